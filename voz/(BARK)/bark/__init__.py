@@ -1,2 +1,30 @@
-from .api import generate_audio, text_to_semantic, semantic_to_waveform, save_as_prompt
-from .generation import SAMPLE_RATE, preload_models
+# the public api is imported on first attribute access, so `import bark` (and the cli) doesn't
+# pay for torch and the model code until it's actually used
+_EXPORTS = {
+    "generate_audio": "api",
+    "generate_audio_stream": "api",
+    "generate_long_audio": "api",
+    "text_to_semantic": "api",
+    "semantic_to_waveform": "api",
+    "semantic_to_waveform_stream": "api",
+    "save_as_prompt": "api",
+    "SAMPLE_RATE": "generation",
+    "preload_models": "generation",
+    "preload_models_async": "generation",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
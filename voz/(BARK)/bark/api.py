@@ -1,8 +1,62 @@
-from typing import Dict, Optional, Union
+import logging
+import queue
+import re
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
 import numpy as np
 
-from .generation import codec_decode, generate_coarse, generate_fine, generate_text_semantic
+from .cache import digest_arrays, make_key
+from .generation import (
+    N_COARSE_CODEBOOKS,
+    N_FINE_CODEBOOKS,
+    SAMPLE_RATE,
+    USE_FINE_LENGTH_BUCKETS,
+    USE_GENERATION_CACHE,
+    HistoryPrompt,
+    can_overlap_stages,
+    codec_decode,
+    codec_decode_stream,
+    generate_coarse,
+    generate_coarse_stream,
+    generate_fine,
+    generate_fine_stream,
+    generate_text_semantic,
+    generate_text_semantic_stream,
+    get_generation_cache,
+    load_history_prompt,
+    model_variant,
+    trim_semantic_silence,
+    trim_semantic_silence_stream,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _get_cache(use_cache, seed):
+    if not (use_cache or USE_GENERATION_CACHE):
+        return None
+    if seed is None:
+        # unseeded generations aren't reproducible, so there is nothing to reuse
+        if use_cache:
+            logger.warning("the generation cache is only used with an explicit seed")
+        return None
+    return get_generation_cache()
+
+
+def _prompt_id(history_prompt):
+    return None if history_prompt is None else history_prompt.digest()
+
+
+def _cached(cache, key, generate_fn):
+    if cache is not None:
+        out = cache.get(key)
+        if out is not None:
+            return out
+    out = generate_fn()
+    if cache is not None:
+        cache.put(key, out)
+    return out
 
 
 def text_to_semantic(
@@ -10,6 +64,10 @@ def text_to_semantic(
     history_prompt: Optional[Union[Dict, str]] = None,
     temp: float = 0.7,
     silent: bool = False,
+    seed: Optional[int] = None,
+    use_cache: bool = False,
+    min_eos_p: float = 0.2,
+    trim_silence: bool = False,
 ):
     """Generate semantic array from text.
 
@@ -18,17 +76,42 @@ def text_to_semantic(
         history_prompt: history choice for audio cloning
         temp: generation temperature (1.0 more diverse, 0.0 more conservative)
         silent: disable progress bar
+        seed: seed for reproducible sampling
+        use_cache: reuse and store the result in the generation cache (needs a seed)
+        min_eos_p: end of sentence probability above which generation stops (lower ends sooner)
+        trim_silence: drop trailing silence so the later stages don't render it
 
     Returns:
         numpy semantic array to be fed into `semantic_to_waveform`
     """
-    x_semantic = generate_text_semantic(
-        text,
-        history_prompt=history_prompt,
-        temp=temp,
-        silent=silent,
-        use_kv_caching=True
+    history_prompt = load_history_prompt(history_prompt)
+    cache = _get_cache(use_cache, seed)
+    key = None
+    if cache is not None:
+        key = make_key(
+            "semantic",
+            text=" ".join(text.split()),
+            prompt=_prompt_id(history_prompt),
+            temp=temp,
+            min_eos_p=min_eos_p,
+            seed=seed,
+            model=model_variant("text"),
+        )
+    x_semantic = _cached(
+        cache,
+        key,
+        lambda: generate_text_semantic(
+            text,
+            history_prompt=history_prompt,
+            temp=temp,
+            silent=silent,
+            min_eos_p=min_eos_p,
+            use_kv_caching=True,
+            seed=seed,
+        ),
     )
+    if trim_silence:
+        x_semantic = trim_semantic_silence(x_semantic)
     return x_semantic
 
 
@@ -38,6 +121,8 @@ def semantic_to_waveform(
     temp: float = 0.7,
     silent: bool = False,
     output_full: bool = False,
+    seed: Optional[int] = None,
+    use_cache: bool = False,
 ):
     """Generate audio array from semantic input.
 
@@ -47,23 +132,65 @@ def semantic_to_waveform(
         temp: generation temperature (1.0 more diverse, 0.0 more conservative)
         silent: disable progress bar
         output_full: return full generation to be used as a history prompt
+        seed: seed for reproducible sampling
+        use_cache: reuse and store each stage in the generation cache (needs a seed)
 
     Returns:
         numpy audio array at sample frequency 24khz
     """
-    coarse_tokens = generate_coarse(
-        semantic_tokens,
-        history_prompt=history_prompt,
-        temp=temp,
-        silent=silent,
-        use_kv_caching=True
-    )
-    fine_tokens = generate_fine(
-        coarse_tokens,
-        history_prompt=history_prompt,
-        temp=0.5,
-    )
-    audio_arr = codec_decode(fine_tokens)
+    # load and preprocess the speaker once for both stages
+    history_prompt = load_history_prompt(history_prompt)
+    cache = _get_cache(use_cache, seed)
+    keys = {}
+    if cache is not None:
+        keys["coarse"] = make_key(
+            "coarse",
+            semantic=digest_arrays(semantic_tokens),
+            prompt=_prompt_id(history_prompt),
+            temp=temp,
+            seed=seed,
+            model=model_variant("coarse"),
+        )
+        fine_params = dict(temp=0.5, seed=seed, model=model_variant("fine"))
+        if USE_FINE_LENGTH_BUCKETS:
+            # bucketed fine codes differ from padded ones, keep them apart
+            fine_params["length_buckets"] = True
+        keys["fine"] = make_key("fine", parent=keys["coarse"], **fine_params)
+        keys["audio"] = make_key("audio", parent=keys["fine"], model=model_variant("codec"))
+    # resume from the deepest cached stage
+    audio_arr = None
+    fine_tokens = None
+    coarse_tokens = None
+    if cache is not None and not output_full:
+        audio_arr = cache.get(keys["audio"])
+    if audio_arr is None and cache is not None:
+        fine_tokens = cache.get(keys["fine"])
+    if fine_tokens is None or output_full:
+        coarse_tokens = _cached(
+            cache,
+            keys.get("coarse"),
+            lambda: generate_coarse(
+                semantic_tokens,
+                history_prompt=history_prompt,
+                temp=temp,
+                silent=silent,
+                use_kv_caching=True,
+                seed=seed,
+            ),
+        )
+    if audio_arr is None and fine_tokens is None:
+        fine_tokens = _cached(
+            cache,
+            keys.get("fine"),
+            lambda: generate_fine(
+                coarse_tokens,
+                history_prompt=history_prompt,
+                temp=0.5,
+                seed=seed,
+            ),
+        )
+    if audio_arr is None:
+        audio_arr = _cached(cache, keys.get("audio"), lambda: codec_decode(fine_tokens))
     if output_full:
         full_generation = {
             "semantic_prompt": semantic_tokens,
@@ -74,6 +201,51 @@ def semantic_to_waveform(
     return audio_arr
 
 
+def semantic_to_waveform_stream(
+    semantic_tokens: Union[np.ndarray, Iterable[np.ndarray]],
+    history_prompt: Optional[Union[Dict, str]] = None,
+    temp: float = 0.7,
+    silent: bool = False,
+    seed: Optional[int] = None,
+) -> Iterator[np.ndarray]:
+    """Generate audio from semantic input, yielding it in chunks as coarse windows complete.
+
+    The coarse, fine and codec stages run interleaved on overlapping segments, so the first
+    chunk is ready after a couple of coarse windows instead of after the whole generation.
+
+    Args:
+        semantic_tokens: semantic token output from `text_to_semantic`, or chunks of it as
+            they are generated (e.g. from `generate_text_semantic_stream`)
+        history_prompt: history choice for audio cloning
+        temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        silent: disable progress bar
+        seed: seed for reproducible sampling
+
+    Yields:
+        numpy audio arrays at sample frequency 24khz, to be played back to back
+    """
+    history_prompt = load_history_prompt(history_prompt)
+    coarse_chunks = generate_coarse_stream(
+        semantic_tokens,
+        history_prompt=history_prompt,
+        temp=temp,
+        silent=silent,
+        use_kv_caching=True,
+        seed=seed,
+    )
+    fine_chunks = generate_fine_stream(
+        coarse_chunks, history_prompt=history_prompt, temp=0.5, seed=seed
+    )
+    audio_chunks = codec_decode_stream(fine_chunks)
+    try:
+        yield from audio_chunks
+    finally:
+        # unpin the models right away if the caller stops early
+        audio_chunks.close()
+        fine_chunks.close()
+        coarse_chunks.close()
+
+
 def save_as_prompt(filepath, full_generation):
     assert(filepath.endswith(".npz"))
     assert(isinstance(full_generation, dict))
@@ -83,6 +255,64 @@ def save_as_prompt(filepath, full_generation):
     np.savez(filepath, **full_generation)
 
 
+def _semantic_stream(text, history_prompt, temp, silent, seed, trim_silence):
+    semantic_chunks = generate_text_semantic_stream(
+        text,
+        history_prompt=history_prompt,
+        temp=temp,
+        silent=silent,
+        use_kv_caching=True,
+        seed=seed,
+    )
+    if trim_silence:
+        semantic_chunks = trim_semantic_silence_stream(semantic_chunks)
+    return semantic_chunks
+
+
+def _use_overlap(overlap_stages, use_cache, seed):
+    if overlap_stages is None:
+        # without a seed both stages draw from the global torch rng at the same time, and
+        # `torch.manual_seed(n)` would no longer make runs reproducible
+        overlap_stages = seed is not None
+    return overlap_stages and _get_cache(use_cache, seed) is None and can_overlap_stages()
+
+
+def _generate_audio_overlapped(
+    text, history_prompt, text_temp, waveform_temp, silent, output_full, seed, trim_silence
+):
+    # the coarse stage consumes semantic tokens while they are sampled on another thread,
+    # with a seed the output is the same as running the stages one after the other
+    semantic_chunks = []
+
+    def _semantic_producer():
+        for chunk in _semantic_stream(
+            text, history_prompt, text_temp, silent, seed, trim_silence
+        ):
+            semantic_chunks.append(chunk)
+            yield chunk
+
+    coarse_tokens = generate_coarse(
+        _semantic_producer(),
+        history_prompt=history_prompt,
+        temp=waveform_temp,
+        silent=silent,
+        use_kv_caching=True,
+        seed=seed,
+    )
+    fine_tokens = generate_fine(
+        coarse_tokens, history_prompt=history_prompt, temp=0.5, seed=seed
+    )
+    audio_arr = codec_decode(fine_tokens)
+    if output_full:
+        full_generation = {
+            "semantic_prompt": np.concatenate(semantic_chunks),
+            "coarse_prompt": coarse_tokens,
+            "fine_prompt": fine_tokens,
+        }
+        return full_generation, audio_arr
+    return audio_arr
+
+
 def generate_audio(
     text: str,
     history_prompt: Optional[Union[Dict, str]] = None,
@@ -90,6 +320,10 @@ def generate_audio(
     waveform_temp: float = 0.7,
     silent: bool = False,
     output_full: bool = False,
+    seed: Optional[int] = None,
+    use_cache: bool = False,
+    trim_silence: bool = False,
+    overlap_stages: Optional[bool] = None,
 ):
     """Generate audio array from input text.
 
@@ -100,15 +334,39 @@ def generate_audio(
         waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
         silent: disable progress bar
         output_full: return full generation to be used as a history prompt
+        seed: seed for reproducible sampling
+        use_cache: reuse and store each stage in the generation cache (needs a seed)
+        trim_silence: drop trailing silence before rendering audio from the semantic tokens
+        overlap_stages: run the semantic and coarse stages concurrently, by default only with
+            a seed (unseeded overlapped runs are not reproducible with `torch.manual_seed`)
 
     Returns:
         numpy audio array at sample frequency 24khz
     """
+    history_prompt = load_history_prompt(history_prompt)
+    if _use_overlap(overlap_stages, use_cache, seed):
+        out = _generate_audio_overlapped(
+            text,
+            history_prompt=history_prompt,
+            text_temp=text_temp,
+            waveform_temp=waveform_temp,
+            silent=silent,
+            output_full=output_full,
+            seed=seed,
+            trim_silence=trim_silence,
+        )
+        if output_full:
+            full_generation, audio_arr = out
+            return full_generation, audio_arr
+        return out
     semantic_tokens = text_to_semantic(
         text,
         history_prompt=history_prompt,
         temp=text_temp,
         silent=silent,
+        seed=seed,
+        use_cache=use_cache,
+        trim_silence=trim_silence,
     )
     out = semantic_to_waveform(
         semantic_tokens,
@@ -116,6 +374,8 @@ def generate_audio(
         temp=waveform_temp,
         silent=silent,
         output_full=output_full,
+        seed=seed,
+        use_cache=use_cache,
     )
     if output_full:
         full_generation, audio_arr = out
@@ -123,3 +383,217 @@ def generate_audio(
     else:
         audio_arr = out
     return audio_arr
+
+
+def generate_audio_stream(
+    text: str,
+    history_prompt: Optional[Union[Dict, str]] = None,
+    text_temp: float = 0.7,
+    waveform_temp: float = 0.7,
+    silent: bool = False,
+    seed: Optional[int] = None,
+    use_cache: bool = False,
+    trim_silence: bool = False,
+    overlap_stages: Optional[bool] = None,
+) -> Iterator[np.ndarray]:
+    """Generate audio from input text, yielding it in chunks as soon as they are decoded.
+
+    Args:
+        text: text to be turned into audio
+        history_prompt: history choice for audio cloning
+        text_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        silent: disable progress bar
+        seed: seed for reproducible sampling
+        use_cache: reuse and store the semantic tokens in the generation cache (needs a seed)
+        trim_silence: drop trailing silence before rendering audio from the semantic tokens
+        overlap_stages: run the semantic and coarse stages concurrently, by default only with
+            a seed (unseeded overlapped runs are not reproducible with `torch.manual_seed`)
+
+    Yields:
+        numpy audio arrays at sample frequency 24khz, to be played back to back
+    """
+    history_prompt = load_history_prompt(history_prompt)
+    if _use_overlap(overlap_stages, use_cache, seed):
+        # coarse windows start while the semantic tokens after them are still being sampled
+        semantic_tokens = _semantic_stream(
+            text, history_prompt, text_temp, silent, seed, trim_silence
+        )
+    else:
+        semantic_tokens = text_to_semantic(
+            text,
+            history_prompt=history_prompt,
+            temp=text_temp,
+            silent=silent,
+            seed=seed,
+            use_cache=use_cache,
+            trim_silence=trim_silence,
+        )
+    yield from semantic_to_waveform_stream(
+        semantic_tokens,
+        history_prompt=history_prompt,
+        temp=waveform_temp,
+        silent=silent,
+        seed=seed,
+    )
+
+
+def split_sentences(text: str, max_chars: int = 220) -> List[str]:
+    """Split text into sentences, breaking up any longer than `max_chars` between words.
+
+    Args:
+        text: text to split
+        max_chars: longest sentence kept whole (bark fits roughly 13s of speech per generation)
+
+    Returns:
+        list of sentences
+    """
+    text = " ".join(text.split())
+    sentences = []
+    for sentence in re.split(r"(?<=[.!?…。！？])\s+", text):
+        while len(sentence) > max_chars:
+            # prefer breaking after a clause, else at the last space that fits
+            cut = max(sentence.rfind(p, 0, max_chars) for p in (", ", "; ", ": "))
+            cut = cut + 1 if cut > 0 else sentence.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            sentences.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+_DONE = object()
+
+
+def _put_until(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def generate_long_audio(
+    text: str,
+    history_prompt: Optional[Union[Dict, str]] = None,
+    text_temp: float = 0.7,
+    waveform_temp: float = 0.7,
+    min_eos_p: float = 0.05,
+    silence_s: float = 0.25,
+    carry_history: bool = False,
+    silent: bool = True,
+    seed: Optional[int] = None,
+    use_cache: bool = False,
+    max_queued: int = 2,
+    trim_silence: bool = False,
+) -> Iterator[np.ndarray]:
+    """Generate audio for text of any length, one sentence at a time.
+
+    The semantic stage of the following sentences runs on a worker thread while the coarse,
+    fine and codec stages of the current one run on the calling thread, so stages overlap
+    across sentences instead of adding up. Under a device memory budget or cpu offloading,
+    sentences run one after the other instead.
+
+    Args:
+        text: text to be turned into audio
+        history_prompt: history choice for audio cloning
+        text_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        waveform_temp: generation temperature (1.0 more diverse, 0.0 more conservative)
+        min_eos_p: end of sentence probability above which generation stops (lower ends sooner)
+        silence_s: seconds of silence appended after each sentence
+        carry_history: condition each sentence on the previous one instead of on the prompt
+        silent: disable progress bars
+        seed: seed for reproducible sampling, sentence i uses `seed + i`
+        use_cache: reuse and store each stage in the generation cache (needs a seed)
+        max_queued: how many sentences the semantic stage may run ahead
+        trim_silence: drop each sentence's trailing silence before rendering it
+
+    Yields:
+        numpy audio arrays at sample frequency 24khz, one per sentence (with its trailing silence)
+    """
+    sentences = split_sentences(text)
+    history_prompt = load_history_prompt(history_prompt)
+    silence = np.zeros(int(silence_s * SAMPLE_RATE), dtype=np.float32)
+    semantic_queue = queue.Queue(maxsize=max(1, max_queued))
+    stop = threading.Event()
+
+    def _semantic_sentences():
+        semantic_prompt = history_prompt
+        for i, sentence in enumerate(sentences):
+            if stop.is_set():
+                return
+            x_semantic = text_to_semantic(
+                sentence,
+                history_prompt=semantic_prompt,
+                temp=text_temp,
+                silent=silent,
+                seed=None if seed is None else seed + i,
+                use_cache=use_cache,
+                min_eos_p=min_eos_p,
+                trim_silence=trim_silence,
+            )
+            if carry_history:
+                # the semantic stage only reads the semantic part of its prompt
+                semantic_prompt = HistoryPrompt(
+                    {
+                        "semantic_prompt": x_semantic,
+                        "coarse_prompt": np.zeros((N_COARSE_CODEBOOKS, 0), dtype=np.int64),
+                        "fine_prompt": np.zeros((N_FINE_CODEBOOKS, 0), dtype=np.int64),
+                    }
+                )
+            yield x_semantic
+
+    def _semantic_worker():
+        try:
+            for x_semantic in _semantic_sentences():
+                if not _put_until(semantic_queue, x_semantic, stop):
+                    return
+            _put_until(semantic_queue, _DONE, stop)
+        except BaseException as e:
+            _put_until(semantic_queue, e, stop)
+
+    def _queued_sentences():
+        while True:
+            x_semantic = semantic_queue.get()
+            if isinstance(x_semantic, BaseException):
+                raise x_semantic
+            if x_semantic is _DONE:
+                return
+            yield x_semantic
+
+    if can_overlap_stages():
+        worker = threading.Thread(target=_semantic_worker, name="bark-semantic", daemon=True)
+        worker.start()
+        semantic_sentences = _queued_sentences()
+    else:
+        # a device memory budget or cpu offloading keeps one model resident at a time, so the
+        # next sentence's semantic stage waits for this one's waveform
+        worker = None
+        semantic_sentences = _semantic_sentences()
+    waveform_prompt = history_prompt
+    try:
+        for i, x_semantic in enumerate(semantic_sentences):
+            out = semantic_to_waveform(
+                x_semantic,
+                history_prompt=waveform_prompt,
+                temp=waveform_temp,
+                silent=silent,
+                output_full=carry_history,
+                seed=None if seed is None else seed + i,
+                use_cache=use_cache,
+            )
+            if carry_history:
+                full_generation, audio_arr = out
+                waveform_prompt = HistoryPrompt(full_generation)
+            else:
+                audio_arr = out
+            yield np.concatenate([audio_arr, silence])
+    finally:
+        # also runs when the caller stops iterating early
+        stop.set()
+        if worker is not None:
+            worker.join()
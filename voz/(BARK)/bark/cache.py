@@ -0,0 +1,129 @@
+"""
+Disk-backed, content-addressed cache of generation artifacts.
+
+Each stage's output (semantic tokens, coarse codes, fine codes, waveform) is stored as a .npy
+file named by a hash of everything that determines it: the stage inputs, speaker prompt
+content, sampling parameters, model variant and seed. Stage keys chain onto their parent's
+key, so a lookup can start from the deepest stage and skip all the work before it.
+
+Generation is only deterministic with an explicit seed, so callers only use the cache then.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def digest_arrays(*arrs):
+    """Content hash of integer token arrays, independent of their dtype."""
+    h = hashlib.sha256()
+    for arr in arrs:
+        arr = np.ascontiguousarray(arr, dtype=np.int64)
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def make_key(stage, **parts):
+    """Cache key of a stage output, from JSON-serializable parts (parent keys, params, seed)."""
+    payload = json.dumps({"stage": stage, **parts}, sort_keys=True)
+    return f"{stage}-{hashlib.sha256(payload.encode()).hexdigest()}"
+
+
+class GenerationCache:
+    """
+    Stage artifacts under `cache_dir`, evicting the least recently used ones once they take
+    more than `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (nbytes, last use), rebuilt from the directory so the budget spans restarts
+        self._entries = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith(".npy"):
+                st = os.stat(os.path.join(cache_dir, file_name))
+                self._entries[file_name[: -len(".npy")]] = (st.st_size, st.st_mtime)
+        self._nbytes = sum(nbytes for nbytes, _ in self._entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """The cached array for `key`, or None."""
+        path = self._path(key)
+        try:
+            arr = np.load(path)
+        except (OSError, ValueError):
+            # missing, or evicted/corrupted by another process
+            with self._lock:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._nbytes -= entry[0]
+            return None
+        with self._lock:
+            # the file may have been written by another process since we last listed it
+            self._track(key, path)
+            self._evict(keep=key)
+        try:
+            # mtime doubles as the last-use time for LRU eviction
+            os.utime(path)
+        except OSError:
+            pass
+        logger.debug(f"generation cache hit: {key}")
+        return arr
+
+    def put(self, key, arr):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._track(key, path)
+            self._evict(keep=key)
+
+    def _track(self, key, path):
+        """Record the current size of `key`'s file in the byte count. Call with the lock held."""
+        old = self._entries.get(key)
+        if old is not None:
+            self._nbytes -= old[0]
+        nbytes = os.path.getsize(path)
+        self._entries[key] = (nbytes, os.path.getmtime(path))
+        self._nbytes += nbytes
+
+    def _evict(self, keep=None):
+        if self._nbytes <= self.max_bytes:
+            return
+        for key, (nbytes, _) in sorted(self._entries.items(), key=lambda kv: kv[1][1]):
+            if self._nbytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            del self._entries[key]
+            self._nbytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._entries = {}
+            self._nbytes = 0
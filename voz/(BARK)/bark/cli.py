@@ -2,9 +2,30 @@ import argparse
 from typing import Dict, Optional, Union
 import os
 
-from scipy.io.wavfile import write as write_wav
-from .api import generate_audio
-from .generation import SAMPLE_RATE
+# nothing heavy (torch, scipy, the models) is imported at module level: arguments are parsed
+# and checked first, so `--help` and bad invocations return right away
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "prompts")
+
+
+def _validate_args(parser, args):
+    if not args.get("text") or not args["text"].strip():
+        parser.error("--text is required and can't be empty")
+    history_prompt = args.get("history_prompt")
+    if history_prompt is not None:
+        if history_prompt.endswith(".npz"):
+            prompt_path = history_prompt
+        else:
+            prompt_path = os.path.join(PROMPTS_DIR, *history_prompt.split("/")) + ".npz"
+        if not os.path.isfile(prompt_path):
+            parser.error(f"history prompt not found: {history_prompt}")
+    for name in ("text_temp", "waveform_temp"):
+        if args[name] < 0:
+            parser.error(f"--{name} can't be negative")
+    try:
+        os.makedirs(args["output_dir"], exist_ok=True)
+    except OSError as e:
+        parser.error(f"can't create --output_dir: {e}")
 
 
 def cli():
@@ -45,6 +66,7 @@ def cli():
     )
 
     args = vars(parser.parse_args())
+    _validate_args(parser, args)
     input_text: str = args.get("text")
     output_filename: str = args.get("output_filename")
     output_dir: str = args.get("output_dir")
@@ -54,8 +76,11 @@ def cli():
     silent: bool = args.get("silent")
     output_full: bool = args.get("output_full")
 
+    from scipy.io.wavfile import write as write_wav
+    from .api import generate_audio
+    from .generation import SAMPLE_RATE
+
     try:
-        os.makedirs(output_dir, exist_ok=True)
         generated_audio = generate_audio(
             input_text,
             history_prompt=history_prompt,
@@ -1,45 +1,57 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
+import functools
 import gc
+import inspect
 import os
+import queue
 import re
+import threading
 
-from encodec import EncodecModel
 import funcy
 import logging
 import numpy as np
-from scipy.special import softmax
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import tqdm
-from transformers import BertTokenizer
-from huggingface_hub import hf_hub_download
-import torch.serialization
-torch.serialization.add_safe_globals([np.core.multiarray.scalar])
 
-from .model import GPTConfig, GPT
+from .model import GPTConfig, GPT, StaticKVCache
 from .model_fine import FineGPT, FineGPTConfig
+from .cache import GenerationCache, digest_arrays
+from . import prompt_archive
+from . import sampling
+
+# encodec, transformers and huggingface_hub are imported where they're used, and cuda is only
+# probed on first use, so importing bark (and `python -m bark --help`) stays cheap
+
+
+@functools.lru_cache(maxsize=None)
+def _use_bf16_autocast():
+    return (
+        torch.cuda.is_available() and
+        hasattr(torch.cuda, "amp") and
+        hasattr(torch.cuda.amp, "autocast") and
+        hasattr(torch.cuda, "is_bf16_supported") and
+        torch.cuda.is_bf16_supported()
+    )
 
-if (
-    torch.cuda.is_available() and
-    hasattr(torch.cuda, "amp") and
-    hasattr(torch.cuda.amp, "autocast") and
-    hasattr(torch.cuda, "is_bf16_supported") and
-    torch.cuda.is_bf16_supported()
-):
-    autocast = funcy.partial(torch.cuda.amp.autocast, dtype=torch.bfloat16)
-else:
-    @contextlib.contextmanager
-    def autocast():
-        yield
 
+def autocast():
+    if _use_bf16_autocast():
+        return torch.cuda.amp.autocast(dtype=torch.bfloat16)
+    return contextlib.nullcontext()
 
-# hold models in global scope to lazy load
-global models
-models = {}
 
+# device each model runs on, by model key (models may sit on cpu in between uses)
 global models_devices
 models_devices = {}
 
+# checkpoint each model was loaded from, by model key
+model_variants = {}
+
 
 CONTEXT_WINDOW_SIZE = 1024
 
@@ -94,6 +106,30 @@ def _cast_bool_env_var(s):
 USE_SMALL_MODELS = _cast_bool_env_var(os.environ.get("SUNO_USE_SMALL_MODELS", "False"))
 GLOBAL_ENABLE_MPS = _cast_bool_env_var(os.environ.get("SUNO_ENABLE_MPS", "False"))
 OFFLOAD_CPU = _cast_bool_env_var(os.environ.get("SUNO_OFFLOAD_CPU", "False"))
+USE_INT8 = _cast_bool_env_var(os.environ.get("SUNO_USE_INT8", "False"))
+USE_CONVERTED_CKPTS = _cast_bool_env_var(os.environ.get("SUNO_USE_CONVERTED_CKPTS", "True"))
+
+
+def _cast_gb_env_var(s):
+    return None if s is None else int(float(s) * 2**30)
+
+
+# byte budgets for the model residency manager, unlimited if unset
+HOST_MEMORY_BUDGET = _cast_gb_env_var(os.environ.get("SUNO_HOST_MEMORY_BUDGET_GB"))
+DEVICE_MEMORY_BUDGET = _cast_gb_env_var(os.environ.get("SUNO_DEVICE_MEMORY_BUDGET_GB"))
+PREFETCH_MODELS = _cast_bool_env_var(os.environ.get("SUNO_PREFETCH_MODELS", "True"))
+# number of preprocessed speaker prompts kept in memory
+PROMPT_CACHE_SIZE = int(os.environ.get("SUNO_PROMPT_CACHE_SIZE", "64"))
+USE_PROMPT_ARCHIVE = _cast_bool_env_var(os.environ.get("SUNO_USE_PROMPT_ARCHIVE", "True"))
+# disk cache of seeded generations, see `get_generation_cache`
+USE_GENERATION_CACHE = _cast_bool_env_var(os.environ.get("SUNO_USE_GENERATION_CACHE", "False"))
+GENERATION_CACHE_SIZE = _cast_gb_env_var(os.environ.get("SUNO_GENERATION_CACHE_GB", "2"))
+# run the fine model on the shortest bucket that fits a short clip, instead of 1024 frames
+USE_FINE_LENGTH_BUCKETS = _cast_bool_env_var(os.environ.get("SUNO_FINE_LENGTH_BUCKETS", "False"))
+# the rust tokenizer gives the same ids as the python one, much faster and batched
+USE_FAST_TOKENIZER = _cast_bool_env_var(os.environ.get("SUNO_USE_FAST_TOKENIZER", "True"))
+# number of encoded texts kept in memory
+TEXT_CACHE_SIZE = int(os.environ.get("SUNO_TEXT_CACHE_SIZE", "1024"))
 
 
 REMOTE_MODEL_PATHS = {
@@ -124,14 +160,28 @@ REMOTE_MODEL_PATHS = {
 }
 
 
-if not hasattr(torch.nn.functional, 'scaled_dot_product_attention') and torch.cuda.is_available():
-    logger.warning(
-        "torch version does not support flash attention. You will get faster" +
-        " inference speed by upgrade torch to newest nightly version."
-    )
+@functools.lru_cache(maxsize=None)
+def _init_torch_backends():
+    """One-time torch setup, done on first use instead of at import since it probes cuda."""
+    if not torch.cuda.is_available():
+        return
+    if not hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+        logger.warning(
+            "torch version does not support flash attention. You will get faster" +
+            " inference speed by upgrade torch to newest nightly version."
+        )
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+
+@functools.lru_cache(maxsize=None)
+def _allow_numpy_scalars():
+    # older checkpoints pickle numpy scalars, which torch.load(weights_only=True) rejects
+    torch.serialization.add_safe_globals([np.core.multiarray.scalar])
 
 
 def _grab_best_device(use_gpu=True):
+    _init_torch_backends()
     if torch.cuda.device_count() > 0 and use_gpu:
         device = "cuda"
     elif torch.backends.mps.is_available() and use_gpu and GLOBAL_ENABLE_MPS:
@@ -148,7 +198,19 @@ def _get_ckpt_path(model_type, use_small=False):
     return os.path.join(CACHE_DIR, REMOTE_MODEL_PATHS[key]["file_name"])
 
 
+def _get_int8_ckpt_path(ckpt_path):
+    root, ext = os.path.splitext(ckpt_path)
+    return f"{root}_int8{ext}"
+
+
+def _get_converted_ckpt_path(ckpt_path):
+    root, ext = os.path.splitext(ckpt_path)
+    return f"{root}_mmap{ext}"
+
+
 def _download(from_hf_path, file_name):
+    from huggingface_hub import hf_hub_download
+
     os.makedirs(CACHE_DIR, exist_ok=True)
     hf_hub_download(repo_id=from_hf_path, filename=file_name, local_dir=CACHE_DIR)
 
@@ -167,13 +229,9 @@ class InferenceContext:
         torch.backends.cudnn.benchmark = self._cudnn_benchmark
 
 
-if torch.cuda.is_available():
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.allow_tf32 = True
-
-
 @contextlib.contextmanager
 def _inference_mode():
+    _init_torch_backends()
     with InferenceContext(), torch.inference_mode(), torch.no_grad(), autocast():
         yield
 
@@ -184,6 +242,262 @@ def _clear_cuda_cache():
         torch.cuda.synchronize()
 
 
+def _unwrap_model(model):
+    return model["model"] if isinstance(model, dict) else model
+
+
+def _model_nbytes(model):
+    """Bytes held by a model's tensors, counting tied weights once."""
+    seen = set()
+    nbytes = 0
+    for v in _unwrap_model(model).state_dict().values():
+        # packed int8 linears show up as (weight, bias) tuples
+        for t in v if isinstance(v, tuple) else (v,):
+            if isinstance(t, torch.Tensor) and t.data_ptr() not in seen:
+                seen.add(t.data_ptr())
+                nbytes += t.numel() * t.element_size()
+    return nbytes
+
+
+def _model_on_device(model):
+    return next(_unwrap_model(model).parameters()).device.type != "cpu"
+
+
+class ModelManager(MutableMapping):
+    """
+    Holds the loaded models by key ("text", "coarse", "fine", "codec", "text_small", ...).
+
+    Models are kept in LRU order and evicted when their memory exceeds the host budget (models
+    on cpu) or device budget (models on gpu/mps). A model evicted from the device is moved back
+    to cpu, one evicted from the host is dropped and reloaded on its next use with the loader
+    it was last loaded with. Models between `acquire` and `release` are pinned and never
+    evicted. A device budget of 0 moves each model back to cpu right after use, which is what
+    `SUNO_OFFLOAD_CPU` does without a budget.
+    """
+
+    def __init__(self, host_budget=None, device_budget=None, prefetch=True):
+        self.host_budget = host_budget
+        self.device_budget = device_budget
+        self.prefetch_enabled = prefetch
+        self._models = OrderedDict()
+        self._nbytes = {}
+        self._pins = {}
+        self._loaders = {}
+        self._futures = {}
+        self._executor = None
+        self._lock = threading.RLock()
+        self._load_locks = {}
+
+    def __getitem__(self, model_key):
+        with self._lock:
+            model = self._models[model_key]
+            self._models.move_to_end(model_key)
+            return model
+
+    def __setitem__(self, model_key, model):
+        with self._lock:
+            self._models[model_key] = model
+            self._models.move_to_end(model_key)
+            self._nbytes[model_key] = _model_nbytes(model)
+            evicted = self._enforce_budgets(keep=model_key)
+        if evicted:
+            _clear_cuda_cache()
+            gc.collect()
+
+    def __delitem__(self, model_key):
+        with self._lock:
+            del self._models[model_key]
+            del self._nbytes[model_key]
+
+    def __iter__(self):
+        # a snapshot, loader and prefetch threads may add or evict models meanwhile
+        with self._lock:
+            model_keys = list(self._models)
+        return iter(model_keys)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._models)
+
+    def set_budget(self, host_budget=None, device_budget=None):
+        """Set the host and device byte budgets (None for unlimited) and evict to fit them."""
+        with self._lock:
+            self.host_budget = host_budget
+            self.device_budget = device_budget
+            evicted = self._enforce_budgets()
+        if evicted:
+            _clear_cuda_cache()
+            gc.collect()
+
+    def set_loader(self, model_key, loader):
+        """Remember how `model_key` was loaded, to reload it after an eviction."""
+        self._loaders[model_key] = loader
+
+    def usage(self):
+        """Bytes of model memory currently held on the host and on the device."""
+        with self._lock:
+            host, device = 0, 0
+            for model_key, model in self._models.items():
+                if _model_on_device(model):
+                    device += self._nbytes[model_key]
+                else:
+                    host += self._nbytes[model_key]
+            return host, device
+
+    def _enforce_budgets(self, keep=None):
+        evicted = []
+        host, device = self.usage()
+        # oldest first, never touching pinned models or the one being added
+        candidates = [
+            k for k in self._models if k != keep and self._pins.get(k, 0) == 0
+        ]
+        if self.device_budget is not None:
+            for model_key in candidates:
+                if device <= self.device_budget:
+                    break
+                model = self._models[model_key]
+                if _model_on_device(model):
+                    _unwrap_model(model).to("cpu")
+                    device -= self._nbytes[model_key]
+                    host += self._nbytes[model_key]
+                    evicted.append(model_key)
+                    logger.debug(f"moved {model_key} model to cpu to fit the device budget")
+        if self.host_budget is not None:
+            for model_key in candidates:
+                if host <= self.host_budget:
+                    break
+                if not _model_on_device(self._models[model_key]):
+                    host -= self._nbytes[model_key]
+                    del self[model_key]
+                    evicted.append(model_key)
+                    logger.info(f"evicted {model_key} model to fit the host memory budget")
+        return evicted
+
+    def _submit(self, model_key, fn):
+        with self._lock:
+            future = self._futures.get(model_key)
+            if future is not None and not future.done():
+                return future
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bark-load")
+            future = self._executor.submit(fn)
+            self._futures[model_key] = future
+            return future
+
+    def load_async(self, model_key, loader):
+        """Run `loader` in the background, unless a load of `model_key` is already in flight."""
+        return self._submit(model_key, loader)
+
+    def ready(self, model_key):
+        future = self._futures.get(model_key)
+        if future is not None and not future.done():
+            return False
+        return model_key in self
+
+    def wait(self, model_key, timeout=None):
+        future = self._futures.get(model_key)
+        if future is not None:
+            future.result(timeout=timeout)
+
+    def _ensure_loaded(self, model_key):
+        with self._lock:
+            load_lock = self._load_locks.setdefault(model_key, threading.Lock())
+        with load_lock:
+            if model_key not in self:
+                loader = self._loaders.get(model_key, funcy.partial(_default_loader, model_key))
+                loader()
+        return self[model_key]
+
+    def _needs_move(self, model_key, model):
+        device = models_devices.get(model_key)
+        return device is not None and device != "cpu" and not _model_on_device(model)
+
+    def _move_to_device(self, model_key, model):
+        with self._lock:
+            if not self._needs_move(model_key, model):
+                return
+            _unwrap_model(model).to(models_devices[model_key])
+            self._enforce_budgets(keep=model_key)
+
+    def acquire(self, model_key):
+        """Load `model_key` if needed, move it to its device and pin it until `release`."""
+        try:
+            self.wait(model_key)
+        except Exception as e:
+            # a failed background load is retried below, raising from this thread if it fails again
+            logger.warning(f"background load of {model_key} model failed: {e!r}")
+        model = self._ensure_loaded(model_key)
+        with self._lock:
+            self._pins[model_key] = self._pins.get(model_key, 0) + 1
+        try:
+            self._move_to_device(model_key, model)
+        except BaseException:
+            self.release(model_key)
+            raise
+        return model
+
+    def release(self, model_key):
+        with self._lock:
+            self._pins[model_key] = max(self._pins.get(model_key, 0) - 1, 0)
+            evicted = self._enforce_budgets()
+        if evicted:
+            _clear_cuda_cache()
+
+    def prefetch(self, model_key):
+        """
+        Load `model_key` in the background and move it to its device if that fits the device
+        budget, so the next pipeline stage is ready by the time the current one finishes.
+        """
+        if not self.prefetch_enabled:
+            return
+        with self._lock:
+            model = self._models.get(model_key)
+            if model is not None and not (
+                self._needs_move(model_key, model) and self._fits_on_device(model_key)
+            ):
+                return
+
+        def _prefetch():
+            model = self._ensure_loaded(model_key)
+            with self._lock:
+                if self._fits_on_device(model_key):
+                    self._move_to_device(model_key, model)
+
+        self._submit(model_key, _prefetch)
+
+    def _fits_on_device(self, model_key):
+        if self.device_budget is None:
+            return True
+        return self.usage()[1] + self._nbytes[model_key] <= self.device_budget
+
+    def _after_fork(self):
+        # the loader threads don't survive a fork, and their locks may have been taken
+        self._executor = None
+        self._futures = {}
+        self._lock = threading.RLock()
+        self._load_locks = {}
+
+
+def _default_loader(model_key):
+    if model_key == "codec":
+        load_codec_model()
+    elif model_key == "text_small":
+        load_draft_model()
+    else:
+        load_model(model_type=model_key)
+
+
+# hold models in global scope to lazy load
+global models
+models = ModelManager(
+    host_budget=HOST_MEMORY_BUDGET,
+    device_budget=0 if OFFLOAD_CPU and DEVICE_MEMORY_BUDGET is None else DEVICE_MEMORY_BUDGET,
+    prefetch=PREFETCH_MODELS,
+)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: models._after_fork())
+
+
 def clean_models(model_key=None):
     global models
     model_keys = [model_key] if model_key is not None else list(models.keys())
@@ -194,34 +508,86 @@ def clean_models(model_key=None):
     gc.collect()
 
 
-def _load_model(ckpt_path, device, use_small=False, model_type="text"):
+def _quantize_int8(model):
+    """Dynamic int8 quantization of every nn.Linear (attention, mlp and lm_head(s)), CPU only."""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def _swap_linears_for_int8(module):
+    """Replace nn.Linear layers by empty int8 ones, so a quantized state dict can be loaded."""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(
+                module,
+                name,
+                torch.ao.nn.quantized.dynamic.Linear(
+                    child.in_features, child.out_features, bias_=child.bias is not None
+                ),
+            )
+        else:
+            _swap_linears_for_int8(child)
+    return module
+
+
+def _save_int8_model(model, model_args, int8_ckpt_path):
+    tmp_path = f"{int8_ckpt_path}.tmp"
+    torch.save({"model_args": model_args, "model": model.state_dict()}, tmp_path)
+    os.replace(tmp_path, int8_ckpt_path)
+    logger.info(f"int8 checkpoint cached at `{int8_ckpt_path}`")
+
+
+def _load_int8_model(int8_ckpt_path, ConfigClass, ModelClass):
+    # packed int8 weights are torchbind objects, which the weights_only unpickler rejects
+    checkpoint = torch.load(int8_ckpt_path, map_location="cpu", weights_only=False)
+    model = _swap_linears_for_int8(ModelClass(ConfigClass(**checkpoint["model_args"])))
+    result = model.load_state_dict(checkpoint["model"], strict=False)
+    # the causal mask buffer only exists without flash attention, so it may differ between torch
+    # versions, any other key left out would leave a layer at its random init
+    extra_keys = set([k for k in result.unexpected_keys if not k.endswith(".attn.bias")])
+    missing_keys = set([k for k in result.missing_keys if not k.endswith(".attn.bias")])
+    if len(extra_keys) != 0:
+        raise ValueError(f"extra keys found in `{int8_ckpt_path}`: {extra_keys}")
+    if len(missing_keys) != 0:
+        raise ValueError(f"missing keys in `{int8_ckpt_path}`: {missing_keys}")
+    model.eval()
+    logger.info(f"int8 model loaded from `{int8_ckpt_path}`")
+    return model
+
+
+def _load_tokenizer():
+    if USE_FAST_TOKENIZER:
+        try:
+            from transformers import BertTokenizerFast
+
+            return BertTokenizerFast.from_pretrained("bert-base-multilingual-cased")
+        except ImportError as e:
+            # the fast tokenizer needs the `tokenizers` package
+            logger.warning(f"fast tokenizer unavailable, using the python one: {e}")
+    from transformers import BertTokenizer
+
+    return BertTokenizer.from_pretrained("bert-base-multilingual-cased")
+
+
+def _wrap_text_model(model, model_type):
     if model_type == "text":
-        ConfigClass = GPTConfig
-        ModelClass = GPT
-    elif model_type == "coarse":
-        ConfigClass = GPTConfig
-        ModelClass = GPT
-    elif model_type == "fine":
-        ConfigClass = FineGPTConfig
-        ModelClass = FineGPT
-    else:
-        raise NotImplementedError()
-    model_key = f"{model_type}_small" if use_small or USE_SMALL_MODELS else model_type
-    model_info = REMOTE_MODEL_PATHS[model_key]
-    if not os.path.exists(ckpt_path):
-        logger.info(f"{model_type} model not found, downloading into `{CACHE_DIR}`.")
-        _download(model_info["repo_id"], model_info["file_name"])
-        torch.serialization.add_safe_globals([np.core.multiarray.scalar])  # necessário
-    checkpoint = torch.load(ckpt_path, map_location=device, weights_only=False)
+        tokenizer = _load_tokenizer()
+        return {
+            "model": model,
+            "tokenizer": tokenizer,
+        }
+    return model
+
+
+def _fixup_model_args(model_args):
     # this is a hack
-    model_args = checkpoint["model_args"]
     if "input_vocab_size" not in model_args:
         model_args["input_vocab_size"] = model_args["vocab_size"]
         model_args["output_vocab_size"] = model_args["vocab_size"]
         del model_args["vocab_size"]
-    gptconf = ConfigClass(**checkpoint["model_args"])
-    model = ModelClass(gptconf)
-    state_dict = checkpoint["model"]
+    return model_args
+
+
+def _fixup_state_dict(state_dict, model):
     # fixup checkpoint
     unwanted_prefix = "_orig_mod."
     for k, v in list(state_dict.items()):
@@ -235,24 +601,121 @@ def _load_model(ckpt_path, device, use_small=False, model_type="text"):
         raise ValueError(f"extra keys found: {extra_keys}")
     if len(missing_keys) != 0:
         raise ValueError(f"missing keys: {missing_keys}")
-    model.load_state_dict(state_dict, strict=False)
+    return state_dict
+
+
+def _supports_mmap_loading():
+    # mmap loading needs torch.load(mmap=...) and load_state_dict(assign=...), both torch >= 2.1
+    return (
+        "mmap" in inspect.signature(torch.load).parameters
+        and "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+    )
+
+
+def _convert_checkpoint(ckpt_path, converted_ckpt_path, ConfigClass, ModelClass):
+    """Rewrite a training checkpoint as a plain tensor file that can be memory-mapped."""
+    logger.info(f"converting `{ckpt_path}` for memory-mapped loading.")
+    checkpoint = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+    model_args = _fixup_model_args(checkpoint["model_args"])
+    model_args = {k: v.item() if isinstance(v, np.generic) else v for k, v in model_args.items()}
+    with torch.device("meta"):
+        model = ModelClass(ConfigClass(**model_args))
+    state_dict = _fixup_state_dict(checkpoint["model"], model)
+    state_dict = {k: v for k, v in state_dict.items() if not k.endswith(".attn.bias")}
+    tmp_path = f"{converted_ckpt_path}.tmp"
+    torch.save(
+        {
+            "model_args": model_args,
+            "model": state_dict,
+            "best_val_loss": float(checkpoint["best_val_loss"].item()),
+        },
+        tmp_path,
+    )
+    os.replace(tmp_path, converted_ckpt_path)
+    del checkpoint, state_dict
+
+
+def _needs_conversion(ckpt_path, converted_ckpt_path, force_reload=False):
+    """Whether a converted (mmap or int8) checkpoint is missing, or older than its original."""
+    if not os.path.exists(converted_ckpt_path):
+        return True
+    if not os.path.exists(ckpt_path):
+        # the original may have been deleted to save space, the converted file is all we have
+        return False
+    # a re-downloaded or updated checkpoint is newer than the file converted from the old one
+    return force_reload or os.path.getmtime(ckpt_path) > os.path.getmtime(converted_ckpt_path)
+
+
+def _load_converted_model(converted_ckpt_path, ConfigClass, ModelClass):
+    # tensors stay backed by the file, so pages are read on first use and shared across processes
+    checkpoint = torch.load(converted_ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+    with torch.device("meta"):
+        model = ModelClass(ConfigClass(**checkpoint["model_args"]))
+    model.load_state_dict(checkpoint["model"], strict=False, assign=True)
+    not_loaded = [
+        k for k, v in list(model.named_parameters()) + list(model.named_buffers()) if v.is_meta
+    ]
+    if len(not_loaded) != 0:
+        raise ValueError(f"missing keys: {not_loaded}")
+    return model, checkpoint["model_args"], checkpoint["best_val_loss"]
+
+
+def _load_model(
+    ckpt_path, device, use_small=False, model_type="text", use_int8=False, force_reload=False
+):
+    if model_type == "text":
+        ConfigClass = GPTConfig
+        ModelClass = GPT
+    elif model_type == "coarse":
+        ConfigClass = GPTConfig
+        ModelClass = GPT
+    elif model_type == "fine":
+        ConfigClass = FineGPTConfig
+        ModelClass = FineGPT
+    else:
+        raise NotImplementedError()
+    int8_ckpt_path = _get_int8_ckpt_path(ckpt_path)
+    # a stale int8 checkpoint is quantized again from the float one below
+    if use_int8 and not _needs_conversion(ckpt_path, int8_ckpt_path, force_reload=force_reload):
+        model = _load_int8_model(int8_ckpt_path, ConfigClass, ModelClass)
+        return _wrap_text_model(model, model_type)
+    converted_ckpt_path = _get_converted_ckpt_path(ckpt_path)
+    use_converted = USE_CONVERTED_CKPTS and _supports_mmap_loading()
+    model_key = f"{model_type}_small" if use_small or USE_SMALL_MODELS else model_type
+    model_info = REMOTE_MODEL_PATHS[model_key]
+    if not os.path.exists(ckpt_path) and not (use_converted and os.path.exists(converted_ckpt_path)):
+        logger.info(f"{model_type} model not found, downloading into `{CACHE_DIR}`.")
+        _download(model_info["repo_id"], model_info["file_name"])
+    _allow_numpy_scalars()
+    if use_converted:
+        if _needs_conversion(ckpt_path, converted_ckpt_path, force_reload=force_reload):
+            _convert_checkpoint(ckpt_path, converted_ckpt_path, ConfigClass, ModelClass)
+        model, model_args, val_loss = _load_converted_model(
+            converted_ckpt_path, ConfigClass, ModelClass
+        )
+    else:
+        checkpoint = torch.load(ckpt_path, map_location=device, weights_only=False)
+        model_args = _fixup_model_args(checkpoint["model_args"])
+        gptconf = ConfigClass(**model_args)
+        model = ModelClass(gptconf)
+        state_dict = _fixup_state_dict(checkpoint["model"], model)
+        model.load_state_dict(state_dict, strict=False)
+        val_loss = checkpoint["best_val_loss"].item()
+        del checkpoint, state_dict
     n_params = model.get_num_params()
-    val_loss = checkpoint["best_val_loss"].item()
     logger.info(f"model loaded: {round(n_params/1e6,1)}M params, {round(val_loss,3)} loss")
     model.eval()
+    if use_int8:
+        model = _quantize_int8(model)
+        _save_int8_model(model, model_args, int8_ckpt_path)
     model.to(device)
-    del checkpoint, state_dict
     _clear_cuda_cache()
-    if model_type == "text":
-        tokenizer = BertTokenizer.from_pretrained("bert-base-multilingual-cased")
-        return {
-            "model": model,
-            "tokenizer": tokenizer,
-        }
-    return model
+    return _wrap_text_model(model, model_type)
 
 
 def _load_codec_model(device):
+    from encodec import EncodecModel
+
     model = EncodecModel.encodec_model_24khz()
     model.set_target_bandwidth(6.0)
     model.eval()
@@ -261,21 +724,43 @@ def _load_codec_model(device):
     return model
 
 
-def load_model(use_gpu=True, use_small=False, force_reload=False, model_type="text"):
-    _load_model_f = funcy.partial(_load_model, model_type=model_type, use_small=use_small)
+def load_model(
+    use_gpu=True, use_small=False, force_reload=False, model_type="text", model_key=None, use_int8=False
+):
     if model_type not in ("text", "coarse", "fine"):
         raise NotImplementedError()
     global models
     global models_devices
     device = _grab_best_device(use_gpu=use_gpu)
-    model_key = f"{model_type}"
+    use_int8 = use_int8 or USE_INT8
+    if use_int8 and device != "cpu":
+        # int8 kernels only exist on cpu
+        logger.warning(f"int8 quantization is cpu only, loading float {model_type} model on {device}")
+        use_int8 = False
+    _load_model_f = funcy.partial(
+        _load_model, model_type=model_type, use_small=use_small, use_int8=use_int8
+    )
+    if model_key is None:
+        model_key = f"{model_type}"
+    models.set_loader(
+        model_key,
+        funcy.partial(
+            load_model,
+            use_gpu=use_gpu,
+            use_small=use_small,
+            model_type=model_type,
+            model_key=model_key,
+            use_int8=use_int8,
+        ),
+    )
+    models_devices[model_key] = device
+    model_variants[model_key] = _model_variant(model_type, use_small, use_int8)
     if OFFLOAD_CPU:
-        models_devices[model_key] = device
         device = "cpu"
     if model_key not in models or force_reload:
         ckpt_path = _get_ckpt_path(model_type, use_small=use_small)
         clean_models(model_key=model_key)
-        model = _load_model_f(ckpt_path, device)
+        model = _load_model_f(ckpt_path, device, force_reload=force_reload)
         models[model_key] = model
     if model_type == "text":
         models[model_key]["model"].to(device)
@@ -284,6 +769,20 @@ def load_model(use_gpu=True, use_small=False, force_reload=False, model_type="te
     return models[model_key]
 
 
+def _model_variant(model_type, use_small=False, use_int8=False):
+    variant = os.path.basename(_get_ckpt_path(model_type, use_small=use_small))
+    return f"{variant}+int8" if use_int8 else variant
+
+
+def model_variant(model_key):
+    """The checkpoint `model_key` is (or would by default be) loaded from."""
+    if model_key in model_variants:
+        return model_variants[model_key]
+    if model_key == "codec":
+        return "encodec_24khz@6kbps"
+    return _model_variant(model_key, use_int8=USE_INT8 and _grab_best_device() == "cpu")
+
+
 def load_codec_model(use_gpu=True, force_reload=False):
     global models
     global models_devices
@@ -292,8 +791,10 @@ def load_codec_model(use_gpu=True, force_reload=False):
         # encodec doesn't support mps
         device = "cpu"
     model_key = "codec"
+    models.set_loader(model_key, funcy.partial(load_codec_model, use_gpu=use_gpu))
+    models_devices[model_key] = device
+    model_variants[model_key] = "encodec_24khz@6kbps"
     if OFFLOAD_CPU:
-        models_devices[model_key] = device
         device = "cpu"
     if model_key not in models or force_reload:
         clean_models(model_key=model_key)
@@ -312,6 +813,7 @@ def preload_models(
     fine_use_small=False,
     codec_use_gpu=True,
     force_reload=False,
+    use_int8=False,
 ):
     """Load all the necessary models for the pipeline."""
     if _grab_best_device() == "cpu" and (
@@ -319,20 +821,88 @@ def preload_models(
     ):
         logger.warning("No GPU being used. Careful, inference might be very slow!")
     _ = load_model(
-        model_type="text", use_gpu=text_use_gpu, use_small=text_use_small, force_reload=force_reload
+        model_type="text",
+        use_gpu=text_use_gpu,
+        use_small=text_use_small,
+        force_reload=force_reload,
+        use_int8=use_int8,
     )
     _ = load_model(
         model_type="coarse",
         use_gpu=coarse_use_gpu,
         use_small=coarse_use_small,
         force_reload=force_reload,
+        use_int8=use_int8,
     )
     _ = load_model(
-        model_type="fine", use_gpu=fine_use_gpu, use_small=fine_use_small, force_reload=force_reload
+        model_type="fine",
+        use_gpu=fine_use_gpu,
+        use_small=fine_use_small,
+        force_reload=force_reload,
+        use_int8=use_int8,
     )
     _ = load_codec_model(use_gpu=codec_use_gpu, force_reload=force_reload)
 
 
+def preload_models_async(
+    text_use_gpu=True,
+    text_use_small=False,
+    coarse_use_gpu=True,
+    coarse_use_small=False,
+    fine_use_gpu=True,
+    fine_use_small=False,
+    codec_use_gpu=True,
+    force_reload=False,
+    use_int8=False,
+):
+    """
+    Start loading all models in parallel and return right away with a future per model key.
+
+    `generate_*` functions wait only for the model they need, so semantic generation can start
+    as soon as the text model is ready while the others are still loading.
+    """
+    if _grab_best_device() == "cpu" and (
+        text_use_gpu or coarse_use_gpu or fine_use_gpu or codec_use_gpu
+    ):
+        logger.warning("No GPU being used. Careful, inference might be very slow!")
+    loaders = {
+        "text": funcy.partial(
+            load_model, model_type="text", use_gpu=text_use_gpu, use_small=text_use_small
+        ),
+        "coarse": funcy.partial(
+            load_model, model_type="coarse", use_gpu=coarse_use_gpu, use_small=coarse_use_small
+        ),
+        "fine": funcy.partial(
+            load_model, model_type="fine", use_gpu=fine_use_gpu, use_small=fine_use_small
+        ),
+    }
+    loaders = {k: funcy.partial(f, use_int8=use_int8) for k, f in loaders.items()}
+    loaders["codec"] = funcy.partial(load_codec_model, use_gpu=codec_use_gpu)
+    return {
+        model_key: models.load_async(model_key, funcy.partial(loader, force_reload=force_reload))
+        for model_key, loader in loaders.items()
+    }
+
+
+def model_ready(model_key):
+    """Whether `model_key` is loaded, without blocking on an in-flight load."""
+    return models.ready(model_key)
+
+
+def wait_for_model(model_key, timeout=None):
+    """Block until the async load of `model_key` finishes, re-raising any loading error."""
+    models.wait(model_key, timeout=timeout)
+    return models[model_key]
+
+
+def can_overlap_stages():
+    """
+    Whether consecutive stages may run concurrently. That keeps two models on the device at
+    once, so not while a device memory budget (or cpu offloading) is in effect.
+    """
+    return models.device_budget is None
+
+
 ####
 # Generation Functionality
 ####
@@ -342,6 +912,10 @@ def _tokenize(tokenizer, text):
     return tokenizer.encode(text, add_special_tokens=False)
 
 
+def _tokenize_batch(tokenizer, texts):
+    return tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+
+
 def _detokenize(tokenizer, enc_text):
     return tokenizer.decode(enc_text)
 
@@ -354,6 +928,25 @@ TEXT_ENCODING_OFFSET = 10_048
 SEMANTIC_PAD_TOKEN = 10_000
 TEXT_PAD_TOKEN = 129_595
 SEMANTIC_INFER_TOKEN = 129_599
+# the token nearly all long constant runs in the bundled speaker prompts are made of
+SEMANTIC_SILENCE_TOKENS = (87,)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_prompt_archive():
+    """The packed archive of the bundled prompts, building it in CACHE_DIR on first use."""
+    if not USE_PROMPT_ARCHIVE:
+        return None
+    prompts_dir = os.path.join(CUR_PATH, "assets", "prompts")
+    archive_dirs = [prompts_dir, os.path.join(CACHE_DIR, "prompts")]
+    archive = prompt_archive.open_archive(archive_dirs, prompts_dir)
+    if archive is None:
+        try:
+            prompt_archive.build_archive(prompts_dir, archive_dirs[-1])
+            archive = prompt_archive.open_archive(archive_dirs[-1:], prompts_dir)
+        except OSError as e:
+            logger.warning(f"could not build the prompt archive, reading .npz prompts: {e}")
+    return archive
 
 
 def _load_history_prompt(history_prompt_input):
@@ -364,9 +957,14 @@ def _load_history_prompt(history_prompt_input):
         history_prompt_input = os.path.join(*history_prompt_input.split("/"))
         if history_prompt_input not in ALLOWED_PROMPTS:
             raise ValueError("history prompt not found")
-        history_prompt = np.load(
-            os.path.join(CUR_PATH, "assets", "prompts", f"{history_prompt_input}.npz")
-        )
+        archive = _get_prompt_archive()
+        archive_name = history_prompt_input.replace(os.path.sep, "/")
+        if archive is not None and archive_name in archive:
+            history_prompt = archive[archive_name]
+        else:
+            history_prompt = np.load(
+                os.path.join(CUR_PATH, "assets", "prompts", f"{history_prompt_input}.npz")
+            )
     elif isinstance(history_prompt_input, dict):
         assert("semantic_prompt" in history_prompt_input)
         assert("coarse_prompt" in history_prompt_input)
@@ -377,25 +975,55 @@ def _load_history_prompt(history_prompt_input):
     return history_prompt
 
 
-def generate_text_semantic(
-    text,
-    history_prompt=None,
-    temp=0.7,
-    top_k=None,
-    top_p=None,
-    silent=False,
-    min_eos_p=0.2,
-    max_gen_duration_s=None,
-    allow_early_stop=True,
-    use_kv_caching=False,
-):
-    """Generate semantic tokens from text."""
-    assert isinstance(text, str)
-    text = _normalize_whitespace(text)
-    assert len(text.strip()) > 0
-    if history_prompt is not None:
-        history_prompt = _load_history_prompt(history_prompt)
-        semantic_history = history_prompt["semantic_prompt"]
+def _readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+class HistoryPrompt:
+    """
+    A speaker prompt loaded once, with the history each stage derives from it computed (and
+    validated) on first use and kept, so repeated generations with the same speaker skip it.
+    """
+
+    def __init__(self, history_prompt):
+        self.semantic_prompt = np.asarray(history_prompt["semantic_prompt"])
+        self.coarse_prompt = np.asarray(history_prompt["coarse_prompt"])
+        self.fine_prompt = np.asarray(history_prompt["fine_prompt"])
+        self._histories = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key, fn, *args):
+        with self._lock:
+            if key not in self._histories:
+                self._histories[key] = fn(*args)
+            return self._histories[key]
+
+    def semantic_history(self):
+        """Last 256 semantic tokens, padded, as fed to the text model."""
+        return self._cached("semantic", self._semantic_history)
+
+    def coarse_history(self, max_semantic_history, semantic_to_coarse_ratio):
+        """Time-aligned (semantic, flattened coarse) histories for the coarse model."""
+        return self._cached(
+            ("coarse", max_semantic_history, semantic_to_coarse_ratio),
+            self._coarse_history,
+            max_semantic_history,
+            semantic_to_coarse_ratio,
+        )
+
+    def fine_history(self):
+        """Last 512 frames of fine codes."""
+        return self._cached("fine", self._fine_history)
+
+    def digest(self):
+        """Content hash of the prompt, the same for a speaker name, its .npz or its arrays."""
+        return self._cached(
+            "digest", digest_arrays, self.semantic_prompt, self.coarse_prompt, self.fine_prompt
+        )
+
+    def _semantic_history(self):
+        semantic_history = self.semantic_prompt
         assert (
             isinstance(semantic_history, np.ndarray)
             and len(semantic_history.shape) == 1
@@ -403,31 +1031,6 @@ def generate_text_semantic(
             and semantic_history.min() >= 0
             and semantic_history.max() <= SEMANTIC_VOCAB_SIZE - 1
         )
-    else:
-        semantic_history = None
-    # load models if not yet exist
-    global models
-    global models_devices
-    if "text" not in models:
-        preload_models()
-    model_container = models["text"]
-    model = model_container["model"]
-    tokenizer = model_container["tokenizer"]
-    encoded_text = np.array(_tokenize(tokenizer, text)) + TEXT_ENCODING_OFFSET
-    if OFFLOAD_CPU:
-        model.to(models_devices["text"])
-    device = next(model.parameters()).device
-    if len(encoded_text) > 256:
-        p = round((len(encoded_text) - 256) / len(encoded_text) * 100, 1)
-        logger.warning(f"warning, text too long, lopping of last {p}%")
-        encoded_text = encoded_text[:256]
-    encoded_text = np.pad(
-        encoded_text,
-        (0, 256 - len(encoded_text)),
-        constant_values=TEXT_PAD_TOKEN,
-        mode="constant",
-    )
-    if semantic_history is not None:
         semantic_history = semantic_history.astype(np.int64)
         # lop off if history is too long, pad if needed
         semantic_history = semantic_history[-256:]
@@ -437,127 +1040,11 @@ def generate_text_semantic(
             constant_values=SEMANTIC_PAD_TOKEN,
             mode="constant",
         )
-    else:
-        semantic_history = np.array([SEMANTIC_PAD_TOKEN] * 256)
-    x = torch.from_numpy(
-        np.hstack([
-            encoded_text, semantic_history, np.array([SEMANTIC_INFER_TOKEN])
-        ]).astype(np.int64)
-    )[None]
-    assert x.shape[1] == 256 + 256 + 1
-    with _inference_mode():
-        x = x.to(device)
-        n_tot_steps = 768
-        # custom tqdm updates since we don't know when eos will occur
-        pbar = tqdm.tqdm(disable=silent, total=n_tot_steps)
-        pbar_state = 0
-        tot_generated_duration_s = 0
-        kv_cache = None
-        for n in range(n_tot_steps):
-            if use_kv_caching and kv_cache is not None:
-                x_input = x[:, [-1]]
-            else:
-                x_input = x
-            logits, kv_cache = model(
-                x_input, merge_context=True, use_cache=use_kv_caching, past_kv=kv_cache
-            )
-            relevant_logits = logits[0, 0, :SEMANTIC_VOCAB_SIZE]
-            if allow_early_stop:
-                relevant_logits = torch.hstack(
-                    (relevant_logits, logits[0, 0, [SEMANTIC_PAD_TOKEN]])  # eos
-                )
-            if top_p is not None:
-                # faster to convert to numpy
-                original_device = relevant_logits.device
-                relevant_logits = relevant_logits.detach().cpu().type(torch.float32).numpy()
-                sorted_indices = np.argsort(relevant_logits)[::-1]
-                sorted_logits = relevant_logits[sorted_indices]
-                cumulative_probs = np.cumsum(softmax(sorted_logits))
-                sorted_indices_to_remove = cumulative_probs > top_p
-                sorted_indices_to_remove[1:] = sorted_indices_to_remove[:-1].copy()
-                sorted_indices_to_remove[0] = False
-                relevant_logits[sorted_indices[sorted_indices_to_remove]] = -np.inf
-                relevant_logits = torch.from_numpy(relevant_logits)
-                relevant_logits = relevant_logits.to(original_device)
-            if top_k is not None:
-                v, _ = torch.topk(relevant_logits, min(top_k, relevant_logits.size(-1)))
-                relevant_logits[relevant_logits < v[-1]] = -float("Inf")
-            probs = F.softmax(relevant_logits / temp, dim=-1)
-            item_next = torch.multinomial(probs, num_samples=1).to(torch.int32)
-            if allow_early_stop and (
-                item_next == SEMANTIC_VOCAB_SIZE
-                or (min_eos_p is not None and probs[-1] >= min_eos_p)
-            ):
-                # eos found, so break
-                pbar.update(n - pbar_state)
-                break
-            x = torch.cat((x, item_next[None]), dim=1)
-            tot_generated_duration_s += 1 / SEMANTIC_RATE_HZ
-            if max_gen_duration_s is not None and tot_generated_duration_s > max_gen_duration_s:
-                pbar.update(n - pbar_state)
-                break
-            if n == n_tot_steps - 1:
-                pbar.update(n - pbar_state)
-                break
-            del logits, relevant_logits, probs, item_next
-
-            if n > pbar_state:
-                if n > pbar.total:
-                    pbar.total = n
-                pbar.update(n - pbar_state)
-            pbar_state = n
-        pbar.total = n
-        pbar.refresh()
-        pbar.close()
-        out = x.detach().cpu().numpy().squeeze()[256 + 256 + 1 :]
-    if OFFLOAD_CPU:
-        model.to("cpu")
-    assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
-    _clear_cuda_cache()
-    return out
-
-
-def _flatten_codebooks(arr, offset_size=CODEBOOK_SIZE):
-    assert len(arr.shape) == 2
-    arr = arr.copy()
-    if offset_size is not None:
-        for n in range(1, arr.shape[0]):
-            arr[n, :] += offset_size * n
-    flat_arr = arr.ravel("F")
-    return flat_arr
-
-
-COARSE_SEMANTIC_PAD_TOKEN = 12_048
-COARSE_INFER_TOKEN = 12_050
-
+        return _readonly(semantic_history)
 
-def generate_coarse(
-    x_semantic,
-    history_prompt=None,
-    temp=0.7,
-    top_k=None,
-    top_p=None,
-    silent=False,
-    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
-    sliding_window_len=60,
-    use_kv_caching=False,
-):
-    """Generate coarse audio codes from semantic tokens."""
-    assert (
-        isinstance(x_semantic, np.ndarray)
-        and len(x_semantic.shape) == 1
-        and len(x_semantic) > 0
-        and x_semantic.min() >= 0
-        and x_semantic.max() <= SEMANTIC_VOCAB_SIZE - 1
-    )
-    assert 60 <= max_coarse_history <= 630
-    assert max_coarse_history + sliding_window_len <= 1024 - 256
-    semantic_to_coarse_ratio = COARSE_RATE_HZ / SEMANTIC_RATE_HZ * N_COARSE_CODEBOOKS
-    max_semantic_history = int(np.floor(max_coarse_history / semantic_to_coarse_ratio))
-    if history_prompt is not None:
-        history_prompt = _load_history_prompt(history_prompt)
-        x_semantic_history = history_prompt["semantic_prompt"]
-        x_coarse_history = history_prompt["coarse_prompt"]
+    def _coarse_history(self, max_semantic_history, semantic_to_coarse_ratio):
+        x_semantic_history = self.semantic_prompt
+        x_coarse_history = self.coarse_prompt
         assert (
             isinstance(x_semantic_history, np.ndarray)
             and len(x_semantic_history.shape) == 1
@@ -589,115 +1076,1223 @@ def generate_coarse(
         x_coarse_history = x_coarse_history[-n_coarse_hist_provided:].astype(np.int32)
         # TODO: bit of a hack for time alignment (sounds better)
         x_coarse_history = x_coarse_history[:-2]
-    else:
-        x_semantic_history = np.array([], dtype=np.int32)
-        x_coarse_history = np.array([], dtype=np.int32)
-    # load models if not yet exist
-    global models
-    global models_devices
-    if "coarse" not in models:
-        preload_models()
-    model = models["coarse"]
-    if OFFLOAD_CPU:
-        model.to(models_devices["coarse"])
-    device = next(model.parameters()).device
-    # start loop
-    n_steps = int(
-        round(
-            np.floor(len(x_semantic) * semantic_to_coarse_ratio / N_COARSE_CODEBOOKS)
-            * N_COARSE_CODEBOOKS
+        return _readonly(x_semantic_history), _readonly(x_coarse_history)
+
+    def _fine_history(self):
+        x_fine_history = self.fine_prompt
+        assert (
+            isinstance(x_fine_history, np.ndarray)
+            and len(x_fine_history.shape) == 2
+            and x_fine_history.shape[0] == N_FINE_CODEBOOKS
+            and x_fine_history.shape[1] >= 0
+            and x_fine_history.min() >= 0
+            and x_fine_history.max() <= CODEBOOK_SIZE - 1
         )
+        return _readonly(x_fine_history[:, -512:].astype(np.int32))
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _load_cached_history_prompt(history_prompt_input, mtime_ns=None):
+    # mtime_ns is only part of the cache key, so an edited .npz file gets reloaded
+    history_prompt = _load_history_prompt(history_prompt_input)
+    try:
+        return HistoryPrompt(history_prompt)
+    finally:
+        if isinstance(history_prompt, np.lib.npyio.NpzFile):
+            history_prompt.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_generation_cache():
+    """The disk cache of generation artifacts under CACHE_DIR, see `bark.cache`."""
+    return GenerationCache(os.path.join(CACHE_DIR, "generations"), GENERATION_CACHE_SIZE)
+
+
+def load_history_prompt(history_prompt):
+    """
+    Resolve a history prompt (speaker name, .npz path, dict or HistoryPrompt) to a HistoryPrompt.
+
+    Named and .npz prompts are kept in an LRU of `SUNO_PROMPT_CACHE_SIZE` speakers. Passing the
+    returned object to the generate functions shares the preprocessing between stages.
+    """
+    if history_prompt is None or isinstance(history_prompt, HistoryPrompt):
+        return history_prompt
+    if isinstance(history_prompt, str) and history_prompt.endswith(".npz"):
+        path = os.path.abspath(history_prompt)
+        return _load_cached_history_prompt(path, os.stat(path).st_mtime_ns)
+    if isinstance(history_prompt, str):
+        return _load_cached_history_prompt(os.path.join(*history_prompt.split("/")))
+    return HistoryPrompt(_load_history_prompt(history_prompt))
+
+
+def _load_semantic_history(history_prompt):
+    if history_prompt is None:
+        return None
+    return load_history_prompt(history_prompt).semantic_history()
+
+
+def _pad_encoded_text(ids):
+    """The text tokens padded or cut to 256, and the fraction of tokens cut off."""
+    encoded_text = np.array(ids, dtype=np.int64) + TEXT_ENCODING_OFFSET
+    p_dropped = max(len(encoded_text) - 256, 0) / max(len(encoded_text), 1)
+    encoded_text = encoded_text[:256]
+    encoded_text = np.pad(
+        encoded_text,
+        (0, 256 - len(encoded_text)),
+        constant_values=TEXT_PAD_TOKEN,
+        mode="constant",
     )
-    assert n_steps > 0 and n_steps % N_COARSE_CODEBOOKS == 0
-    x_semantic = np.hstack([x_semantic_history, x_semantic]).astype(np.int32)
-    x_coarse = x_coarse_history.astype(np.int32)
-    base_semantic_idx = len(x_semantic_history)
-    with _inference_mode():
-        x_semantic_in = torch.from_numpy(x_semantic)[None].to(device)
-        x_coarse_in = torch.from_numpy(x_coarse)[None].to(device)
-        n_window_steps = int(np.ceil(n_steps / sliding_window_len))
-        n_step = 0
-        for _ in tqdm.tqdm(range(n_window_steps), total=n_window_steps, disable=silent):
-            semantic_idx = base_semantic_idx + int(round(n_step / semantic_to_coarse_ratio))
-            # pad from right side
-            x_in = x_semantic_in[:, np.max([0, semantic_idx - max_semantic_history]) :]
-            x_in = x_in[:, :256]
-            x_in = F.pad(
-                x_in,
-                (0, 256 - x_in.shape[-1]),
-                "constant",
-                COARSE_SEMANTIC_PAD_TOKEN,
-            )
-            x_in = torch.hstack(
-                [
-                    x_in,
-                    torch.tensor([COARSE_INFER_TOKEN])[None].to(device),
-                    x_coarse_in[:, -max_coarse_history:],
-                ]
-            )
-            kv_cache = None
-            for _ in range(sliding_window_len):
-                if n_step >= n_steps:
-                    continue
-                is_major_step = n_step % N_COARSE_CODEBOOKS == 0
-
-                if use_kv_caching and kv_cache is not None:
-                    x_input = x_in[:, [-1]]
+    # shared between requests through the cache
+    encoded_text.flags.writeable = False
+    return encoded_text, p_dropped
+
+
+class TextEncodingCache:
+    """
+    LRU of normalized text -> padded text tokens, so repeated texts skip the tokenizer.
+
+    Misses of a batch are tokenized in one call. Entries belong to one tokenizer, the cache
+    starts over when a different one is passed (e.g. after the text model is reloaded).
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._tokenizer = None
+        # text -> (padded tokens, fraction of tokens dropped)
+        self._entries = OrderedDict()
+
+    def encode(self, tokenizer, texts):
+        """Padded 256 token array of every (normalized) text in `texts`."""
+        out = [None] * len(texts)
+        misses = {}
+        with self._lock:
+            if tokenizer is not self._tokenizer:
+                self._tokenizer = tokenizer
+                self._entries.clear()
+            for i, text in enumerate(texts):
+                entry = self._entries.get(text)
+                if entry is None:
+                    misses.setdefault(text, []).append(i)
                 else:
-                    x_input = x_in
+                    self._entries.move_to_end(text)
+                    out[i] = entry
+        if misses:
+            entries = [_pad_encoded_text(ids) for ids in _tokenize_batch(tokenizer, misses)]
+            with self._lock:
+                for (text, idxs), entry in zip(misses.items(), entries):
+                    for i in idxs:
+                        out[i] = entry
+                    if tokenizer is self._tokenizer and self.max_size > 0:
+                        self._entries[text] = entry
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        for _, p_dropped in out:
+            if p_dropped > 0:
+                p = round(p_dropped * 100, 1)
+                logger.warning(f"warning, text too long, lopping of last {p}%")
+        return [encoded_text for encoded_text, _ in out]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+text_encodings = TextEncodingCache(TEXT_CACHE_SIZE)
+
+
+def _prepare_semantic_input(tokenizer, text, semantic_history=None):
+    return _prepare_semantic_inputs(tokenizer, [text], [semantic_history])[0]
+
+
+def _prepare_semantic_inputs(tokenizer, texts, semantic_histories):
+    texts = [_normalize_whitespace(text) for text in texts]
+    assert all(len(text) > 0 for text in texts)
+    return [
+        _join_semantic_input(encoded_text, semantic_history)
+        for encoded_text, semantic_history in zip(
+            text_encodings.encode(tokenizer, texts), semantic_histories
+        )
+    ]
+
+
+def _join_semantic_input(encoded_text, semantic_history=None):
+    if semantic_history is None:
+        semantic_history = np.array([SEMANTIC_PAD_TOKEN] * 256)
+    assert len(semantic_history) == 256
+    return np.hstack([
+        encoded_text, semantic_history, np.array([SEMANTIC_INFER_TOKEN])
+    ]).astype(np.int64)
+
+
+def _init_kv_cache(model, use_kv_caching, use_static_kv_cache, batch_size=1):
+    if not (use_kv_caching and use_static_kv_cache):
+        return None
+    kv_cache = StaticKVCache(model.config, batch_size=batch_size)
+    logger.debug(
+        f"static kv cache: {kv_cache.max_len} positions, "
+        f"{round(kv_cache.nbytes(next(model.parameters()).dtype) / 2**20, 1)}MiB"
+    )
+    return kv_cache
+
+
+def _has_kv(kv_cache):
+    if isinstance(kv_cache, StaticKVCache):
+        return kv_cache.length > 0
+    return kv_cache is not None
+
+
+def _n_semantic_logits(allow_early_stop):
+    # the eos logit is the semantic pad token, right after the semantic vocab
+    assert SEMANTIC_PAD_TOKEN == SEMANTIC_VOCAB_SIZE
+    return SEMANTIC_VOCAB_SIZE + 1 if allow_early_stop else SEMANTIC_VOCAB_SIZE
+
+
+def generate_text_semantic(
+    text,
+    history_prompt=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    min_eos_p=0.2,
+    max_gen_duration_s=None,
+    allow_early_stop=True,
+    use_kv_caching=False,
+    use_static_kv_cache=False,
+    seed=None,
+    speculative_k=None,
+):
+    """Generate semantic tokens from text.
+
+    With `speculative_k`, the small text model drafts that many tokens at a time for the large
+    one to verify (see `_generate_text_semantic_speculative`); this implies kv caching.
+    """
+    if speculative_k is None:
+        chunks = generate_text_semantic_stream(
+            text,
+            history_prompt=history_prompt,
+            temp=temp,
+            top_k=top_k,
+            top_p=top_p,
+            silent=silent,
+            min_eos_p=min_eos_p,
+            max_gen_duration_s=max_gen_duration_s,
+            allow_early_stop=allow_early_stop,
+            use_kv_caching=use_kv_caching,
+            use_static_kv_cache=use_static_kv_cache,
+            seed=seed,
+        )
+        return np.concatenate([np.zeros(0, dtype=np.int64), *chunks])
+    assert isinstance(text, str)
+    assert speculative_k >= 1
+    semantic_history = _load_semantic_history(history_prompt)
+    # load models if not yet exist
+    global models
+    global models_devices
+    model_container = models.acquire("text")
+    try:
+        models.prefetch("coarse")
+        model = model_container["model"]
+        tokenizer = model_container["tokenizer"]
+        x = torch.from_numpy(_prepare_semantic_input(tokenizer, text, semantic_history))[None]
+        assert x.shape[1] == 256 + 256 + 1
+        out = _generate_text_semantic_speculative(
+            x,
+            speculative_k,
+            temp=temp,
+            top_k=top_k,
+            top_p=top_p,
+            silent=silent,
+            min_eos_p=min_eos_p,
+            max_gen_duration_s=max_gen_duration_s,
+            allow_early_stop=allow_early_stop,
+            use_static_kv_cache=use_static_kv_cache,
+            seed=seed,
+        )
+    finally:
+        models.release("text")
+    assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
+    _clear_cuda_cache()
+    return out
+
+
+def generate_text_semantic_stream(
+    text,
+    history_prompt=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    min_eos_p=0.2,
+    max_gen_duration_s=None,
+    allow_early_stop=True,
+    use_kv_caching=False,
+    use_static_kv_cache=False,
+    seed=None,
+    chunk_len=16,
+):
+    """
+    Generate semantic tokens from text, yielding them `chunk_len` at a time as they are
+    sampled. The chunks add up to the output of `generate_text_semantic`.
+    """
+    assert isinstance(text, str) and chunk_len >= 1
+    semantic_history = _load_semantic_history(history_prompt)
+    # load models if not yet exist
+    global models
+    global models_devices
+    model_container = models.acquire("text")
+    try:
+        models.prefetch("coarse")
+        model = model_container["model"]
+        tokenizer = model_container["tokenizer"]
+        device = next(model.parameters()).device
+        x = torch.from_numpy(_prepare_semantic_input(tokenizer, text, semantic_history))[None]
+        assert x.shape[1] == 256 + 256 + 1
+        with _inference_mode():
+            n_tot_steps = 768
+            # token buffer for the whole generation, filled up to x_len
+            x_buf = torch.empty(
+                (1, 256 + 256 + 1 + n_tot_steps), dtype=torch.int64, device=device
+            )
+            x_buf[:, : x.shape[1]] = x.to(device)
+            x_len = x.shape[1]
+            kv_cache = _init_kv_cache(model, use_kv_caching, use_static_kv_cache)
+            n_relevant_logits = _n_semantic_logits(allow_early_stop)
+            generators = sampling.make_generators(None if seed is None else [seed], device)
+        # custom tqdm updates since we don't know when eos will occur
+        pbar = tqdm.tqdm(disable=silent, total=n_tot_steps)
+        pbar_state = 0
+        tot_generated_duration_s = 0
+        n_yielded = x_len
+        n_start = 0
+        done = False
+        while not done:
+            # re-entered per chunk so inference mode doesn't leak into the caller between yields
+            with _inference_mode():
+                for n in range(n_start, min(n_start + chunk_len, n_tot_steps)):
+                    if use_kv_caching and _has_kv(kv_cache):
+                        x_input = x_buf[:, x_len - 1 : x_len]
+                    else:
+                        x_input = x_buf[:, :x_len]
+                    logits, kv_cache = model(
+                        x_input,
+                        merge_context=True,
+                        use_cache=use_kv_caching,
+                        past_kv=kv_cache,
+                        logits_range=(0, n_relevant_logits),
+                    )
+                    relevant_logits = logits[:, 0]
+                    item_next, probs = sampling.sample(
+                        relevant_logits, temp=temp, top_k=top_k, top_p=top_p, generators=generators
+                    )
+                    if allow_early_stop and sampling.eos_reached(
+                        item_next, probs, SEMANTIC_VOCAB_SIZE, min_eos_p
+                    ).item():
+                        # eos found, so break
+                        pbar.update(n - pbar_state)
+                        done = True
+                        break
+                    x_buf[:, x_len] = item_next
+                    x_len += 1
+                    tot_generated_duration_s += 1 / SEMANTIC_RATE_HZ
+                    if (
+                        max_gen_duration_s is not None
+                        and tot_generated_duration_s > max_gen_duration_s
+                    ):
+                        pbar.update(n - pbar_state)
+                        done = True
+                        break
+                    if n == n_tot_steps - 1:
+                        pbar.update(n - pbar_state)
+                        done = True
+                        break
+                    del logits, relevant_logits, probs, item_next
+
+                    if n > pbar_state:
+                        if n > pbar.total:
+                            pbar.total = n
+                        pbar.update(n - pbar_state)
+                    pbar_state = n
+                n_start = n + 1
+                out = x_buf[0, n_yielded:x_len].detach().cpu().numpy()
+            n_yielded = x_len
+            assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
+            if len(out) > 0:
+                yield out
+        pbar.total = n
+        pbar.refresh()
+        pbar.close()
+    finally:
+        models.release("text")
+        _clear_cuda_cache()
+
+
+def _is_silent_window(x_window, max_distinct, silence_tokens):
+    # semantic tokens barely change over silence (or a held noise), while speech cycles
+    # through many of them
+    if len(np.unique(x_window)) <= max_distinct:
+        return True
+    return np.isin(x_window, silence_tokens).mean() >= 0.5
+
+
+def _trailing_silence_idx(x_semantic, window_len, max_distinct, silence_tokens):
+    """Where the run of silent windows at the end of `x_semantic` starts, or its length."""
+    end_idx = len(x_semantic)
+    while end_idx >= window_len and _is_silent_window(
+        x_semantic[end_idx - window_len : end_idx], max_distinct, silence_tokens
+    ):
+        end_idx -= 1
+    if end_idx == len(x_semantic):
+        return len(x_semantic)
+    # the first silent window may still begin with the end of speech
+    return end_idx + 1 - window_len // 2
+
+
+def trim_semantic_silence(
+    x_semantic,
+    min_silence_s=0.75,
+    keep_s=0.25,
+    window_s=0.5,
+    max_distinct=3,
+    silence_tokens=SEMANTIC_SILENCE_TOKENS,
+):
+    """
+    Drop trailing silence from semantic tokens, so the acoustic stages don't render audio that
+    only gets cut off afterwards.
+
+    A window of `window_s` counts as silent when it has at most `max_distinct` distinct tokens,
+    or is mostly made of `silence_tokens`. A trailing run of silent windows is only trimmed
+    when it is at least `min_silence_s` long, and `keep_s` of it is left so the clip doesn't
+    end abruptly.
+    """
+    window_len = max(1, int(round(window_s * SEMANTIC_RATE_HZ)))
+    start_idx = _trailing_silence_idx(x_semantic, window_len, max_distinct, silence_tokens)
+    if len(x_semantic) - start_idx < min_silence_s * SEMANTIC_RATE_HZ:
+        return x_semantic
+    n_keep = max(1, start_idx + int(round(keep_s * SEMANTIC_RATE_HZ)))
+    return x_semantic[:n_keep]
+
+
+def trim_semantic_silence_stream(
+    x_semantic_chunks,
+    min_silence_s=0.75,
+    keep_s=0.25,
+    window_s=0.5,
+    max_distinct=3,
+    silence_tokens=SEMANTIC_SILENCE_TOKENS,
+):
+    """
+    `trim_semantic_silence` over chunks of semantic tokens as they are generated.
+
+    Tokens that could still turn out to belong to trailing silence are held back until more
+    tokens (or the end) arrive, so the chunks add up to the trimmed array.
+    """
+    window_len = max(1, int(round(window_s * SEMANTIC_RATE_HZ)))
+    x_semantic = np.zeros(0, dtype=np.int64)
+    n_yielded = 0
+    for x_semantic_chunk in x_semantic_chunks:
+        x_semantic = np.hstack([x_semantic, x_semantic_chunk])
+        # the final trailing run starts where the current one does, or after the last
+        # complete window if speech resumes
+        start_idx = _trailing_silence_idx(x_semantic, window_len, max_distinct, silence_tokens)
+        n_safe = min(start_idx, len(x_semantic) - window_len)
+        if n_safe > n_yielded:
+            yield x_semantic[n_yielded:n_safe]
+            n_yielded = n_safe
+    x_semantic = trim_semantic_silence(
+        x_semantic,
+        min_silence_s=min_silence_s,
+        keep_s=keep_s,
+        window_s=window_s,
+        max_distinct=max_distinct,
+        silence_tokens=silence_tokens,
+    )
+    if len(x_semantic) > n_yielded:
+        yield x_semantic[n_yielded:]
+
+
+def _kv_length(kv_cache):
+    if kv_cache is None:
+        return 0
+    if isinstance(kv_cache, StaticKVCache):
+        return kv_cache.length
+    return kv_cache[0][0].size(-2)
+
+
+def _truncate_kv(kv_cache, length):
+    if kv_cache is None or _kv_length(kv_cache) <= length:
+        return kv_cache
+    if isinstance(kv_cache, StaticKVCache):
+        kv_cache.truncate(length)
+        return kv_cache
+    return tuple(
+        (past_key[:, :, :length], past_value[:, :, :length])
+        for past_key, past_value in kv_cache
+    )
+
+
+def _forward_semantic(model, x_buf, x_len, kv_cache, n_relevant_logits, use_static, n_logits=1):
+    """Feed every token of x_buf[:, :x_len] the cache hasn't seen yet."""
+    # the merged text + history context takes 256 tokens of the buffer but no cache positions
+    n_cached = _kv_length(kv_cache)
+    if n_cached == 0:
+        x_input = x_buf[:, :x_len]
+        kv_cache = StaticKVCache(model.config) if use_static else None
+    else:
+        x_input = x_buf[:, n_cached + 256 : x_len]
+    return model(
+        x_input,
+        merge_context=n_cached == 0,
+        use_cache=True,
+        past_kv=kv_cache,
+        logits_range=(0, n_relevant_logits),
+        n_logits=n_logits,
+    )
+
+
+def load_draft_model(use_gpu=True, force_reload=False):
+    """Load the small text model next to the large one, as a draft for speculative decoding."""
+    return load_model(
+        use_gpu=use_gpu,
+        use_small=True,
+        force_reload=force_reload,
+        model_type="text",
+        model_key="text_small",
+    )
+
 
-                logits, kv_cache = model(x_input, use_cache=use_kv_caching, past_kv=kv_cache)
-                logit_start_idx = (
-                    SEMANTIC_VOCAB_SIZE + (1 - int(is_major_step)) * CODEBOOK_SIZE
+def _generate_text_semantic_speculative(
+    x,
+    speculative_k,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    min_eos_p=0.2,
+    max_gen_duration_s=None,
+    allow_early_stop=True,
+    use_static_kv_cache=False,
+    seed=None,
+):
+    """
+    Speculative sampling: the small text model drafts `speculative_k` tokens, the large one
+    scores all of them in a single cached forward pass, and rejection sampling keeps the
+    output distributed exactly as if the large model had sampled every token itself.
+    """
+    global models
+    global models_devices
+    model = models.acquire("text")["model"]
+    try:
+        draft_model = models.acquire("text_small")["model"]
+    except BaseException:
+        models.release("text")
+        raise
+    try:
+        device = next(model.parameters()).device
+        assert next(draft_model.parameters()).device == device
+        n_tot_steps = 768
+        n_relevant_logits = _n_semantic_logits(allow_early_stop)
+        with _inference_mode():
+            x_buf = torch.empty((1, 256 + 256 + 1 + n_tot_steps), dtype=torch.int64, device=device)
+            x_buf[:, : x.shape[1]] = x.to(device)
+            x_len = x.shape[1]
+            generators = sampling.make_generators(None if seed is None else [seed], device)
+            pbar = tqdm.tqdm(disable=silent, total=n_tot_steps)
+            kv_cache = None
+            draft_kv_cache = None
+            n_drafted = 0
+            n_accepted = 0
+            n_generated = 0
+            tot_generated_duration_s = 0
+            is_done = False
+            while not is_done:
+                # never draft past the step budget (which also keeps both models within block_size)
+                k = min(speculative_k, n_tot_steps - 1 - n_generated)
+                draft_probs = []
+                for i in range(k):
+                    logits, draft_kv_cache = _forward_semantic(
+                        draft_model, x_buf, x_len + i, draft_kv_cache, n_relevant_logits,
+                        use_static_kv_cache,
+                    )
+                    item_next, probs = sampling.sample(
+                        logits[:, 0], temp=temp, top_k=top_k, top_p=top_p, generators=generators
+                    )
+                    x_buf[:, x_len + i] = item_next
+                    draft_probs.append(probs)
+                # score the k drafted tokens plus one extra position in one pass
+                logits, kv_cache = _forward_semantic(
+                    model, x_buf, x_len + k, kv_cache, n_relevant_logits, use_static_kv_cache,
+                    n_logits=k + 1,
                 )
-                logit_end_idx = (
-                    SEMANTIC_VOCAB_SIZE + (2 - int(is_major_step)) * CODEBOOK_SIZE
+                target_probs = sampling.filtered_probs(logits, temp=temp, top_k=top_k, top_p=top_p)
+                n_drafted += k
+                n_new = 0
+                for i in range(k + 1):
+                    probs = target_probs[:, i]
+                    if allow_early_stop and min_eos_p is not None and probs[0, -1] >= min_eos_p:
+                        is_done = True
+                        break
+                    if i < k:
+                        item_next, accepted = sampling.speculative_accept(
+                            x_buf[:, x_len + i], probs, draft_probs[i], generators=generators
+                        )
+                        accepted = bool(accepted.item())
+                    else:
+                        # every draft was accepted, so the extra position gives one more token
+                        item_next = sampling.multinomial(probs, generators)
+                        accepted = False
+                    if allow_early_stop and item_next.item() == SEMANTIC_VOCAB_SIZE:
+                        # eos found, so break
+                        is_done = True
+                        break
+                    x_buf[:, x_len + i] = item_next
+                    n_new += 1
+                    n_accepted += int(accepted)
+                    tot_generated_duration_s += 1 / SEMANTIC_RATE_HZ
+                    if (
+                        (
+                            max_gen_duration_s is not None
+                            and tot_generated_duration_s > max_gen_duration_s
+                        )
+                        or n_generated + n_new == n_tot_steps
+                    ):
+                        is_done = True
+                        break
+                    if not accepted:
+                        break
+                x_len += n_new
+                n_generated += n_new
+                pbar.update(n_new)
+                # drop cache entries of rejected drafts; the last token stays pending for both
+                # models
+                kv_cache = _truncate_kv(kv_cache, x_len - 1 - 256)
+                draft_kv_cache = _truncate_kv(draft_kv_cache, x_len - 1 - 256)
+                del logits, target_probs, draft_probs
+            pbar.close()
+            if n_drafted > 0:
+                logger.debug(
+                    f"speculative decoding accepted {n_accepted}/{n_drafted} drafted tokens"
                 )
-                relevant_logits = logits[0, 0, logit_start_idx:logit_end_idx]
-                if top_p is not None:
-                    # faster to convert to numpy
-                    original_device = relevant_logits.device
-                    relevant_logits = relevant_logits.detach().cpu().type(torch.float32).numpy()
-                    sorted_indices = np.argsort(relevant_logits)[::-1]
-                    sorted_logits = relevant_logits[sorted_indices]
-                    cumulative_probs = np.cumsum(softmax(sorted_logits))
-                    sorted_indices_to_remove = cumulative_probs > top_p
-                    sorted_indices_to_remove[1:] = sorted_indices_to_remove[:-1].copy()
-                    sorted_indices_to_remove[0] = False
-                    relevant_logits[sorted_indices[sorted_indices_to_remove]] = -np.inf
-                    relevant_logits = torch.from_numpy(relevant_logits)
-                    relevant_logits = relevant_logits.to(original_device)
-                if top_k is not None:
-                    v, _ = torch.topk(relevant_logits, min(top_k, relevant_logits.size(-1)))
-                    relevant_logits[relevant_logits < v[-1]] = -float("Inf")
-                probs = F.softmax(relevant_logits / temp, dim=-1)
-                item_next = torch.multinomial(probs, num_samples=1).to(torch.int32)
-                item_next += logit_start_idx
-                x_coarse_in = torch.cat((x_coarse_in, item_next[None]), dim=1)
-                x_in = torch.cat((x_in, item_next[None]), dim=1)
+            out = x_buf[0, 256 + 256 + 1 : x_len].detach().cpu().numpy()
+    finally:
+        models.release("text")
+        models.release("text_small")
+    return out
+
+
+def _select_kv_rows(kv_cache, rows):
+    if kv_cache is None:
+        return None
+    if isinstance(kv_cache, StaticKVCache):
+        return kv_cache.select_rows(rows)
+    return tuple(
+        (past_key.index_select(0, rows), past_value.index_select(0, rows))
+        for past_key, past_value in kv_cache
+    )
+
+
+def generate_text_semantic_batch(
+    texts,
+    history_prompts=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    min_eos_p=0.2,
+    max_gen_duration_s=None,
+    allow_early_stop=True,
+    use_kv_caching=False,
+    use_static_kv_cache=False,
+    seeds=None,
+):
+    """Generate semantic tokens for a batch of texts, one array per text."""
+    assert isinstance(texts, (list, tuple)) and len(texts) > 0
+    assert all(isinstance(text, str) for text in texts)
+    n_rows = len(texts)
+    if history_prompts is None:
+        history_prompts = [None] * n_rows
+    assert len(history_prompts) == n_rows
+    if max_gen_duration_s is None or np.isscalar(max_gen_duration_s):
+        max_gen_duration_s = [max_gen_duration_s] * n_rows
+    assert len(max_gen_duration_s) == n_rows
+    semantic_histories = [_load_semantic_history(h) for h in history_prompts]
+    # load models if not yet exist
+    global models
+    global models_devices
+    model_container = models.acquire("text")
+    try:
+        models.prefetch("coarse")
+        model = model_container["model"]
+        tokenizer = model_container["tokenizer"]
+        device = next(model.parameters()).device
+        # every row is exactly 256 text + 256 history + 1 infer token, so rows stay aligned
+        x = torch.from_numpy(
+            np.stack(_prepare_semantic_inputs(tokenizer, texts, semantic_histories))
+        )
+        assert x.shape == (n_rows, 256 + 256 + 1)
+        outs = [None] * n_rows
+        with _inference_mode():
+            # original row index of every row still in the active batch
+            active = torch.arange(n_rows, device=device)
+            n_tot_steps = 768
+            x_buf = torch.empty(
+                (n_rows, 256 + 256 + 1 + n_tot_steps), dtype=torch.int64, device=device
+            )
+            x_buf[:, : x.shape[1]] = x.to(device)
+            x_len = x.shape[1]
+            pbar = tqdm.tqdm(disable=silent, total=n_tot_steps)
+            kv_cache = _init_kv_cache(model, use_kv_caching, use_static_kv_cache, batch_size=n_rows)
+            n_relevant_logits = _n_semantic_logits(allow_early_stop)
+            generators = sampling.make_generators(seeds, device)
+            for n in range(n_tot_steps):
+                if use_kv_caching and _has_kv(kv_cache):
+                    x_input = x_buf[:, x_len - 1 : x_len]
+                else:
+                    x_input = x_buf[:, :x_len]
+                logits, kv_cache = model(
+                    x_input,
+                    merge_context=True,
+                    use_cache=use_kv_caching,
+                    past_kv=kv_cache,
+                    logits_range=(0, n_relevant_logits),
+                )
+                relevant_logits = logits[:, 0]
+                item_next, probs = sampling.sample(
+                    relevant_logits, temp=temp, top_k=top_k, top_p=top_p, generators=generators
+                )
+                if allow_early_stop:
+                    is_eos = sampling.eos_reached(item_next, probs, SEMANTIC_VOCAB_SIZE, min_eos_p)
+                else:
+                    is_eos = torch.zeros(len(active), dtype=torch.bool, device=device)
+                x_buf[:, x_len] = item_next
+                x_len += 1
+                tot_generated_duration_s = (n + 1) / SEMANTIC_RATE_HZ
+                is_done = is_eos.cpu().numpy()
+                for i, row in enumerate(active.tolist()):
+                    if is_done[i]:
+                        # eos is not part of the output
+                        outs[row] = x_buf[i, 256 + 256 + 1 : x_len - 1].detach().cpu().numpy()
+                    elif (
+                        max_gen_duration_s[row] is not None
+                        and tot_generated_duration_s > max_gen_duration_s[row]
+                    ) or n == n_tot_steps - 1:
+                        is_done[i] = True
+                        outs[row] = x_buf[i, 256 + 256 + 1 : x_len].detach().cpu().numpy()
                 del logits, relevant_logits, probs, item_next
-                n_step += 1
-            del x_in
-        del x_semantic_in
-    if OFFLOAD_CPU:
-        model.to("cpu")
-    gen_coarse_arr = x_coarse_in.detach().cpu().numpy().squeeze()[len(x_coarse_history) :]
-    del x_coarse_in
-    assert len(gen_coarse_arr) == n_steps
+                pbar.update(1)
+                if is_done.all():
+                    break
+                if is_done.any():
+                    # drop finished rows so the remaining steps only pay for live rows
+                    keep = torch.from_numpy(np.flatnonzero(~is_done)).to(device)
+                    x_buf = x_buf.index_select(0, keep)
+                    kv_cache = _select_kv_rows(kv_cache, keep)
+                    generators = sampling.select_generators(generators, keep)
+                    active = active.index_select(0, keep)
+            pbar.close()
+    finally:
+        models.release("text")
+    for out in outs:
+        assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
+    _clear_cuda_cache()
+    return outs
+
+
+def _flatten_codebooks(arr, offset_size=CODEBOOK_SIZE):
+    assert len(arr.shape) == 2
+    arr = arr.copy()
+    if offset_size is not None:
+        for n in range(1, arr.shape[0]):
+            arr[n, :] += offset_size * n
+    flat_arr = arr.ravel("F")
+    return flat_arr
+
+
+COARSE_SEMANTIC_PAD_TOKEN = 12_048
+COARSE_INFER_TOKEN = 12_050
+
+
+def _n_coarse_steps(n_semantic, semantic_to_coarse_ratio):
+    n_steps = int(
+        round(
+            np.floor(n_semantic * semantic_to_coarse_ratio / N_COARSE_CODEBOOKS)
+            * N_COARSE_CODEBOOKS
+        )
+    )
+    assert n_steps > 0 and n_steps % N_COARSE_CODEBOOKS == 0
+    return n_steps
+
+
+def _unflatten_coarse(gen_coarse_arr):
     gen_coarse_audio_arr = gen_coarse_arr.reshape(-1, N_COARSE_CODEBOOKS).T - SEMANTIC_VOCAB_SIZE
     for n in range(1, N_COARSE_CODEBOOKS):
         gen_coarse_audio_arr[n, :] -= n * CODEBOOK_SIZE
-    _clear_cuda_cache()
     return gen_coarse_audio_arr
 
 
-def generate_fine(
-    x_coarse_gen,
+def _load_coarse_history(history_prompt, max_semantic_history, semantic_to_coarse_ratio):
+    if history_prompt is None:
+        return np.array([], dtype=np.int32), np.array([], dtype=np.int32)
+    return load_history_prompt(history_prompt).coarse_history(
+        max_semantic_history, semantic_to_coarse_ratio
+    )
+
+
+def _n_semantic_for_coarse_steps(n_steps, semantic_to_coarse_ratio):
+    """The fewest semantic tokens `_n_coarse_steps` turns into at least `n_steps` steps."""
+    n_semantic = int(np.ceil(n_steps / semantic_to_coarse_ratio))
+    while (
+        np.floor(n_semantic * semantic_to_coarse_ratio / N_COARSE_CODEBOOKS) * N_COARSE_CODEBOOKS
+        < n_steps
+    ):
+        n_semantic += 1
+    return n_semantic
+
+
+def _iter_queue(q):
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        yield item
+
+
+class _SemanticBuffer:
+    """
+    Semantic tokens for the coarse stage, either a complete array or chunks arriving from a
+    producer (an iterable of 1d token arrays, or a queue of them ended by None) that is
+    drained on a background thread.
+    """
+
+    def __init__(self, x_semantic):
+        self._cond = threading.Condition()
+        self._error = None
+        self._closed = False
+        self._thread = None
+        if isinstance(x_semantic, np.ndarray):
+            self._chunks = [x_semantic]
+            self._n_semantic = len(x_semantic)
+            self.done = True
+            return
+        if isinstance(x_semantic, queue.Queue):
+            x_semantic = _iter_queue(x_semantic)
+        self._chunks = []
+        self._n_semantic = 0
+        self.done = False
+        self._thread = threading.Thread(
+            target=self._drain, args=(x_semantic,), name="bark-semantic-producer", daemon=True
+        )
+        self._thread.start()
+
+    def _drain(self, producer):
+        try:
+            for chunk in producer:
+                assert (
+                    isinstance(chunk, np.ndarray)
+                    and len(chunk.shape) == 1
+                    and (len(chunk) == 0 or chunk.min() >= 0)
+                    and (len(chunk) == 0 or chunk.max() <= SEMANTIC_VOCAB_SIZE - 1)
+                )
+                with self._cond:
+                    self._chunks.append(chunk)
+                    self._n_semantic += len(chunk)
+                    self._cond.notify_all()
+                if self._closed:
+                    break
+        except BaseException as e:
+            self._error = e
+        finally:
+            if hasattr(producer, "close"):
+                # a generator producer releases its model in its own finally block
+                producer.close()
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def wait(self, n_semantic):
+        """Block until `n_semantic` tokens arrived or the producer finished, return the count."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._n_semantic >= n_semantic or self.done)
+            if self._error is not None:
+                raise self._error
+            return self._n_semantic
+
+    def tokens(self):
+        with self._cond:
+            if len(self._chunks) > 1:
+                self._chunks = [np.concatenate(self._chunks)]
+            return self._chunks[0] if self._chunks else np.zeros(0, dtype=np.int64)
+
+    def close(self):
+        self._closed = True
+
+
+def generate_coarse(
+    x_semantic,
     history_prompt=None,
-    temp=0.5,
-    silent=True,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
+    sliding_window_len=60,
+    use_kv_caching=False,
+    use_static_kv_cache=False,
+    seed=None,
+):
+    """Generate coarse audio codes from semantic tokens."""
+    chunks = list(
+        generate_coarse_stream(
+            x_semantic,
+            history_prompt=history_prompt,
+            temp=temp,
+            top_k=top_k,
+            top_p=top_p,
+            silent=silent,
+            max_coarse_history=max_coarse_history,
+            sliding_window_len=sliding_window_len,
+            use_kv_caching=use_kv_caching,
+            use_static_kv_cache=use_static_kv_cache,
+            seed=seed,
+        )
+    )
+    return np.hstack(chunks)
+
+
+def generate_coarse_stream(
+    x_semantic,
+    history_prompt=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
+    sliding_window_len=60,
+    use_kv_caching=False,
+    use_static_kv_cache=False,
+    seed=None,
+):
+    """
+    Generate coarse audio codes from semantic tokens, yielding the (2, n) new codes of each
+    sliding window as soon as it completes.
+
+    `x_semantic` can also be a producer of semantic token chunks, such as
+    `generate_text_semantic_stream` or a queue of arrays ended by None. It is drained on a
+    background thread and each window starts as soon as the semantic tokens it reads have
+    arrived, so the two stages run concurrently. The output is the same as for the complete
+    array.
+    """
+    if isinstance(x_semantic, np.ndarray):
+        assert (
+            len(x_semantic.shape) == 1
+            and len(x_semantic) > 0
+            and x_semantic.min() >= 0
+            and x_semantic.max() <= SEMANTIC_VOCAB_SIZE - 1
+        )
+    assert 60 <= max_coarse_history <= 630
+    assert max_coarse_history + sliding_window_len <= 1024 - 256
+    semantic_to_coarse_ratio = COARSE_RATE_HZ / SEMANTIC_RATE_HZ * N_COARSE_CODEBOOKS
+    max_semantic_history = int(np.floor(max_coarse_history / semantic_to_coarse_ratio))
+    x_semantic_history, x_coarse_history = _load_coarse_history(
+        history_prompt, max_semantic_history, semantic_to_coarse_ratio
+    )
+    # load models if not yet exist
+    global models
+    global models_devices
+    semantic = _SemanticBuffer(x_semantic)
+    model = models.acquire("coarse")
+    try:
+        models.prefetch("fine")
+        device = next(model.parameters()).device
+        # start loop
+        x_coarse = x_coarse_history.astype(np.int32)
+        base_semantic_idx = len(x_semantic_history)
+        with _inference_mode():
+            # token buffers for all coarse codes (grown as semantic tokens arrive) and for one
+            # window's model input
+            x_coarse_buf = torch.empty(
+                (1, len(x_coarse) + sliding_window_len), dtype=torch.int32, device=device
+            )
+            x_coarse_buf[:, : len(x_coarse)] = torch.from_numpy(x_coarse).to(device)
+            x_coarse_len = len(x_coarse)
+            x_in_buf = torch.empty(
+                (1, 256 + 1 + max_coarse_history + sliding_window_len),
+                dtype=torch.int32,
+                device=device,
+            )
+            kv_cache = _init_kv_cache(model, use_kv_caching, use_static_kv_cache)
+            generators = sampling.make_generators(None if seed is None else [seed], device)
+        n_semantic_in = None
+        n_step = 0
+        n_yielded = 0
+        pbar = tqdm.tqdm(disable=silent)
+        while True:
+            semantic_idx = base_semantic_idx + int(round(n_step / semantic_to_coarse_ratio))
+            semantic_start_idx = max(0, semantic_idx - max_semantic_history)
+            # wait for the semantic tokens this window reads, and for enough of them to know
+            # none of its steps is past the end
+            n_semantic = semantic.wait(
+                max(
+                    semantic_start_idx + 256 - base_semantic_idx,
+                    _n_semantic_for_coarse_steps(
+                        n_step + sliding_window_len, semantic_to_coarse_ratio
+                    ),
+                )
+            )
+            n_steps = _n_coarse_steps(n_semantic, semantic_to_coarse_ratio)
+            if n_step >= n_steps:
+                break
+            if pbar.total is None and semantic.done:
+                pbar.total = int(np.ceil(n_steps / sliding_window_len))
+                pbar.refresh()
+            # re-entered per window so inference mode doesn't leak into the caller between yields
+            with _inference_mode():
+                if n_semantic != n_semantic_in:
+                    x_semantic_in = np.hstack([x_semantic_history, semantic.tokens()])
+                    x_semantic_in = torch.from_numpy(x_semantic_in.astype(np.int32))[None]
+                    x_semantic_in = x_semantic_in.to(device)
+                    n_semantic_in = n_semantic
+                if x_coarse_buf.shape[1] < x_coarse_len + sliding_window_len:
+                    x_coarse_buf = torch.cat([x_coarse_buf, torch.empty_like(x_coarse_buf)], dim=1)
+                # pad from right side
+                x_in = x_semantic_in[:, semantic_start_idx:]
+                x_in = x_in[:, :256]
+                x_in_buf[:, : x_in.shape[-1]] = x_in
+                x_in_buf[:, x_in.shape[-1] : 256] = COARSE_SEMANTIC_PAD_TOKEN
+                x_in_buf[:, 256] = COARSE_INFER_TOKEN
+                x_coarse_ctx = x_coarse_buf[
+                    :, max(0, x_coarse_len - max_coarse_history) : x_coarse_len
+                ]
+                x_in_len = 256 + 1 + x_coarse_ctx.shape[-1]
+                x_in_buf[:, 256 + 1 : x_in_len] = x_coarse_ctx
+                if isinstance(kv_cache, StaticKVCache):
+                    kv_cache.truncate(0)
+                else:
+                    kv_cache = None
+                for _ in range(sliding_window_len):
+                    if n_step >= n_steps:
+                        continue
+                    is_major_step = n_step % N_COARSE_CODEBOOKS == 0
+
+                    if use_kv_caching and _has_kv(kv_cache):
+                        x_input = x_in_buf[:, x_in_len - 1 : x_in_len]
+                    else:
+                        x_input = x_in_buf[:, :x_in_len]
+
+                    logit_start_idx = (
+                        SEMANTIC_VOCAB_SIZE + (1 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    logit_end_idx = (
+                        SEMANTIC_VOCAB_SIZE + (2 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    logits, kv_cache = model(
+                        x_input,
+                        use_cache=use_kv_caching,
+                        past_kv=kv_cache,
+                        logits_range=(logit_start_idx, logit_end_idx),
+                    )
+                    relevant_logits = logits[:, 0]
+                    item_next, probs = sampling.sample(
+                        relevant_logits, temp=temp, top_k=top_k, top_p=top_p, generators=generators
+                    )
+                    item_next = item_next.to(torch.int32) + logit_start_idx
+                    x_coarse_buf[:, x_coarse_len] = item_next
+                    x_coarse_len += 1
+                    x_in_buf[:, x_in_len] = item_next
+                    x_in_len += 1
+                    del logits, relevant_logits, probs, item_next
+                    n_step += 1
+                del x_in
+                # only hand out whole frames, an odd window length ends between codebooks
+                n_ready = n_step - n_step % N_COARSE_CODEBOOKS
+                offset = len(x_coarse_history)
+                gen_coarse_arr = (
+                    x_coarse_buf[0, offset + n_yielded : offset + n_ready].detach().cpu().numpy()
+                )
+            pbar.update(1)
+            if len(gen_coarse_arr) > 0:
+                n_yielded = n_ready
+                yield _unflatten_coarse(gen_coarse_arr)
+        pbar.close()
+        assert n_yielded == n_steps
+    finally:
+        semantic.close()
+        models.release("coarse")
+        _clear_cuda_cache()
+
+
+def _left_pad_rows(rows, pad_value, extra_len=0):
+    """
+    Stack 1d tensors of different lengths, padding on the left, into a buffer with room for
+    `extra_len` more tokens. The mask has the same shape and is None if no padding was needed.
+    """
+    max_len = max(len(row) for row in rows)
+    device = rows[0].device
+    x = torch.full((len(rows), max_len + extra_len), pad_value, dtype=rows[0].dtype, device=device)
+    if all(len(row) == max_len for row in rows):
+        x[:, :max_len] = torch.stack(rows)
+        return x, None
+    attention_mask = torch.ones((len(rows), max_len + extra_len), dtype=torch.bool, device=device)
+    for i, row in enumerate(rows):
+        attention_mask[i, : max_len - len(row)] = False
+        if len(row) > 0:
+            x[i, max_len - len(row) : max_len] = row
+    return x, attention_mask
+
+
+def generate_coarse_batch(
+    x_semantics,
+    history_prompts=None,
+    temp=0.7,
+    top_k=None,
+    top_p=None,
+    silent=False,
+    max_coarse_history=630,  # min 60 (faster), max 630 (more context)
+    sliding_window_len=60,
+    use_kv_caching=False,
+    use_static_kv_cache=False,
+    seeds=None,
 ):
-    """Generate full audio codes from coarse audio codes."""
+    """Generate coarse audio codes for a batch of semantic arrays, one array per input."""
+    assert isinstance(x_semantics, (list, tuple)) and len(x_semantics) > 0
+    for x_semantic in x_semantics:
+        assert (
+            isinstance(x_semantic, np.ndarray)
+            and len(x_semantic.shape) == 1
+            and len(x_semantic) > 0
+            and x_semantic.min() >= 0
+            and x_semantic.max() <= SEMANTIC_VOCAB_SIZE - 1
+        )
+    n_rows = len(x_semantics)
+    if history_prompts is None:
+        history_prompts = [None] * n_rows
+    assert len(history_prompts) == n_rows
+    assert 60 <= max_coarse_history <= 630
+    assert max_coarse_history + sliding_window_len <= 1024 - 256
+    semantic_to_coarse_ratio = COARSE_RATE_HZ / SEMANTIC_RATE_HZ * N_COARSE_CODEBOOKS
+    max_semantic_history = int(np.floor(max_coarse_history / semantic_to_coarse_ratio))
+    x_semantic_ins = []
+    x_coarse_histories = []
+    base_semantic_idxs = []
+    n_steps = []
+    for x_semantic, history_prompt in zip(x_semantics, history_prompts):
+        x_semantic_history, x_coarse_history = _load_coarse_history(
+            history_prompt, max_semantic_history, semantic_to_coarse_ratio
+        )
+        n_steps.append(_n_coarse_steps(len(x_semantic), semantic_to_coarse_ratio))
+        x_semantic_ins.append(np.hstack([x_semantic_history, x_semantic]).astype(np.int32))
+        x_coarse_histories.append(x_coarse_history.astype(np.int32))
+        base_semantic_idxs.append(len(x_semantic_history))
+    # load models if not yet exist
+    global models
+    global models_devices
+    model = models.acquire("coarse")
+    try:
+        models.prefetch("fine")
+        device = next(model.parameters()).device
+        max_n_steps = max(n_steps)
+        with _inference_mode():
+            x_semantic_ins = [torch.from_numpy(x).to(device) for x in x_semantic_ins]
+            x_coarse_histories = [torch.from_numpy(x).to(device) for x in x_coarse_histories]
+            n_steps_in = torch.tensor(n_steps, device=device)
+            infer_token = torch.tensor([COARSE_INFER_TOKEN], dtype=torch.int32, device=device)
+            # generated tokens, written column by column; all rows share the same step counter
+            gen_coarse = torch.zeros((n_rows, max_n_steps), dtype=torch.int32, device=device)
+            generators = sampling.make_generators(seeds, device)
+            n_window_steps = int(np.ceil(max_n_steps / sliding_window_len))
+            n_step = 0
+            for _ in tqdm.tqdm(range(n_window_steps), total=n_window_steps, disable=silent):
+                active = [row for row in range(n_rows) if n_steps[row] > n_step]
+                x_in_rows = []
+                for row in active:
+                    semantic_idx = base_semantic_idxs[row] + int(
+                        round(n_step / semantic_to_coarse_ratio)
+                    )
+                    # pad from right side
+                    x_semantic_in = x_semantic_ins[row][
+                        np.max([0, semantic_idx - max_semantic_history]) :
+                    ]
+                    x_semantic_in = x_semantic_in[:256]
+                    x_semantic_in = F.pad(
+                        x_semantic_in,
+                        (0, 256 - x_semantic_in.shape[-1]),
+                        "constant",
+                        COARSE_SEMANTIC_PAD_TOKEN,
+                    )
+                    x_coarse_in = torch.cat([x_coarse_histories[row], gen_coarse[row, :n_step]])
+                    x_in_rows.append(
+                        torch.cat([x_semantic_in, infer_token, x_coarse_in[-max_coarse_history:]])
+                    )
+                # rows with shorter coarse context are padded on the left and masked out
+                x_in, attention_mask = _left_pad_rows(
+                    x_in_rows, COARSE_SEMANTIC_PAD_TOKEN, extra_len=sliding_window_len
+                )
+                x_in_len = x_in.shape[1] - sliding_window_len
+                active = torch.tensor(active, device=device)
+                kv_cache = _init_kv_cache(
+                    model, use_kv_caching, use_static_kv_cache, batch_size=len(active)
+                )
+                for _ in range(sliding_window_len):
+                    is_finished = n_steps_in.index_select(0, active) <= n_step
+                    if is_finished.all():
+                        break
+                    if is_finished.any():
+                        keep = torch.nonzero(~is_finished).squeeze(-1)
+                        x_in = x_in.index_select(0, keep)
+                        if attention_mask is not None:
+                            attention_mask = attention_mask.index_select(0, keep)
+                        kv_cache = _select_kv_rows(kv_cache, keep)
+                        active = active.index_select(0, keep)
+                    is_major_step = n_step % N_COARSE_CODEBOOKS == 0
+
+                    if use_kv_caching and _has_kv(kv_cache):
+                        x_input = x_in[:, x_in_len - 1 : x_in_len]
+                    else:
+                        x_input = x_in[:, :x_in_len]
+
+                    logit_start_idx = (
+                        SEMANTIC_VOCAB_SIZE + (1 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    logit_end_idx = (
+                        SEMANTIC_VOCAB_SIZE + (2 - int(is_major_step)) * CODEBOOK_SIZE
+                    )
+                    logits, kv_cache = model(
+                        x_input,
+                        use_cache=use_kv_caching,
+                        past_kv=kv_cache,
+                        attention_mask=(
+                            None if attention_mask is None else attention_mask[:, :x_in_len]
+                        ),
+                        logits_range=(logit_start_idx, logit_end_idx),
+                    )
+                    relevant_logits = logits[:, 0]
+                    row_generators = sampling.select_generators(generators, active)
+                    item_next, probs = sampling.sample(
+                        relevant_logits,
+                        temp=temp,
+                        top_k=top_k,
+                        top_p=top_p,
+                        generators=row_generators,
+                    )
+                    item_next = item_next.to(torch.int32) + logit_start_idx
+                    gen_coarse[active, n_step] = item_next
+                    x_in[:, x_in_len] = item_next
+                    x_in_len += 1
+                    del logits, relevant_logits, probs, item_next
+                    n_step += 1
+                del x_in
+            gen_coarse = gen_coarse.detach().cpu().numpy()
+    finally:
+        models.release("coarse")
+    gen_coarse_audio_arrs = [
+        _unflatten_coarse(gen_coarse[row, : n_steps[row]]) for row in range(n_rows)
+    ]
+    _clear_cuda_cache()
+    return gen_coarse_audio_arrs
+
+
+def _assert_coarse_codes(x_coarse_gen):
     assert (
         isinstance(x_coarse_gen, np.ndarray)
         and len(x_coarse_gen.shape) == 2
@@ -706,29 +2301,28 @@ def generate_fine(
         and x_coarse_gen.min() >= 0
         and x_coarse_gen.max() <= CODEBOOK_SIZE - 1
     )
-    if history_prompt is not None:
-        history_prompt = _load_history_prompt(history_prompt)
-        x_fine_history = history_prompt["fine_prompt"]
-        assert (
-            isinstance(x_fine_history, np.ndarray)
-            and len(x_fine_history.shape) == 2
-            and x_fine_history.shape[0] == N_FINE_CODEBOOKS
-            and x_fine_history.shape[1] >= 0
-            and x_fine_history.min() >= 0
-            and x_fine_history.max() <= CODEBOOK_SIZE - 1
-        )
-    else:
-        x_fine_history = None
+
+
+def _load_fine_history(history_prompt):
+    if history_prompt is None:
+        return None
+    return load_history_prompt(history_prompt).fine_history()
+
+
+FINE_LENGTH_BUCKETS = (256, 512, 768, 1024)
+
+
+def _fine_window_len(n_frames, length_buckets):
+    """Fine model window length for `n_frames` of history plus coarse codes."""
+    if length_buckets is None:
+        length_buckets = USE_FINE_LENGTH_BUCKETS
+    if not length_buckets or n_frames > 1024:
+        return 1024
+    return min(bucket for bucket in FINE_LENGTH_BUCKETS if bucket >= n_frames)
+
+
+def _prepare_fine_input(x_coarse_gen, x_fine_history=None, window_len=1024):
     n_coarse = x_coarse_gen.shape[0]
-    # load models if not yet exist
-    global models
-    global models_devices
-    if "fine" not in models:
-        preload_models()
-    model = models["fine"]
-    if OFFLOAD_CPU:
-        model.to(models_devices["fine"])
-    device = next(model.parameters()).device
     # make input arr
     in_arr = np.vstack(
         [
@@ -751,8 +2345,9 @@ def generate_fine(
         n_history = 0
     n_remove_from_end = 0
     # need to pad if too short (since non-causal model)
-    if in_arr.shape[1] < 1024:
-        n_remove_from_end = 1024 - in_arr.shape[1]
+    assert window_len == 1024 or in_arr.shape[1] <= window_len
+    if in_arr.shape[1] < window_len:
+        n_remove_from_end = window_len - in_arr.shape[1]
         in_arr = np.hstack(
             [
                 in_arr,
@@ -761,55 +2356,158 @@ def generate_fine(
         )
     # we can be lazy about fractional loop and just keep overwriting codebooks
     n_loops = np.max([0, int(np.ceil((x_coarse_gen.shape[1] - (1024 - n_history)) / 512))]) + 1
+    return in_arr, n_history, n_remove_from_end, n_loops
+
+
+def _generate_fine_codes(
+    model, x_coarse_gen, x_fine_history, temp, silent, generators, length_buckets=None
+):
+    """Run the fine model over `x_coarse_gen`, conditioned on `x_fine_history` (or None)."""
+    n_coarse = x_coarse_gen.shape[0]
+    device = next(model.parameters()).device
+    n_history = 0 if x_fine_history is None else min(x_fine_history.shape[1], 512)
+    window_len = _fine_window_len(n_history + x_coarse_gen.shape[1], length_buckets)
+    in_arr, n_history, n_remove_from_end, n_loops = _prepare_fine_input(
+        x_coarse_gen, x_fine_history, window_len
+    )
     with _inference_mode():
         in_arr = torch.tensor(in_arr.T).to(device)
         for n in tqdm.tqdm(range(n_loops), disable=silent):
-            start_idx = np.min([n * 512, in_arr.shape[0] - 1024])
-            start_fill_idx = np.min([n_history + n * 512, in_arr.shape[0] - 512])
+            start_idx = np.min([n * 512, in_arr.shape[0] - window_len])
+            # a single short window is filled right after the history
+            start_fill_idx = np.min(
+                [n_history + n * 512, max(n_history, in_arr.shape[0] - 512)]
+            )
             rel_start_fill_idx = start_fill_idx - start_idx
-            in_buffer = in_arr[start_idx : start_idx + 1024, :][None]
+            in_buffer = in_arr[start_idx : start_idx + window_len, :][None]
+            # running sum of the embeddings of the codebooks filled so far
+            tok_emb = model.embed_codebooks(in_buffer, n_coarse)
             for nn in range(n_coarse, N_FINE_CODEBOOKS):
-                logits = model(nn, in_buffer)
+                logits = model.forward_embeddings(nn, tok_emb + model.embed_codebook(in_buffer, nn))
                 if temp is None:
                     relevant_logits = logits[0, rel_start_fill_idx:, :CODEBOOK_SIZE]
                     codebook_preds = torch.argmax(relevant_logits, -1)
                 else:
-                    relevant_logits = logits[0, :, :CODEBOOK_SIZE] / temp
-                    probs = F.softmax(relevant_logits, dim=-1)
-                    codebook_preds = torch.multinomial(
-                        probs[rel_start_fill_idx:1024], num_samples=1
-                    ).reshape(-1)
+                    relevant_logits = logits[:, rel_start_fill_idx:window_len, :CODEBOOK_SIZE]
+                    codebook_preds, _ = sampling.sample(
+                        relevant_logits, temp=temp, generators=generators
+                    )
+                    codebook_preds = codebook_preds[0]
                 codebook_preds = codebook_preds.to(torch.int32)
                 in_buffer[0, rel_start_fill_idx:, nn] = codebook_preds
+                if nn < N_FINE_CODEBOOKS - 1:
+                    tok_emb = tok_emb + model.embed_codebook(in_buffer, nn)
                 del logits, codebook_preds
+            del tok_emb
             # transfer over info into model_in and convert to numpy
             for nn in range(n_coarse, N_FINE_CODEBOOKS):
                 in_arr[
-                    start_fill_idx : start_fill_idx + (1024 - rel_start_fill_idx), nn
+                    start_fill_idx : start_fill_idx + (window_len - rel_start_fill_idx), nn
                 ] = in_buffer[0, rel_start_fill_idx:, nn]
             del in_buffer
         gen_fine_arr = in_arr.detach().cpu().numpy().squeeze().T
         del in_arr
-    if OFFLOAD_CPU:
-        model.to("cpu")
     gen_fine_arr = gen_fine_arr[:, n_history:]
     if n_remove_from_end > 0:
         gen_fine_arr = gen_fine_arr[:, :-n_remove_from_end]
     assert gen_fine_arr.shape[-1] == x_coarse_gen.shape[-1]
-    _clear_cuda_cache()
     return gen_fine_arr
 
 
-def codec_decode(fine_tokens):
-    """Turn quantized audio codes into audio array using encodec."""
+def generate_fine(
+    x_coarse_gen,
+    history_prompt=None,
+    temp=0.5,
+    silent=True,
+    seed=None,
+    length_buckets=None,
+):
+    """Generate full audio codes from coarse audio codes.
+
+    With `length_buckets` (default `SUNO_FINE_LENGTH_BUCKETS`), a clip that fits in a single
+    window runs on the shortest of `FINE_LENGTH_BUCKETS` frames instead of being padded to 1024.
+    """
+    _assert_coarse_codes(x_coarse_gen)
+    x_fine_history = _load_fine_history(history_prompt)
     # load models if not yet exist
     global models
     global models_devices
-    if "codec" not in models:
-        preload_models()
-    model = models["codec"]
-    if OFFLOAD_CPU:
-        model.to(models_devices["codec"])
+    model = models.acquire("fine")
+    try:
+        models.prefetch("codec")
+        device = next(model.parameters()).device
+        generators = sampling.make_generators(None if seed is None else [seed], device)
+        gen_fine_arr = _generate_fine_codes(
+            model, x_coarse_gen, x_fine_history, temp, silent, generators, length_buckets
+        )
+    finally:
+        models.release("fine")
+    _clear_cuda_cache()
+    return gen_fine_arr
+
+
+def _append_fine_history(x_fine_history, gen_fine_arr):
+    if x_fine_history is None:
+        return gen_fine_arr[:, -512:]
+    return np.hstack([x_fine_history, gen_fine_arr])[:, -512:]
+
+
+def generate_fine_stream(
+    x_coarse_chunks,
+    history_prompt=None,
+    temp=0.5,
+    seed=None,
+    first_chunk_frames=32,
+    max_chunk_frames=256,
+    lookahead_frames=24,
+    length_buckets=None,
+):
+    """
+    Generate full audio codes from an iterable of coarse code chunks, yielding (8, n) fine
+    codes as soon as enough coarse frames have arrived.
+
+    Each pass conditions on the last 512 fine frames already yielded. The fine model is
+    non-causal, so the last `lookahead_frames` of a pass are held back and regenerated once
+    their right context exists. Passes start at `first_chunk_frames` and double up to
+    `max_chunk_frames`, trading an early first chunk for fewer passes later on.
+    """
+    assert 0 < first_chunk_frames <= max_chunk_frames and lookahead_frames >= 0
+    x_fine_history = _load_fine_history(history_prompt)
+    global models
+    global models_devices
+    model = models.acquire("fine")
+    try:
+        models.prefetch("codec")
+        device = next(model.parameters()).device
+        generators = sampling.make_generators(None if seed is None else [seed], device)
+        x_coarse = None
+        n_done = 0
+        chunk_frames = first_chunk_frames
+        for x_coarse_chunk in x_coarse_chunks:
+            _assert_coarse_codes(x_coarse_chunk)
+            x_coarse = (
+                x_coarse_chunk if x_coarse is None else np.hstack([x_coarse, x_coarse_chunk])
+            )
+            if x_coarse.shape[-1] - n_done < chunk_frames + lookahead_frames:
+                continue
+            gen_fine_arr = _generate_fine_codes(
+                model, x_coarse[:, n_done:], x_fine_history, temp, True, generators, length_buckets
+            )
+            gen_fine_arr = gen_fine_arr[:, : gen_fine_arr.shape[-1] - lookahead_frames]
+            n_done += gen_fine_arr.shape[-1]
+            x_fine_history = _append_fine_history(x_fine_history, gen_fine_arr)
+            chunk_frames = min(2 * chunk_frames, max_chunk_frames)
+            yield gen_fine_arr
+        if x_coarse is not None and x_coarse.shape[-1] > n_done:
+            yield _generate_fine_codes(
+                model, x_coarse[:, n_done:], x_fine_history, temp, True, generators, length_buckets
+            )
+    finally:
+        models.release("fine")
+        _clear_cuda_cache()
+
+
+def _codec_decode(model, fine_tokens):
     device = next(model.parameters()).device
     arr = torch.from_numpy(fine_tokens)[None]
     arr = arr.to(device)
@@ -818,6 +2516,217 @@ def codec_decode(fine_tokens):
     out = model.decoder(emb)
     audio_arr = out.detach().cpu().numpy().squeeze()
     del arr, emb, out
-    if OFFLOAD_CPU:
-        model.to("cpu")
     return audio_arr
+
+
+def codec_decode(fine_tokens):
+    """Turn quantized audio codes into audio array using encodec."""
+    # load models if not yet exist
+    global models
+    global models_devices
+    model = models.acquire("codec")
+    try:
+        audio_arr = _codec_decode(model, fine_tokens)
+    finally:
+        models.release("codec")
+    return audio_arr
+
+
+def codec_decode_stream(fine_token_chunks, context_frames=32, crossfade_frames=4):
+    """
+    Turn an iterable of quantized audio code chunks into audio chunks using encodec.
+
+    Each chunk is decoded together with the `context_frames` frames before it, so the
+    decoder's recurrent state is warmed up instead of starting from scratch. The audio of the
+    last `crossfade_frames` frames is held back and crossfaded with its re-decode in the next
+    chunk, which hides the small mismatch between two decodes with different context. The
+    chunks add up to exactly the audio length of all codes.
+    """
+    assert context_frames >= crossfade_frames >= 0
+    global models
+    global models_devices
+    model = models.acquire("codec")
+    try:
+        fine_tokens = None
+        n_emitted = 0
+        tail = None
+        for fine_tokens_chunk in fine_token_chunks:
+            if fine_tokens_chunk.shape[-1] == 0:
+                continue
+            fine_tokens = (
+                fine_tokens_chunk
+                if fine_tokens is None
+                else np.hstack([fine_tokens, fine_tokens_chunk])
+            )
+            start = max(0, n_emitted - context_frames)
+            with _inference_mode():
+                audio_arr = _codec_decode(model, fine_tokens[:, start:])
+            hop_length = audio_arr.shape[-1] // (fine_tokens.shape[-1] - start)
+            audio_arr = audio_arr[(n_emitted - start) * hop_length :]
+            if tail is not None:
+                fade = (np.arange(len(tail), dtype=np.float32) + 0.5) / len(tail)
+                audio_arr = audio_arr.copy()
+                audio_arr[: len(tail)] = tail * (1 - fade) + audio_arr[: len(tail)] * fade
+            n_tail = min(crossfade_frames, fine_tokens_chunk.shape[-1])
+            n_emitted = fine_tokens.shape[-1] - n_tail
+            tail = audio_arr[len(audio_arr) - n_tail * hop_length :] if n_tail > 0 else None
+            yield audio_arr[: len(audio_arr) - n_tail * hop_length]
+            # drop codes that can no longer serve as context
+            n_drop = max(0, n_emitted - context_frames)
+            fine_tokens = fine_tokens[:, n_drop:]
+            n_emitted -= n_drop
+        if tail is not None:
+            yield tail
+    finally:
+        models.release("codec")
+
+
+def generate_fine_batch(
+    x_coarse_gens,
+    history_prompts=None,
+    temp=0.5,
+    silent=True,
+    seeds=None,
+    length_buckets=None,
+):
+    """Generate full audio codes for a batch of coarse code arrays, one array per input."""
+    assert isinstance(x_coarse_gens, (list, tuple)) and len(x_coarse_gens) > 0
+    for x_coarse_gen in x_coarse_gens:
+        _assert_coarse_codes(x_coarse_gen)
+    n_rows = len(x_coarse_gens)
+    if history_prompts is None:
+        history_prompts = [None] * n_rows
+    assert len(history_prompts) == n_rows
+    n_coarse = x_coarse_gens[0].shape[0]
+    assert all(x_coarse_gen.shape[0] == n_coarse for x_coarse_gen in x_coarse_gens)
+    # load models if not yet exist
+    global models
+    global models_devices
+    model = models.acquire("fine")
+    try:
+        models.prefetch("codec")
+        device = next(model.parameters()).device
+        x_fine_histories = [
+            _load_fine_history(history_prompt) for history_prompt in history_prompts
+        ]
+        # rows share one window length, the bucket of the longest row
+        window_len = _fine_window_len(
+            max(
+                (0 if x_fine_history is None else min(x_fine_history.shape[1], 512))
+                + x_coarse_gen.shape[1]
+                for x_coarse_gen, x_fine_history in zip(x_coarse_gens, x_fine_histories)
+            ),
+            length_buckets,
+        )
+        in_arrs, n_histories, n_remove_from_ends, n_loops = zip(*[
+            _prepare_fine_input(x_coarse_gen, x_fine_history, window_len)
+            for x_coarse_gen, x_fine_history in zip(x_coarse_gens, x_fine_histories)
+        ])
+        with _inference_mode():
+            in_arrs = [torch.tensor(in_arr.T).to(device) for in_arr in in_arrs]
+            generators = sampling.make_generators(seeds, device)
+            for n in tqdm.tqdm(range(max(n_loops)), disable=silent):
+                rows = [row for row in range(n_rows) if n < n_loops[row]]
+                start_idxs = []
+                start_fill_idxs = []
+                for row in rows:
+                    start_idxs.append(np.min([n * 512, in_arrs[row].shape[0] - window_len]))
+                    start_fill_idxs.append(
+                        np.min([
+                            n_histories[row] + n * 512,
+                            max(n_histories[row], in_arrs[row].shape[0] - 512),
+                        ])
+                    )
+                rel_start_fill_idxs = torch.tensor(
+                    [fill - start for start, fill in zip(start_idxs, start_fill_idxs)],
+                    device=device,
+                )
+                # one [B, window_len, 8] buffer for every row that still has a window left
+                in_buffer = torch.stack([
+                    in_arrs[row][start_idx : start_idx + window_len, :]
+                    for row, start_idx in zip(rows, start_idxs)
+                ])
+                fill_mask = (
+                    torch.arange(window_len, device=device)[None] >= rel_start_fill_idxs[:, None]
+                )
+                # running sum of the embeddings of the codebooks filled so far
+                tok_emb = model.embed_codebooks(in_buffer, n_coarse)
+                for nn in range(n_coarse, N_FINE_CODEBOOKS):
+                    logits = model.forward_embeddings(
+                        nn, tok_emb + model.embed_codebook(in_buffer, nn)
+                    )
+                    if temp is None:
+                        codebook_preds = torch.argmax(logits[:, :, :CODEBOOK_SIZE], -1)
+                        codebook_preds = codebook_preds[fill_mask]
+                    elif generators is None:
+                        codebook_preds, _ = sampling.sample(
+                            logits[:, :, :CODEBOOK_SIZE][fill_mask], temp=temp
+                        )
+                    else:
+                        # each row draws only its own positions, from its own generator
+                        codebook_preds = torch.cat([
+                            sampling.sample(
+                                logits[i : i + 1, int(rel_start_fill_idx):, :CODEBOOK_SIZE],
+                                temp=temp,
+                                generators=[generators[row]],
+                            )[0][0]
+                            for i, (row, rel_start_fill_idx) in enumerate(
+                                zip(rows, rel_start_fill_idxs)
+                            )
+                        ])
+                    codebook_preds = codebook_preds.to(torch.int32)
+                    in_buffer[:, :, nn][fill_mask] = codebook_preds
+                    if nn < N_FINE_CODEBOOKS - 1:
+                        tok_emb = tok_emb + model.embed_codebook(in_buffer, nn)
+                    del logits, codebook_preds
+                del tok_emb
+                # transfer over info into model_in
+                for i, (row, start_fill_idx) in enumerate(zip(rows, start_fill_idxs)):
+                    rel_start_fill_idx = int(rel_start_fill_idxs[i])
+                    end_fill_idx = start_fill_idx + (window_len - rel_start_fill_idx)
+                    in_arrs[row][start_fill_idx:end_fill_idx, n_coarse:] = in_buffer[
+                        i, rel_start_fill_idx:, n_coarse:
+                    ]
+                del in_buffer
+            gen_fine_arrs = [in_arr.detach().cpu().numpy().T for in_arr in in_arrs]
+            del in_arrs
+    finally:
+        models.release("fine")
+    for row in range(n_rows):
+        gen_fine_arr = gen_fine_arrs[row][:, n_histories[row]:]
+        if n_remove_from_ends[row] > 0:
+            gen_fine_arr = gen_fine_arr[:, :-n_remove_from_ends[row]]
+        assert gen_fine_arr.shape[-1] == x_coarse_gens[row].shape[-1]
+        gen_fine_arrs[row] = gen_fine_arr
+    _clear_cuda_cache()
+    return gen_fine_arrs
+
+
+def codec_decode_batch(fine_tokens_list):
+    """Turn a batch of quantized audio code arrays into audio arrays using encodec."""
+    assert isinstance(fine_tokens_list, (list, tuple)) and len(fine_tokens_list) > 0
+    # load models if not yet exist
+    global models
+    global models_devices
+    model = models.acquire("codec")
+    try:
+        device = next(model.parameters()).device
+        lengths = [fine_tokens.shape[-1] for fine_tokens in fine_tokens_list]
+        max_length = max(lengths)
+        # the 24khz encodec decoder is causal, so right padding does not leak into earlier samples
+        arr = np.stack([
+            np.pad(fine_tokens, ((0, 0), (0, max_length - fine_tokens.shape[-1])))
+            for fine_tokens in fine_tokens_list
+        ]).astype(np.int64)
+        with _inference_mode():
+            arr = torch.from_numpy(arr).to(device)
+            arr = arr.transpose(0, 1)
+            emb = model.quantizer.decode(arr)
+            out = model.decoder(emb)
+            out = out.detach().cpu().numpy()[:, 0]
+            del arr, emb
+        hop_length = out.shape[-1] // max_length
+        audio_arrs = [out[i, : length * hop_length] for i, length in enumerate(lengths)]
+    finally:
+        models.release("codec")
+    return audio_arrs
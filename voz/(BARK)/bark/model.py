@@ -43,7 +43,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x, past_kv=None, use_cache=False):
+    def forward(self, x, past_kv=None, use_cache=False, attn_mask=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -52,23 +52,33 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        if past_kv is not None:
-            past_key = past_kv[0]
-            past_value = past_kv[1]
-            k = torch.cat((past_key, k), dim=-2)
-            v = torch.cat((past_value, v), dim=-2)
+        if isinstance(past_kv, _StaticKVLayer):
+            # write into the preallocated buffer instead of growing the cache
+            has_past = past_kv.cache.length > 0
+            k, v = past_kv.update(k, v)
+            present = past_kv if use_cache else None
+        else:
+            has_past = past_kv is not None
+            if past_kv is not None:
+                past_key = past_kv[0]
+                past_value = past_kv[1]
+                k = torch.cat((past_key, k), dim=-2)
+                v = torch.cat((past_value, v), dim=-2)
 
-        FULL_T = k.shape[-2]
+            if use_cache is True:
+                present = (k, v)
+            else:
+                present = None
 
-        if use_cache is True:
-            present = (k, v)
-        else:
-            present = None
+        FULL_T = k.shape[-2]
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            if past_kv is not None:
+            if attn_mask is not None:
+                # padded batch: the mask already encodes causality and which keys are real
+                is_causal = False
+            elif has_past:
                 # When `past_kv` is provided, we're doing incremental decoding and `q.shape[2] == 1`: q only contains
                 # the query for the last token. scaled_dot_product_attention interprets this as the first token in the
                 # sequence, so if is_causal=True it will mask out all attention from it. This is not what we want, so 
@@ -77,11 +87,14 @@ class CausalSelfAttention(nn.Module):
             else:
                 is_causal = True
 
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=self.dropout, is_causal=is_causal)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout, is_causal=is_causal)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,FULL_T-T:FULL_T,:FULL_T] == 0, float('-inf'))
+            if attn_mask is not None:
+                att = att.masked_fill(~attn_mask, float('-inf'))
+            else:
+                att = att.masked_fill(self.bias[:,:,FULL_T-T:FULL_T,:FULL_T] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
             y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
@@ -117,12 +130,189 @@ class Block(nn.Module):
         self.mlp = MLP(config)
         self.layer_idx = layer_idx
 
-    def forward(self, x, past_kv=None, use_cache=False):
-        attn_output, prev_kvs = self.attn(self.ln_1(x), past_kv=past_kv, use_cache=use_cache)
+    def forward(self, x, past_kv=None, use_cache=False, attn_mask=None):
+        attn_output, prev_kvs = self.attn(self.ln_1(x), past_kv=past_kv, use_cache=use_cache, attn_mask=attn_mask)
         x = x + attn_output
         x = x + self.mlp(self.ln_2(x))
         return (x, prev_kvs)
 
+def _make_attn_mask(attention_mask, t, past_length):
+    """
+    Expand a (b, past_length + t) padding mask into a (b, 1, t, past_length + t) boolean
+    attention mask that is also causal. Every query may always attend to itself, so rows
+    made purely of padding don't turn into NaNs.
+    """
+    device = attention_mask.device
+    full_t = past_length + t
+    query_pos = torch.arange(past_length, full_t, device=device)[:, None]
+    key_pos = torch.arange(full_t, device=device)[None, :]
+    mask = (key_pos <= query_pos)[None] & attention_mask.bool()[:, None, :]
+    mask = mask | (key_pos == query_pos)[None]
+    return mask[:, None]
+
+class _StaticKVLayer:
+    """ One layer's view of a StaticKVCache """
+
+    def __init__(self, cache, shape):
+        self.cache = cache
+        self.shape = shape
+        self.key = None
+        self.value = None
+
+    def update(self, k, v):
+        start = self.cache.length
+        end = start + k.size(-2)
+        assert end <= self.shape[2], f"static kv cache overflow: {end} > {self.shape[2]}"
+        if self.key is None:
+            # allocated on first use so the buffer matches the (possibly autocast) compute dtype
+            self.key = torch.empty(self.shape, dtype=k.dtype, device=k.device)
+            self.value = torch.empty(self.shape, dtype=v.dtype, device=v.device)
+        self.key[:, :, start:end] = k
+        self.value[:, :, start:end] = v
+        return self.key[:, :, :end], self.value[:, :, :end]
+
+class StaticKVCache:
+    """
+    Preallocated key/value cache for incremental decoding. Every layer owns a single
+    (batch_size, n_head, max_len, head_size) buffer, and all layers share one write cursor
+    (`length`) that GPT.forward advances after each call. Decoding never reallocates, so
+    the per-token cost stays flat and the memory footprint is fixed up front (`nbytes`).
+    """
+
+    def __init__(self, config, batch_size=1, max_len=None):
+        max_len = config.block_size if max_len is None else max_len
+        shape = (batch_size, config.n_head, max_len, config.n_embd // config.n_head)
+        self.layers = [_StaticKVLayer(self, shape) for _ in range(config.n_layer)]
+        self.length = 0
+
+    @property
+    def max_len(self):
+        return self.layers[0].shape[2]
+
+    def nbytes(self, dtype=torch.float32):
+        """ Total size of all key and value buffers once allocated """
+        n_elements = 2 * len(self.layers) * math.prod(self.layers[0].shape)
+        return n_elements * torch.empty((), dtype=dtype).element_size()
+
+    def truncate(self, length=0):
+        """ Move the cursor back; entries past `length` are overwritten by later calls """
+        assert 0 <= length <= self.length
+        self.length = length
+
+    def select_rows(self, rows):
+        """ Keep only the given batch rows (e.g. once some sequences have finished) """
+        for layer in self.layers:
+            layer.shape = (len(rows),) + layer.shape[1:]
+            if layer.key is not None:
+                layer.key = layer.key.index_select(0, rows)
+                layer.value = layer.value.index_select(0, rows)
+        return self
+
+class _SlotKVLayer(_StaticKVLayer):
+    """ One layer's view of a SlotKVCache, covering the first (active) slots """
+
+    def update(self, k, v):
+        start = self.cache.length
+        end = start + k.size(-2)
+        assert end <= self.shape[2], f"slot kv cache overflow: {end} > {self.shape[2]}"
+        self.cache._allocate(k.dtype, k.device)
+        b = k.size(0)
+        self.key[:b, :, start:end] = k
+        self.value[:b, :, start:end] = v
+        return self.key[:b, :, :end], self.value[:b, :, :end]
+
+class SlotKVCache(StaticKVCache):
+    """
+    Pool of KV cache slots for continuous batching: one slot (batch row) per sequence, so
+    sequences can join and leave a running decode batch between any two steps.
+
+    All slots share the write cursor `length`, and `mask` marks which columns of each slot
+    hold that sequence's keys. A sequence that joins later, or that is shorter, just has
+    masked out columns. Pass `step_mask()` as the attention_mask of each decoding
+    GPT.forward: positions are counted from the mask, so every sequence sees the same
+    positions as when decoded alone. The active slots are always the first `n_active`
+    batch rows, so a step runs on plain views of the buffers.
+    """
+
+    def __init__(self, config, n_slots, max_len=None):
+        super().__init__(config, batch_size=n_slots, max_len=max_len)
+        self.layers = [_SlotKVLayer(self, layer.shape) for layer in self.layers]
+        self.n_slots = n_slots
+        self.n_active = 0
+        self.mask = None
+
+    def _allocate(self, dtype, device):
+        if self.mask is not None:
+            return
+        for layer in self.layers:
+            layer.key = torch.empty(layer.shape, dtype=dtype, device=device)
+            layer.value = torch.empty(layer.shape, dtype=dtype, device=device)
+        self.mask = torch.zeros((self.n_slots, self.max_len), dtype=torch.bool, device=device)
+
+    @property
+    def n_free(self):
+        return self.n_slots - self.n_active
+
+    def add(self, cache, attention_mask=None):
+        """
+        Move the sequences of a prefilled StaticKVCache into free slots, with `attention_mask`
+        marking the real (not padding) columns. Returns the slot of each sequence.
+        """
+        b, t = cache.layers[0].key.size(0), cache.length
+        assert b <= self.n_free, f"only {self.n_free} free slots for {b} sequences"
+        assert t < self.max_len
+        self._allocate(cache.layers[0].key.dtype, cache.layers[0].key.device)
+        slots = slice(self.n_active, self.n_active + b)
+        for layer, new_layer in zip(self.layers, cache.layers):
+            layer.key[slots, :, :t] = new_layer.key[:, :, :t]
+            layer.value[slots, :, :t] = new_layer.value[:, :, :t]
+        self.mask[slots] = False
+        self.mask[slots, :t] = True if attention_mask is None else attention_mask[:, :t]
+        self.n_active += b
+        # the cursor only moves forward, earlier sequences get masked out columns in between
+        self.length = max(self.length, t)
+        return list(range(slots.start, slots.stop))
+
+    def remove(self, slot):
+        """
+        Free `slot`. The last active slot is moved into its place (so active slots stay
+        contiguous); returns that slot's old index, which now lives at `slot`.
+        """
+        assert 0 <= slot < self.n_active
+        last = self.n_active - 1
+        if slot != last:
+            for layer in self.layers:
+                layer.key[slot] = layer.key[last]
+                layer.value[slot] = layer.value[last]
+            self.mask[slot] = self.mask[last]
+        self.n_active -= 1
+        if self.n_active == 0:
+            self.length = 0
+        return last
+
+    def compact(self):
+        """ Shift each active slot's columns to the left, dropping the masked out ones """
+        n_valid = self.mask[: self.n_active].sum(-1).tolist()
+        for slot, n in enumerate(n_valid):
+            cols = torch.nonzero(self.mask[slot]).squeeze(-1)
+            for layer in self.layers:
+                layer.key[slot, :, :n] = layer.key[slot, :, cols]
+                layer.value[slot, :, :n] = layer.value[slot, :, cols]
+            self.mask[slot] = False
+            self.mask[slot, :n] = True
+        self.length = max(n_valid, default=0)
+
+    def step_mask(self, t=1):
+        """
+        Attention mask of the active slots for a forward of `t` new tokens each, making
+        room for them first if the cursor is at the end of the buffers.
+        """
+        if self.length + t > self.max_len:
+            self.compact()
+        assert self.length + t <= self.max_len, "a sequence outgrew the kv cache"
+        self.mask[: self.n_active, self.length : self.length + t] = True
+        return self.mask[: self.n_active, : self.length + t]
+
 @dataclass
 class GPTConfig:
     block_size: int = 1024
@@ -165,11 +355,18 @@ class GPT(nn.Module):
             n_params -= self.transformer.wpe.weight.numel()
         return n_params
 
-    def forward(self, idx, merge_context=False, past_kv=None, position_ids=None, use_cache=False):
+    def forward(self, idx, merge_context=False, past_kv=None, position_ids=None, use_cache=False, attention_mask=None, logits_range=None, n_logits=1):
         device = idx.device
         b, t = idx.size()
-        if past_kv is not None:
-            assert t == 1
+        if isinstance(past_kv, StaticKVCache):
+            static_cache = past_kv
+            past_length = static_cache.length
+            past_kv = static_cache.layers
+        else:
+            static_cache = None
+            past_length = past_kv[0][0].size(-2) if past_kv is not None else 0
+        if past_length > 0:
+            assert past_length + t <= self.config.block_size, f"Cannot forward sequence of length {past_length + t}, block size is only {self.config.block_size}"
             tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
         else:
             if merge_context:
@@ -188,10 +385,21 @@ class GPT(nn.Module):
                 tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
 
         if past_kv is None:
-            past_length = 0
             past_kv = tuple([None] * len(self.transformer.h))
+
+        if attention_mask is None and t > 1 and past_length > 0:
+            # several new tokens on top of a cache (e.g. verifying drafted tokens): they still
+            # need a causal mask among themselves, offset by the cached length
+            attention_mask = torch.ones((b, past_length + t), dtype=torch.bool, device=device)
+
+        if attention_mask is not None:
+            # left-padded batch: attention_mask is (b, past_length + t), 1 for real tokens
+            assert attention_mask.shape == (b, past_length + t)
+            if position_ids is None:
+                position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)[:, -t:]
+            attn_mask = _make_attn_mask(attention_mask, t, past_length)
         else:
-            past_length = past_kv[0][0].size(-2)
+            attn_mask = None
 
         if position_ids is None:
             position_ids = torch.arange(past_length, t + past_length, dtype=torch.long, device=device)
@@ -205,14 +413,28 @@ class GPT(nn.Module):
         new_kv = () if use_cache else None
 
         for i, (block, past_layer_kv) in enumerate(zip(self.transformer.h, past_kv)):
-            x, kv = block(x, past_kv=past_layer_kv, use_cache=use_cache)
+            x, kv = block(x, past_kv=past_layer_kv, use_cache=use_cache, attn_mask=attn_mask)
 
             if use_cache:
                 new_kv = new_kv + (kv,)
 
+        if static_cache is not None:
+            static_cache.length += t
+            new_kv = static_cache if use_cache else None
+
         x = self.transformer.ln_f(x)
 
-        # inference-time mini-optimization: only forward the lm_head on the very last position
-        logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
+        # inference-time mini-optimization: only forward the lm_head on the last n_logits positions
+        x = x[:, -n_logits:, :] # note: slicing preserves the time dim
+        if logits_range is not None and isinstance(self.lm_head, nn.Linear):
+            # only project onto the (start, end) slice of the vocab the caller samples from
+            start, end = logits_range
+            logits = F.linear(x, self.lm_head.weight[start:end])
+        elif logits_range is not None:
+            # quantized lm_head: packed weights can't be sliced, so project fully and slice after
+            start, end = logits_range
+            logits = self.lm_head(x)[..., start:end]
+        else:
+            logits = self.lm_head(x)
 
         return (logits, new_kv)
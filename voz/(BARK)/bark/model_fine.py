@@ -105,23 +105,48 @@ class FineGPT(GPT):
             self.transformer.wtes[i + 1].weight = self.lm_heads[i].weight
 
     def forward(self, pred_idx, idx):
-        device = idx.device
         b, t, codes = idx.size()
         assert (
             t <= self.config.block_size
         ), f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
         assert pred_idx > 0, "cannot predict 0th codebook"
         assert codes == self.n_codes_total, (b, t, codes)
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0)  # shape (1, t)
 
         # forward the GPT model itself
         tok_embs = [
             wte(idx[:, :, i]).unsqueeze(-1) for i, wte in enumerate(self.transformer.wtes)
         ]  # token embeddings of shape (b, t, n_embd)
         tok_emb = torch.cat(tok_embs, dim=-1)
-        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (1, t, n_embd)
         x = tok_emb[:, :, :, : pred_idx + 1].sum(dim=-1)
-        x = self.transformer.drop(x + pos_emb)
+        return self.forward_embeddings(pred_idx, x)
+
+    def embed_codebook(self, idx, code_idx):
+        """Token embeddings (b, t, n_embd) of codebook `code_idx` of idx (b, t, codes)."""
+        return self.transformer.wtes[code_idx](idx[:, :, code_idx])
+
+    def embed_codebooks(self, idx, n_codes):
+        """Sum of the token embeddings of the first `n_codes` codebooks of idx (b, t, codes)."""
+        tok_emb = self.embed_codebook(idx, 0)
+        for code_idx in range(1, n_codes):
+            tok_emb = tok_emb + self.embed_codebook(idx, code_idx)
+        return tok_emb
+
+    def forward_embeddings(self, pred_idx, tok_emb):
+        """
+        Predict codebook `pred_idx` from the summed token embeddings of codebooks 0..pred_idx.
+
+        Inference can keep a running sum across codebooks (see `embed_codebook`) instead of
+        re-embedding all of them for every call like `forward` does.
+        """
+        device = tok_emb.device
+        b, t, _ = tok_emb.size()
+        assert (
+            t <= self.config.block_size
+        ), f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
+        assert pred_idx > 0, "cannot predict 0th codebook"
+        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0)  # shape (1, t)
+        pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (1, t, n_embd)
+        x = self.transformer.drop(tok_emb + pos_emb)
         for block in self.transformer.h:
             x = block(x)
         x = self.transformer.ln_f(x)
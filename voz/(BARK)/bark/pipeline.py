@@ -0,0 +1,265 @@
+"""
+Stage-parallel runtime: semantic, coarse, fine and codec each run on their own worker threads.
+
+`generate_audio` runs the four stages of a request back to back, so under sustained load
+only one model is busy at a time. Here every stage has its own replicas (threads sharing that
+stage's model) connected by bounded queues of token arrays. While the coarse stage works on
+one request, the semantic stage is already on the next one and the fine stage on the
+previous one. Replicas go where the time goes, typically the coarse stage, without loading
+the whole model stack again:
+
+    from bark.pipeline import Pipeline
+
+    with Pipeline(replicas={"coarse": 2}) as pipeline:
+        futures = [pipeline.submit(text, history_prompt="v2/en_speaker_6") for text in texts]
+        audio_arrs = [f.result() for f in futures]
+        print(pipeline.stats())
+
+Torch releases the GIL inside its kernels, so the stage threads really do run in parallel.
+All models stay resident while the pipeline runs, so it doesn't combine with a device memory
+budget or cpu offloading.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .generation import (
+    can_overlap_stages,
+    codec_decode,
+    generate_coarse,
+    generate_fine,
+    generate_text_semantic,
+    load_history_prompt,
+    trim_semantic_silence,
+)
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("semantic", "coarse", "fine", "codec")
+DEFAULT_REPLICAS = {"semantic": 1, "coarse": 2, "fine": 1, "codec": 1}
+
+_STOP = object()
+
+
+class _Request:
+    def __init__(
+        self, text, history_prompt, text_temp, waveform_temp, seed, output_full, trim_silence
+    ):
+        self.text = text
+        self.history_prompt = history_prompt
+        self.text_temp = text_temp
+        self.waveform_temp = waveform_temp
+        self.seed = seed
+        self.output_full = output_full
+        self.trim_silence = trim_silence
+        self.future = Future()
+        self.semantic_tokens = None
+        self.coarse_tokens = None
+        self.fine_tokens = None
+
+
+def _semantic_stage(request):
+    x_semantic = generate_text_semantic(
+        request.text,
+        history_prompt=request.history_prompt,
+        temp=request.text_temp,
+        silent=True,
+        use_kv_caching=True,
+        seed=request.seed,
+    )
+    if request.trim_silence:
+        x_semantic = trim_semantic_silence(x_semantic)
+    request.semantic_tokens = x_semantic
+
+
+def _coarse_stage(request):
+    request.coarse_tokens = generate_coarse(
+        request.semantic_tokens,
+        history_prompt=request.history_prompt,
+        temp=request.waveform_temp,
+        silent=True,
+        use_kv_caching=True,
+        seed=request.seed,
+    )
+
+
+def _fine_stage(request):
+    request.fine_tokens = generate_fine(
+        request.coarse_tokens,
+        history_prompt=request.history_prompt,
+        temp=0.5,
+        seed=request.seed,
+    )
+
+
+def _codec_stage(request):
+    audio_arr = codec_decode(request.fine_tokens)
+    if request.output_full:
+        full_generation = {
+            "semantic_prompt": request.semantic_tokens,
+            "coarse_prompt": request.coarse_tokens,
+            "fine_prompt": request.fine_tokens,
+        }
+        request.future.set_result((full_generation, audio_arr))
+    else:
+        request.future.set_result(audio_arr)
+
+
+_STAGE_FNS = {
+    "semantic": _semantic_stage,
+    "coarse": _coarse_stage,
+    "fine": _fine_stage,
+    "codec": _codec_stage,
+}
+
+
+class Pipeline:
+    """
+    `generate_audio` as four stages on worker threads, linked by bounded queues.
+
+    Args:
+        replicas: worker threads per stage, by stage name. Stages left out use
+            `DEFAULT_REPLICAS`
+        max_queued: requests each queue holds before the stage feeding it blocks, and
+            `submit` with it
+    """
+
+    def __init__(self, replicas=None, max_queued=4):
+        self.replicas = {**DEFAULT_REPLICAS, **(replicas or {})}
+        assert set(self.replicas) == set(STAGES), f"unknown stages in {replicas}"
+        assert all(n > 0 for n in self.replicas.values())
+        self.max_queued = max_queued
+        # queues[i] feeds stage i
+        self._queues = [queue.Queue(maxsize=max(1, max_queued)) for _ in STAGES]
+        self._lock = threading.Lock()
+        self._threads = []
+        self._n_running = {}
+        self._n_done = {stage: 0 for stage in STAGES}
+        self._busy_s = {stage: 0.0 for stage in STAGES}
+        self._started_at = None
+        self._closed = False
+
+    def start(self):
+        """Start the stage threads. Called by `with Pipeline(...)`."""
+        assert not self._threads, "pipeline already started"
+        if not can_overlap_stages():
+            logger.warning(
+                "the pipeline keeps every model on the device at once, which a device memory "
+                "budget or cpu offloading works against"
+            )
+        self._started_at = time.perf_counter()
+        for i, stage in enumerate(STAGES):
+            self._n_running[stage] = self.replicas[stage]
+            for n in range(self.replicas[stage]):
+                thread = threading.Thread(
+                    target=self._run_stage,
+                    args=(i,),
+                    name=f"bark-{stage}-{n}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def submit(
+        self,
+        text,
+        history_prompt=None,
+        text_temp=0.7,
+        waveform_temp=0.7,
+        seed=None,
+        output_full=False,
+        trim_silence=False,
+    ):
+        """
+        Queue a request and return a Future of what `generate_audio` would return for it.
+
+        Blocks while the semantic stage's queue is full.
+        """
+        assert self._threads, "pipeline not started"
+        assert not self._closed, "pipeline is closed"
+        request = _Request(
+            text,
+            # load and preprocess the speaker once for all stages
+            load_history_prompt(history_prompt),
+            text_temp,
+            waveform_temp,
+            seed,
+            output_full,
+            trim_silence,
+        )
+        self._queues[0].put(request)
+        return request.future
+
+    def map(self, texts, **kwargs):
+        """`submit` every text with shared kwargs and return the results in order."""
+        futures = [self.submit(text, **kwargs) for text in texts]
+        return [future.result() for future in futures]
+
+    def _run_stage(self, i):
+        stage = STAGES[i]
+        in_queue = self._queues[i]
+        out_queue = self._queues[i + 1] if i + 1 < len(STAGES) else None
+        stage_fn = _STAGE_FNS[stage]
+        while True:
+            request = in_queue.get()
+            if request is _STOP:
+                break
+            if i == 0 and not request.future.set_running_or_notify_cancel():
+                continue
+            t0 = time.perf_counter()
+            try:
+                stage_fn(request)
+            except Exception as e:
+                request.future.set_exception(e)
+                continue
+            finally:
+                with self._lock:
+                    self._n_done[stage] += 1
+                    self._busy_s[stage] += time.perf_counter() - t0
+            if out_queue is not None:
+                out_queue.put(request)
+        with self._lock:
+            self._n_running[stage] -= 1
+            is_last = self._n_running[stage] == 0
+        # the last replica out has seen every request through, so the next stage can stop too
+        if is_last and out_queue is not None:
+            for _ in range(self.replicas[STAGES[i + 1]]):
+                out_queue.put(_STOP)
+
+    def stats(self):
+        """Per stage replicas, requests done, busy seconds, utilization and queue depth."""
+        elapsed = time.perf_counter() - self._started_at if self._started_at is not None else 0.0
+        with self._lock:
+            return {
+                stage: {
+                    "replicas": self.replicas[stage],
+                    "done": self._n_done[stage],
+                    "busy_s": self._busy_s[stage],
+                    # of all replicas together, 1.0 when none of them is ever idle
+                    "utilization": (
+                        self._busy_s[stage] / (elapsed * self.replicas[stage])
+                        if elapsed > 0 else 0.0
+                    ),
+                    "queued": self._queues[i].qsize(),
+                }
+                for i, stage in enumerate(STAGES)
+            }
+
+    def close(self, timeout=None):
+        """Finish the requests already submitted, then stop the stage threads."""
+        if self._closed or not self._threads:
+            return
+        self._closed = True
+        for _ in range(self.replicas[STAGES[0]]):
+            self._queues[0].put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
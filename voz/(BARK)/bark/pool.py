@@ -0,0 +1,282 @@
+"""
+Multi-process worker pool around `bark.api.generate_audio`, for throughput on many-core cpus.
+
+One process can only spread a single request over its intra-op threads, which stops scaling
+well past a few cores. The pool loads the models once in the parent and then forks the
+workers, so every worker reads the same weights: copy-on-write pages (or shared memory
+tensors with `share_memory=True`) instead of one copy per process. Each worker is pinned to
+its own slice of the cores with a matching `torch.set_num_threads`, and takes requests from
+a shared queue:
+
+    from bark.generation import preload_models
+    from bark.pool import WorkerPool
+
+    preload_models(
+        text_use_gpu=False, coarse_use_gpu=False, fine_use_gpu=False, codec_use_gpu=False
+    )
+    with WorkerPool(n_workers=8) as pool:
+        futures = [pool.submit(text, history_prompt="v2/en_speaker_6") for text in texts]
+        audio_arrs = [f.result() for f in futures]
+        print(pool.stats())
+
+Workers are forked, so this needs a platform with `fork` (linux, macos) and models on cpu:
+cuda can't be used from a forked process.
+"""
+from concurrent.futures import Future
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+
+import torch
+
+from . import api
+from . import generation
+
+logger = logging.getLogger(__name__)
+
+MODEL_KEYS = ("text", "coarse", "fine", "codec")
+
+
+def _available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _split_cores(cores, n_workers, threads_per_worker):
+    """Contiguous core sets, one per worker, wrapping around when there are too few cores."""
+    return [
+        [cores[(i * threads_per_worker + j) % len(cores)] for j in range(threads_per_worker)]
+        for i in range(n_workers)
+    ]
+
+
+def _picklable_error(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(f"{type(e).__name__}: {e}")
+
+
+def _worker_main(worker_id, cores, n_threads, task_queue, result_queue, pin_cores):
+    if pin_cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(n_threads)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        task_id, kwargs = task
+        result_queue.put(("start", worker_id, task_id, None))
+        t0 = time.perf_counter()
+        try:
+            out, ok = api.generate_audio(**kwargs), True
+        except Exception as e:
+            out, ok = _picklable_error(e), False
+        busy_s = time.perf_counter() - t0
+        result_queue.put(("done" if ok else "error", worker_id, task_id, (out, busy_s)))
+
+
+class WorkerPool:
+    """
+    Forked `generate_audio` workers sharing the parent's loaded models.
+
+    Args:
+        n_workers: number of worker processes, by default one per `threads_per_worker` cores
+        threads_per_worker: intra-op threads (and pinned cores) of each worker, by default
+            the available cores split evenly between the workers
+        pin_cores: pin each worker to its own cores, so workers don't migrate and share caches
+        share_memory: move the weights into shared memory before forking, instead of relying
+            on copy-on-write
+    """
+
+    def __init__(self, n_workers=None, threads_per_worker=None, pin_cores=True, share_memory=False):
+        cores = _available_cores()
+        if n_workers is None:
+            n_workers = max(1, len(cores) // (threads_per_worker or 4))
+        if threads_per_worker is None:
+            threads_per_worker = max(1, len(cores) // n_workers)
+        assert n_workers > 0 and threads_per_worker > 0
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.worker_cores = _split_cores(cores, n_workers, threads_per_worker)
+        self.pin_cores = pin_cores
+        self.share_memory = share_memory
+        self._ctx = multiprocessing.get_context("fork")
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._next_task_id = 0
+        self._processes = []
+        self._collector = None
+        self._closed = False
+        self._started_at = None
+        # per worker: task in flight, tasks done, seconds spent generating
+        self._current = [None] * n_workers
+        self._n_done = [0] * n_workers
+        self._busy_s = [0.0] * n_workers
+
+    def _prepare_models(self):
+        for model_key in MODEL_KEYS:
+            # a load still running on a loader thread wouldn't survive the fork
+            generation.models.wait(model_key)
+            if model_key not in generation.models:
+                generation.models._ensure_loaded(model_key)
+            model = generation._unwrap_model(generation.models[model_key])
+            if any(p.device.type != "cpu" for p in model.parameters()):
+                raise RuntimeError(
+                    f"the {model_key} model is on {next(model.parameters()).device}, worker "
+                    "pools need every model on cpu (load them with use_gpu=False)"
+                )
+            if self.share_memory:
+                model.share_memory()
+
+    def start(self):
+        """Load any missing model, then fork the workers. Called by `with WorkerPool(...)`."""
+        assert not self._processes, "pool already started"
+        self._prepare_models()
+        self._task_queue = self._ctx.Queue()
+        self._result_queue = self._ctx.Queue()
+        # every worker is forked before the pool starts any thread of its own
+        for worker_id, cores in enumerate(self.worker_cores):
+            process = self._ctx.Process(
+                target=_worker_main,
+                args=(
+                    worker_id,
+                    cores,
+                    self.threads_per_worker,
+                    self._task_queue,
+                    self._result_queue,
+                    self.pin_cores,
+                ),
+                name=f"bark-worker-{worker_id}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+        self._started_at = time.perf_counter()
+        self._collector = threading.Thread(
+            target=self._collect, name="bark-pool-results", daemon=True
+        )
+        self._collector.start()
+        return self
+
+    def submit(self, text, **kwargs):
+        """
+        Queue `generate_audio(text, **kwargs)` and return a Future of its result.
+
+        The stages run one after the other unless `overlap_stages=True` is passed, since
+        overlapping them would run two stages on the threads and cores sized for one.
+        """
+        assert self._processes, "pool not started"
+        assert not self._closed, "pool is closed"
+        kwargs = {"silent": True, "overlap_stages": False, **kwargs, "text": text}
+        future = Future()
+        with self._lock:
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            self._futures[task_id] = future
+        self._task_queue.put((task_id, kwargs))
+        return future
+
+    def map(self, texts, **kwargs):
+        """`generate_audio` over `texts` with shared kwargs, results in order."""
+        futures = [self.submit(text, **kwargs) for text in texts]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        n_alive = self.n_workers
+        while n_alive > 0:
+            try:
+                kind, worker_id, task_id, payload = self._result_queue.get(timeout=0.5)
+            except queue.Empty:
+                n_alive = self._check_workers()
+                continue
+            with self._lock:
+                if kind == "start":
+                    self._current[worker_id] = task_id
+                    continue
+                self._current[worker_id] = None
+                out, busy_s = payload
+                self._n_done[worker_id] += 1
+                self._busy_s[worker_id] += busy_s
+                future = self._futures.pop(task_id)
+            if kind == "done":
+                future.set_result(out)
+            else:
+                future.set_exception(out)
+
+    def _check_workers(self):
+        """Fail the request of any worker that died, and return how many are still alive."""
+        n_alive = 0
+        for worker_id, process in enumerate(self._processes):
+            if process.is_alive():
+                n_alive += 1
+                continue
+            with self._lock:
+                task_id, self._current[worker_id] = self._current[worker_id], None
+                future = self._futures.pop(task_id, None) if task_id is not None else None
+            if future is not None:
+                logger.error(f"bark worker {worker_id} died with exit code {process.exitcode}")
+                future.set_exception(
+                    RuntimeError(f"worker {worker_id} died with exit code {process.exitcode}")
+                )
+        if n_alive == 0:
+            # nobody left to run what's still queued
+            with self._lock:
+                futures, self._futures = list(self._futures.values()), {}
+            for future in futures:
+                future.set_exception(RuntimeError("all bark workers exited"))
+        return n_alive
+
+    def stats(self):
+        """Per worker pid, cores, tasks done, busy seconds and utilization since the start."""
+        elapsed = time.perf_counter() - self._started_at if self._started_at is not None else 0.0
+        with self._lock:
+            return [
+                {
+                    "worker": worker_id,
+                    "pid": process.pid,
+                    "alive": process.is_alive(),
+                    "cores": self.worker_cores[worker_id],
+                    "busy": self._current[worker_id] is not None,
+                    "tasks": self._n_done[worker_id],
+                    "busy_s": self._busy_s[worker_id],
+                    "utilization": self._busy_s[worker_id] / elapsed if elapsed > 0 else 0.0,
+                }
+                for worker_id, process in enumerate(self._processes)
+            ]
+
+    def close(self, timeout=None):
+        """Let the workers finish the queued requests, then stop them."""
+        if self._closed or not self._processes:
+            return
+        self._closed = True
+        for _ in self._processes:
+            self._task_queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+        self._collector.join(timeout)
+
+    def terminate(self):
+        """Stop the workers right away, failing the requests still pending."""
+        self._closed = True
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+        if self._collector is not None:
+            self._collector.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -0,0 +1,145 @@
+"""
+Packed archive of the bundled speaker prompts.
+
+All `.npz` prompts under `assets/prompts` are stored back to back in one flat uint16 `.npy`
+file (every semantic token and codebook index fits in 16 bits), next to a JSON index of
+offsets and shapes. The data file is memory-mapped, so a prompt lookup is a dict access plus
+zero-copy slices instead of a file open and zip parse.
+
+Build it into the package assets before packaging with:
+
+    python -m bark.prompt_archive
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+ARCHIVE_DATA_FILE = "prompts_archive.npy"
+ARCHIVE_INDEX_FILE = "prompts_archive.json"
+ARCHIVE_VERSION = 1
+PROMPT_KEYS = ("semantic_prompt", "coarse_prompt", "fine_prompt")
+
+
+def _list_prompt_files(prompts_dir):
+    """(name, path) of every .npz prompt, with names like "v2/en_speaker_1"."""
+    files = []
+    for root, _, file_names in os.walk(prompts_dir):
+        for file_name in file_names:
+            if file_name.endswith(".npz"):
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, prompts_dir)[: -len(".npz")]
+                files.append((name.replace(os.sep, "/"), path))
+    return sorted(files)
+
+
+def source_fingerprint(prompts_dir):
+    """Changes whenever a prompt file is added, removed, resized or modified."""
+    # fixed-shape token arrays keep their size when edited, so the mtime has to be part of it.
+    # An installer that doesn't preserve mtimes only costs one rebuild of the archive
+    h = hashlib.sha1()
+    for name, path in _list_prompt_files(prompts_dir):
+        st = os.stat(path)
+        h.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+
+def build_archive(prompts_dir, out_dir):
+    """Pack every .npz prompt under `prompts_dir` into an archive in `out_dir`."""
+    index = {}
+    chunks = []
+    offset = 0
+    for name, path in _list_prompt_files(prompts_dir):
+        with np.load(path) as prompt:
+            entry = {}
+            for key in PROMPT_KEYS:
+                arr = prompt[key]
+                assert arr.min() >= 0 and arr.max() <= np.iinfo(np.uint16).max, (name, key)
+                chunks.append(np.ascontiguousarray(arr, dtype=np.uint16).ravel())
+                entry[key] = [offset, *arr.shape]
+                offset += arr.size
+            index[name] = entry
+    os.makedirs(out_dir, exist_ok=True)
+    data_path = os.path.join(out_dir, ARCHIVE_DATA_FILE)
+    index_path = os.path.join(out_dir, ARCHIVE_INDEX_FILE)
+    # write to temp files and rename, so concurrent readers never see a partial archive
+    with open(f"{data_path}.tmp", "wb") as f:
+        np.save(f, np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint16))
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(
+            {
+                "version": ARCHIVE_VERSION,
+                "fingerprint": source_fingerprint(prompts_dir),
+                "size": offset,
+                "prompts": index,
+            },
+            f,
+        )
+    os.replace(f"{data_path}.tmp", data_path)
+    os.replace(f"{index_path}.tmp", index_path)
+    logger.info(f"packed {len(index)} prompts into `{data_path}`")
+
+
+class PromptArchive:
+    """Read-only view of a packed prompt archive, looked up by prompt name."""
+
+    def __init__(self, archive_dir):
+        with open(os.path.join(archive_dir, ARCHIVE_INDEX_FILE)) as f:
+            meta = json.load(f)
+        if meta.get("version") != ARCHIVE_VERSION:
+            raise ValueError(f"unsupported prompt archive version {meta.get('version')}")
+        self.fingerprint = meta["fingerprint"]
+        self._index = meta["prompts"]
+        self._data = np.load(os.path.join(archive_dir, ARCHIVE_DATA_FILE), mmap_mode="r")
+        if self._data.dtype != np.uint16 or self._data.size != meta["size"]:
+            # data and index are written separately, don't pair files from different builds
+            raise ValueError("prompt archive data doesn't match its index")
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, name):
+        """The prompt arrays as read-only views into the mapped file."""
+        prompt = {}
+        for key, (offset, *shape) in self._index[name].items():
+            size = int(np.prod(shape))
+            prompt[key] = self._data[offset : offset + size].reshape(shape)
+        return prompt
+
+
+def open_archive(archive_dirs, prompts_dir):
+    """
+    The first archive in `archive_dirs` that is up to date with `prompts_dir`, or None.
+
+    An archive built from a different set of prompt files is skipped rather than trusted.
+    """
+    fingerprint = None
+    for archive_dir in archive_dirs:
+        if not os.path.exists(os.path.join(archive_dir, ARCHIVE_INDEX_FILE)):
+            continue
+        try:
+            archive = PromptArchive(archive_dir)
+        except (OSError, ValueError) as e:
+            logger.warning(f"ignoring unreadable prompt archive in `{archive_dir}`: {e}")
+            continue
+        if fingerprint is None:
+            fingerprint = source_fingerprint(prompts_dir)
+        if archive.fingerprint == fingerprint:
+            return archive
+        logger.info(f"prompt archive in `{archive_dir}` is out of date, skipping it")
+    return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    prompts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "prompts")
+    build_archive(prompts_dir, sys.argv[1] if len(sys.argv) > 1 else prompts_dir)
@@ -0,0 +1,128 @@
+"""
+Token sampling shared by the semantic, coarse and fine stages.
+
+Everything here works on torch tensors of shape (..., vocab) on whatever device the model
+runs on, with a leading batch dimension where rows are independent sequences.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def apply_top_k(logits, top_k):
+    """Mask everything but the `top_k` largest logits of each row."""
+    v, _ = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1)
+    return logits.masked_fill(logits < v[..., [-1]], -float("Inf"))
+
+
+def apply_top_p(logits, top_p):
+    """Nucleus filtering: keep the smallest set of logits whose probability mass exceeds `top_p`."""
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+    cumulative_probs = torch.cumsum(F.softmax(sorted_logits.float(), dim=-1), dim=-1)
+    sorted_indices_to_remove = cumulative_probs > top_p
+    # shift right so the token that crosses the threshold is kept
+    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+    sorted_indices_to_remove[..., 0] = False
+    indices_to_remove = sorted_indices_to_remove.scatter(
+        -1, sorted_indices, sorted_indices_to_remove
+    )
+    return logits.masked_fill(indices_to_remove, -float("Inf"))
+
+
+def make_generators(seeds, device):
+    """One seeded torch.Generator per batch row, or None to use the global RNG."""
+    if seeds is None:
+        return None
+    generators = []
+    for seed in seeds:
+        generator = torch.Generator(device=device)
+        generator.manual_seed(int(seed))
+        generators.append(generator)
+    return generators
+
+
+def select_generators(generators, rows):
+    """Keep the generators of the given batch rows, mirroring `index_select` on the batch."""
+    if generators is None:
+        return None
+    return [generators[row] for row in rows.tolist()]
+
+
+def multinomial(probs, generators=None):
+    """
+    Draw one sample per distribution from (batch, ..., vocab) probabilities.
+
+    With `generators`, row i of the batch is drawn from `generators[i]`, so every row's
+    samples are reproducible no matter which other rows it is batched with.
+    """
+    vocab_size = probs.size(-1)
+    if generators is None:
+        samples = torch.multinomial(probs.reshape(-1, vocab_size), num_samples=1)
+        return samples.reshape(probs.shape[:-1])
+    assert len(generators) == probs.size(0)
+    samples = [
+        torch.multinomial(row.reshape(-1, vocab_size), num_samples=1, generator=generator)
+        for row, generator in zip(probs, generators)
+    ]
+    return torch.stack(samples).reshape(probs.shape[:-1])
+
+
+def filtered_probs(logits, temp=1.0, top_k=None, top_p=None):
+    """The distribution `sample` draws from: top-p, then top-k, then a tempered softmax."""
+    if top_p is not None:
+        logits = apply_top_p(logits, top_p)
+    if top_k is not None:
+        logits = apply_top_k(logits, top_k)
+    return F.softmax(logits / temp, dim=-1)
+
+
+def sample(logits, temp=1.0, top_k=None, top_p=None, generators=None):
+    """
+    Sample tokens from (batch, ..., vocab) logits.
+
+    Returns the sampled indices (batch, ...) and the probabilities they were drawn from, so
+    callers can run their own checks on them (e.g. `eos_reached`).
+    """
+    probs = filtered_probs(logits, temp=temp, top_k=top_k, top_p=top_p)
+    return multinomial(probs, generators), probs
+
+
+def uniform(batch_size, device, generators=None):
+    """One U[0, 1) draw per batch row."""
+    if generators is None:
+        return torch.rand(batch_size, device=device)
+    assert len(generators) == batch_size
+    return torch.cat([torch.rand(1, device=device, generator=g) for g in generators])
+
+
+def speculative_accept(token, p, q, generators=None):
+    """
+    Rejection step of speculative sampling for (batch, vocab) target probs `p` and draft
+    probs `q`. `token` was drawn from `q`; it is kept with probability min(1, p/q), otherwise
+    a replacement is drawn from the normalized residual max(0, p - q). The returned tokens
+    are distributed exactly according to `p`.
+
+    Returns (tokens, accepted).
+    """
+    rows = torch.arange(p.size(0), device=p.device)
+    p_token = p[rows, token]
+    q_token = q[rows, token]
+    accepted = uniform(p.size(0), p.device, generators) * q_token <= p_token
+    if bool(accepted.all()):
+        return token, accepted
+    # only rejected rows draw a replacement, accepted ones leave their generator untouched
+    rejected = torch.nonzero(~accepted).squeeze(-1)
+    p, q = p[rejected], q[rejected]
+    residual = (p - q).clamp(min=0)
+    residual_mass = residual.sum(dim=-1, keepdim=True)
+    residual = torch.where(residual_mass > 0, residual / residual_mass.clamp(min=1e-12), p)
+    tokens = token.clone()
+    tokens[rejected] = multinomial(residual, select_generators(generators, rejected))
+    return tokens, accepted
+
+
+def eos_reached(tokens, probs, eos_idx, min_eos_p=None):
+    """Rows that sampled `eos_idx`, or gave it at least `min_eos_p` probability."""
+    is_eos = tokens == eos_idx
+    if min_eos_p is not None:
+        is_eos = is_eos | (probs[..., eos_idx] >= min_eos_p)
+    return is_eos
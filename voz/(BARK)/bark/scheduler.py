@@ -0,0 +1,558 @@
+"""
+Continuous (iteration-level) batching for the semantic and coarse stages.
+
+A static batch runs until its longest sequence finishes. Short utterances then sit idle in
+it, and new requests wait for the whole batch. A scheduler instead keeps one running decode
+batch per model on its own thread. New requests join at the next token boundary, after a
+prefill of their prompt. Finished requests leave right away. The keys and values of each
+request live in a slot of a `SlotKVCache` pool, so joining and leaving never touches the
+other rows:
+
+    from bark.scheduler import CoarseScheduler, SemanticScheduler
+
+    with SemanticScheduler(max_batch_size=16) as semantic, CoarseScheduler() as coarse:
+        x_semantic = semantic.submit(text, history_prompt="v2/en_speaker_6", seed=0).result()
+        x_coarse = coarse.submit(x_semantic, history_prompt="v2/en_speaker_6", seed=0).result()
+
+Requests may use different sampling parameters, rows are sampled in groups that share them.
+With a seed, a request draws from its own generator, as in the single-sequence functions.
+Outputs can still differ from those in rare cases, since batched attention sums in a
+different order.
+"""
+from collections import deque
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from . import sampling
+from .generation import (
+    CODEBOOK_SIZE,
+    COARSE_INFER_TOKEN,
+    COARSE_RATE_HZ,
+    COARSE_SEMANTIC_PAD_TOKEN,
+    N_COARSE_CODEBOOKS,
+    SEMANTIC_RATE_HZ,
+    SEMANTIC_VOCAB_SIZE,
+    _clear_cuda_cache,
+    _inference_mode,
+    _left_pad_rows,
+    _load_coarse_history,
+    _n_coarse_steps,
+    _normalize_whitespace,
+    _prepare_semantic_inputs,
+    _unflatten_coarse,
+    _unwrap_model,
+    load_history_prompt,
+    models,
+)
+from .model import SlotKVCache, StaticKVCache
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _grouped(requests, key):
+    """Row indices of `requests`, grouped by `key(request)`."""
+    groups = {}
+    for i, request in enumerate(requests):
+        groups.setdefault(key(request), []).append(i)
+    return groups.items()
+
+
+class _Request:
+    def __init__(self, temp, top_k, top_p, seed):
+        self.temp = temp
+        self.top_k = top_k
+        self.top_p = top_p
+        self.seed = seed
+        self.generator = None
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+        self.slot = None
+        self.next_token = None
+        self.done = False
+        self.result = None
+
+    def sampling_key(self):
+        return (self.temp, self.top_k, self.top_p, self.seed is not None)
+
+
+class _DecodeScheduler:
+    """
+    Decode loop shared by the stage schedulers, running on its own thread.
+
+    Subclasses prefill new requests and turn logits into tokens. This class admits requests
+    into free slots, runs one batched decode step at a time and retires the rows that left.
+    """
+
+    model_key = None
+
+    def __init__(self, max_batch_size=16, max_prefill_size=4):
+        assert max_batch_size > 0 and max_prefill_size > 0
+        self.max_batch_size = max_batch_size
+        # requests prefilled per step, bounding the pause a join adds to the running rows
+        self.max_prefill_size = max_prefill_size
+        self._queue = queue.Queue()
+        self._waiting = deque()
+        # in-flight requests that left their slot and need a new prefill (coarse windows)
+        self._resuming = deque()
+        self._admitting = []
+        # request of each active slot
+        self._rows = []
+        self._model = None
+        self._slots = None
+        self._device = None
+        self._thread = None
+        self._closed = False
+        self._n_steps = 0
+        self._n_step_rows = 0
+        self._n_prefills = 0
+        self._latencies = deque(maxlen=1000)
+
+    def start(self):
+        """Start the decode thread. Called by `with ...Scheduler(...)`."""
+        assert self._thread is None, "scheduler already started"
+        self._thread = threading.Thread(
+            target=self._run, name=f"bark-{self.model_key}-scheduler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def _submit(self, request):
+        assert self._thread is not None, "scheduler not started"
+        assert not self._closed, "scheduler is closed"
+        self._queue.put(request)
+        return request.future
+
+    def _take(self, item):
+        """Queue an incoming request, returning True for the stop marker."""
+        if item is _STOP:
+            return True
+        if item.future.set_running_or_notify_cancel():
+            self._waiting.append(item)
+        return False
+
+    def _run(self):
+        stopping = False
+        while True:
+            if not (self._rows or self._resuming or self._waiting):
+                # idle: unpin the model until the next request
+                self._unload()
+                if stopping:
+                    return
+                stopping = self._take(self._queue.get()) or stopping
+            while True:
+                try:
+                    stopping = self._take(self._queue.get_nowait()) or stopping
+                except queue.Empty:
+                    break
+            try:
+                self._load()
+                with _inference_mode():
+                    self._admit()
+                    if self._rows:
+                        self._step()
+            except Exception as e:
+                logger.exception(f"{self.model_key} scheduler step failed")
+                stopping = self._fail_all(e) or stopping
+
+    def _load(self):
+        if self._model is not None:
+            return
+        container = models.acquire(self.model_key)
+        try:
+            self._on_load(container)
+            model = _unwrap_model(container)
+            self._device = next(model.parameters()).device
+            self._slots = SlotKVCache(model.config, n_slots=self.max_batch_size)
+        except BaseException:
+            # leave nothing loaded, so the next request retries from scratch
+            self._slots = None
+            models.release(self.model_key)
+            raise
+        self._model = model
+
+    def _on_load(self, container):
+        pass
+
+    def _unload(self):
+        if self._model is None:
+            return
+        self._model = None
+        self._slots = None
+        models.release(self.model_key)
+        _clear_cuda_cache()
+
+    def _admit(self):
+        n_admit = min(self._slots.n_free, self.max_prefill_size)
+        while len(self._admitting) < n_admit and (self._resuming or self._waiting):
+            source = self._resuming if self._resuming else self._waiting
+            self._admitting.append(source.popleft())
+        if not self._admitting:
+            return
+        requests = self._admitting
+        try:
+            for request in requests:
+                if request.generator is None and request.seed is not None:
+                    request.generator = sampling.make_generators([request.seed], self._device)[0]
+            cache, attention_mask, logits = self._prefill(requests)
+            leaving = self._consume(requests, logits)
+        except Exception as e:
+            # a bad prompt fails the requests it came with, the running rows carry on
+            logger.exception(f"{self.model_key} scheduler prefill failed")
+            self._admitting = []
+            self._fail(requests, e)
+            return
+        for request, slot in zip(requests, self._slots.add(cache, attention_mask)):
+            request.slot = slot
+            self._rows.append(request)
+        self._admitting = []
+        self._n_prefills += len(requests)
+        self._retire(leaving)
+
+    def _step(self):
+        attention_mask = self._slots.step_mask()
+        x = torch.tensor([[request.next_token] for request in self._rows], dtype=torch.int64)
+        x = x.to(self._device)
+        logits, _ = self._model(
+            x,
+            use_cache=True,
+            past_kv=self._slots,
+            attention_mask=attention_mask,
+            logits_range=self.logits_range,
+        )
+        self._n_steps += 1
+        self._n_step_rows += len(self._rows)
+        self._retire(self._consume(list(self._rows), logits[:, 0]))
+
+    def _retire(self, leaving):
+        """Free the slots of the requests that left, resuming the unfinished ones later."""
+        # highest slot first, so the slot moved into a freed one is never freed later on
+        for request in sorted(leaving, key=lambda r: r.slot, reverse=True):
+            moved = self._slots.remove(request.slot)
+            if moved != request.slot:
+                self._rows[request.slot] = self._rows[moved]
+                self._rows[request.slot].slot = request.slot
+            self._rows.pop()
+            request.slot = None
+            if request.done:
+                self._latencies.append(time.perf_counter() - request.submitted_at)
+                request.future.set_result(request.result)
+            else:
+                self._resuming.append(request)
+
+    @staticmethod
+    def _fail(requests, e):
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(e)
+
+    def _fail_all(self, e):
+        """Fail every request in flight or queued, returning True if the stop marker was seen."""
+        stopping = False
+        while True:
+            try:
+                stopping = self._take(self._queue.get_nowait()) or stopping
+            except queue.Empty:
+                break
+        self._fail(self._rows + list(self._resuming) + self._admitting + list(self._waiting), e)
+        self._rows = []
+        self._resuming.clear()
+        self._admitting = []
+        self._waiting.clear()
+        if self._model is not None:
+            self._slots = SlotKVCache(self._model.config, n_slots=self.max_batch_size)
+        return stopping
+
+    def stats(self):
+        """Decode steps, mean and relative batch size, queue depth and request latencies."""
+        mean_batch = self._n_step_rows / self._n_steps if self._n_steps else 0.0
+        latencies = sorted(self._latencies)
+        return {
+            "steps": self._n_steps,
+            "prefills": self._n_prefills,
+            "active": len(self._rows),
+            "waiting": self._queue.qsize() + len(self._waiting),
+            "mean_batch": mean_batch,
+            "utilization": mean_batch / self.max_batch_size,
+            "latency_p50_s": latencies[len(latencies) // 2] if latencies else None,
+            "latency_p99_s": latencies[int(len(latencies) * 0.99)] if latencies else None,
+        }
+
+    def close(self):
+        """Finish every submitted request, then stop the decode thread."""
+        if self._closed or self._thread is None:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class _SemanticRequest(_Request):
+    def __init__(
+        self, text, semantic_history, min_eos_p, max_gen_duration_s, allow_early_stop, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.text = text
+        self.semantic_history = semantic_history
+        self.min_eos_p = min_eos_p
+        self.max_gen_duration_s = max_gen_duration_s
+        self.allow_early_stop = allow_early_stop
+        self.tokens = []
+        self.n_step = 0
+        self.generated_duration_s = 0
+
+
+class SemanticScheduler(_DecodeScheduler):
+    """
+    Continuous batching of `generate_text_semantic` requests.
+
+    Args:
+        max_batch_size: most requests decoded together (kv cache slots)
+        max_prefill_size: most requests joining per step
+    """
+
+    model_key = "text"
+    # eos included, rows that can't stop early slice it off
+    logits_range = (0, SEMANTIC_VOCAB_SIZE + 1)
+    n_tot_steps = 768
+
+    def _on_load(self, container):
+        self._tokenizer = container["tokenizer"]
+        models.prefetch("coarse")
+
+    def submit(
+        self,
+        text,
+        history_prompt=None,
+        temp=0.7,
+        top_k=None,
+        top_p=None,
+        min_eos_p=0.2,
+        max_gen_duration_s=None,
+        allow_early_stop=True,
+        seed=None,
+    ):
+        """Queue a request and return a Future of what `generate_text_semantic` returns."""
+        assert isinstance(text, str) and len(_normalize_whitespace(text)) > 0
+        history_prompt = load_history_prompt(history_prompt)
+        request = _SemanticRequest(
+            text,
+            None if history_prompt is None else history_prompt.semantic_history(),
+            min_eos_p,
+            max_gen_duration_s,
+            allow_early_stop,
+            temp=temp,
+            top_k=top_k,
+            top_p=top_p,
+            seed=seed,
+        )
+        return self._submit(request)
+
+    def _prefill(self, requests):
+        # every prompt is 256 text + 256 history + 1 infer token, merged into 257 positions
+        x = np.stack(
+            _prepare_semantic_inputs(
+                self._tokenizer,
+                [request.text for request in requests],
+                [request.semantic_history for request in requests],
+            )
+        )
+        x = torch.from_numpy(x).to(self._device)
+        cache = StaticKVCache(self._model.config, batch_size=len(requests), max_len=256 + 1)
+        logits, _ = self._model(
+            x, merge_context=True, use_cache=True, past_kv=cache, logits_range=self.logits_range
+        )
+        return cache, None, logits[:, 0]
+
+    def _consume(self, requests, logits):
+        leaving = []
+        for key, rows in _grouped(
+            requests, lambda r: (*r.sampling_key(), r.allow_early_stop, r.min_eos_p)
+        ):
+            group = [requests[row] for row in rows]
+            temp, top_k, top_p, seeded, allow_early_stop, min_eos_p = key
+            n_logits = SEMANTIC_VOCAB_SIZE + 1 if allow_early_stop else SEMANTIC_VOCAB_SIZE
+            item_next, probs = sampling.sample(
+                logits[rows, :n_logits],
+                temp=temp,
+                top_k=top_k,
+                top_p=top_p,
+                generators=[r.generator for r in group] if seeded else None,
+            )
+            if allow_early_stop:
+                is_eos = sampling.eos_reached(item_next, probs, SEMANTIC_VOCAB_SIZE, min_eos_p)
+                is_eos = is_eos.tolist()
+            else:
+                is_eos = [False] * len(group)
+            for request, token, eos in zip(group, item_next.tolist(), is_eos):
+                if self._advance(request, token, eos):
+                    leaving.append(request)
+        return leaving
+
+    def _advance(self, request, token, eos):
+        """Take the sampled token, returning True once the request is done."""
+        n = request.n_step
+        request.n_step += 1
+        if not eos:
+            request.tokens.append(token)
+            request.next_token = token
+            request.generated_duration_s += 1 / SEMANTIC_RATE_HZ
+        if eos or n == self.n_tot_steps - 1 or (
+            request.max_gen_duration_s is not None
+            and request.generated_duration_s > request.max_gen_duration_s
+        ):
+            # eos is not part of the output
+            out = np.array(request.tokens, dtype=np.int64)
+            assert all(0 <= out) and all(out < SEMANTIC_VOCAB_SIZE)
+            request.done = True
+            request.result = out
+            return True
+        return False
+
+
+class _CoarseRequest(_Request):
+    def __init__(self, x_semantic_in, x_coarse_history, base_semantic_idx, n_steps, **kwargs):
+        super().__init__(**kwargs)
+        self.x_semantic_in = x_semantic_in
+        self.x_coarse = list(x_coarse_history)
+        self.n_history = len(x_coarse_history)
+        self.base_semantic_idx = base_semantic_idx
+        self.n_steps = n_steps
+        self.n_step = 0
+
+
+class CoarseScheduler(_DecodeScheduler):
+    """
+    Continuous batching of `generate_coarse` requests.
+
+    Every sliding window starts from a new prompt, so a request leaves its slot after each
+    window and rejoins with a prefill of the next one, as it does when decoded alone.
+
+    Args:
+        max_batch_size: most requests decoded together (kv cache slots)
+        max_prefill_size: most requests joining (or starting a window) per step
+        max_coarse_history: coarse codes of context, min 60 (faster), max 630 (more context)
+        sliding_window_len: coarse codes generated per prompt
+    """
+
+    model_key = "coarse"
+    # both codebooks, each row keeps the one its step samples from
+    logits_range = (SEMANTIC_VOCAB_SIZE, SEMANTIC_VOCAB_SIZE + N_COARSE_CODEBOOKS * CODEBOOK_SIZE)
+
+    def __init__(
+        self, max_batch_size=16, max_prefill_size=4, max_coarse_history=630, sliding_window_len=60
+    ):
+        super().__init__(max_batch_size=max_batch_size, max_prefill_size=max_prefill_size)
+        assert 60 <= max_coarse_history <= 630
+        assert max_coarse_history + sliding_window_len <= 1024 - 256
+        self.max_coarse_history = max_coarse_history
+        self.sliding_window_len = sliding_window_len
+        self.semantic_to_coarse_ratio = COARSE_RATE_HZ / SEMANTIC_RATE_HZ * N_COARSE_CODEBOOKS
+        self.max_semantic_history = int(
+            np.floor(max_coarse_history / self.semantic_to_coarse_ratio)
+        )
+
+    def _on_load(self, container):
+        models.prefetch("fine")
+
+    def submit(self, x_semantic, history_prompt=None, temp=0.7, top_k=None, top_p=None, seed=None):
+        """Queue a request and return a Future of what `generate_coarse` returns."""
+        assert (
+            isinstance(x_semantic, np.ndarray)
+            and len(x_semantic.shape) == 1
+            and len(x_semantic) > 0
+            and x_semantic.min() >= 0
+            and x_semantic.max() <= SEMANTIC_VOCAB_SIZE - 1
+        )
+        x_semantic_history, x_coarse_history = _load_coarse_history(
+            history_prompt, self.max_semantic_history, self.semantic_to_coarse_ratio
+        )
+        request = _CoarseRequest(
+            np.hstack([x_semantic_history, x_semantic]).astype(np.int32),
+            x_coarse_history.astype(np.int32),
+            len(x_semantic_history),
+            _n_coarse_steps(len(x_semantic), self.semantic_to_coarse_ratio),
+            temp=temp,
+            top_k=top_k,
+            top_p=top_p,
+            seed=seed,
+        )
+        return self._submit(request)
+
+    def _window_prompt(self, request):
+        semantic_idx = request.base_semantic_idx + int(
+            round(request.n_step / self.semantic_to_coarse_ratio)
+        )
+        semantic_start_idx = max(0, semantic_idx - self.max_semantic_history)
+        # pad from right side
+        x_semantic_in = request.x_semantic_in[semantic_start_idx:][:256]
+        x_semantic_in = np.pad(
+            x_semantic_in,
+            (0, 256 - len(x_semantic_in)),
+            constant_values=COARSE_SEMANTIC_PAD_TOKEN,
+            mode="constant",
+        )
+        x_coarse_ctx = request.x_coarse[max(0, len(request.x_coarse) - self.max_coarse_history) :]
+        return np.hstack([x_semantic_in, [COARSE_INFER_TOKEN], x_coarse_ctx]).astype(np.int64)
+
+    def _prefill(self, requests):
+        # coarse contexts differ in length, shorter ones are left padded and masked out
+        x, attention_mask = _left_pad_rows(
+            [torch.from_numpy(self._window_prompt(r)).to(self._device) for r in requests],
+            COARSE_SEMANTIC_PAD_TOKEN,
+        )
+        cache = StaticKVCache(self._model.config, batch_size=len(requests), max_len=x.shape[1])
+        logits, _ = self._model(
+            x,
+            use_cache=True,
+            past_kv=cache,
+            attention_mask=attention_mask,
+            logits_range=self.logits_range,
+        )
+        return cache, attention_mask, logits[:, 0]
+
+    def _consume(self, requests, logits):
+        leaving = []
+        for key, rows in _grouped(
+            requests, lambda r: (*r.sampling_key(), r.n_step % N_COARSE_CODEBOOKS)
+        ):
+            group = [requests[row] for row in rows]
+            temp, top_k, top_p, seeded, codebook = key
+            item_next, _ = sampling.sample(
+                logits[rows, codebook * CODEBOOK_SIZE : (codebook + 1) * CODEBOOK_SIZE],
+                temp=temp,
+                top_k=top_k,
+                top_p=top_p,
+                generators=[r.generator for r in group] if seeded else None,
+            )
+            offset = SEMANTIC_VOCAB_SIZE + codebook * CODEBOOK_SIZE
+            for request, token in zip(group, item_next.tolist()):
+                if self._advance(request, token + offset):
+                    leaving.append(request)
+        return leaving
+
+    def _advance(self, request, token):
+        """Take the sampled token, returning True once the request leaves its slot."""
+        request.x_coarse.append(token)
+        request.next_token = token
+        request.n_step += 1
+        if request.n_step >= request.n_steps:
+            gen_coarse_arr = np.array(request.x_coarse[request.n_history :], dtype=np.int32)
+            request.done = True
+            request.result = _unflatten_coarse(gen_coarse_arr)
+            return True
+        # the next window starts from a new prompt
+        return request.n_step % self.sliding_window_len == 0
@@ -0,0 +1,108 @@
+"""
+Compare latency and memory of the float and int8 quantized models on CPU.
+
+Each mode runs in its own subprocess so peak RSS is measured from a clean interpreter:
+
+    pip install -e . && python scripts/benchmark_int8.py
+    python scripts/benchmark_int8.py --use_small --n_repeats 3
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+PROMPTS = [
+    "Hello, my name is Suno. And, uh — and I like pizza.",
+    "The quick brown fox jumps over the lazy dog.",
+    "[clears throat] This is a test of the quantized inference mode.",
+]
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_mode(use_int8, use_small, n_repeats):
+    from bark import generation
+
+    t0 = time.perf_counter()
+    generation.preload_models(
+        text_use_gpu=False,
+        text_use_small=use_small,
+        coarse_use_gpu=False,
+        coarse_use_small=use_small,
+        fine_use_gpu=False,
+        fine_use_small=use_small,
+        codec_use_gpu=False,
+        use_int8=use_int8,
+    )
+    result = {"load_s": time.perf_counter() - t0, "rss_after_load_mb": _peak_rss_mb()}
+    timings = {"semantic": [], "coarse": [], "fine": []}
+    n_audio_s = 0.0
+    for _ in range(n_repeats):
+        for i, text in enumerate(PROMPTS):
+            t0 = time.perf_counter()
+            x_semantic = generation.generate_text_semantic(
+                text, silent=True, use_kv_caching=True, seed=i
+            )
+            t1 = time.perf_counter()
+            x_coarse = generation.generate_coarse(
+                x_semantic, silent=True, use_kv_caching=True, seed=i
+            )
+            t2 = time.perf_counter()
+            x_fine = generation.generate_fine(x_coarse, silent=True, seed=i)
+            t3 = time.perf_counter()
+            timings["semantic"].append(t1 - t0)
+            timings["coarse"].append(t2 - t1)
+            timings["fine"].append(t3 - t2)
+            n_audio_s += x_fine.shape[-1] / generation.COARSE_RATE_HZ
+    for stage, values in timings.items():
+        result[f"{stage}_s"] = sum(values)
+    result["audio_s"] = n_audio_s
+    result["peak_rss_mb"] = _peak_rss_mb()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--use_small", action="store_true", help="benchmark the small models")
+    parser.add_argument("--n_repeats", type=int, default=1, help="passes over the prompt set")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--mode", choices=["float", "int8"], default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        if args.threads is not None:
+            import torch
+
+            torch.set_num_threads(args.threads)
+        result = run_mode(args.mode == "int8", args.use_small, args.n_repeats)
+        print(json.dumps(result))
+        return
+
+    results = {}
+    for mode in ("float", "int8"):
+        cmd = [sys.executable, os.path.abspath(__file__), "--mode", mode]
+        cmd += ["--n_repeats", str(args.n_repeats)]
+        if args.use_small:
+            cmd.append("--use_small")
+        if args.threads is not None:
+            cmd += ["--threads", str(args.threads)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results[mode] = json.loads(out.strip().splitlines()[-1])
+
+    keys = list(results["float"].keys())
+    print(f"{'':<20}{'float':>12}{'int8':>12}{'ratio':>10}")
+    for key in keys:
+        f, q = results["float"][key], results["int8"][key]
+        ratio = q / f if f else float("nan")
+        print(f"{key:<20}{f:>12.2f}{q:>12.2f}{ratio:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Throughput and memory of `bark.pool.WorkerPool` for a range of worker counts on cpu.
+
+Every configuration splits the same cores between its workers, so the table shows how
+throughput scales with processes at a fixed thread budget. Memory is the proportional set
+size (PSS) of the parent and its workers, where shared weight pages are counted once:
+
+    pip install -e . && python scripts/benchmark_pool.py
+    python scripts/benchmark_pool.py --use_small --n_workers 1 2 4 8 --n_requests 32
+"""
+import argparse
+import os
+import time
+
+PROMPTS = [
+    "Hello, my name is Suno. And, uh — and I like pizza.",
+    "The quick brown fox jumps over the lazy dog.",
+    "[clears throat] This is a test of the worker pool.",
+    "Short one.",
+]
+
+
+def _pss_mb(pids):
+    """Summed PSS of `pids` from /proc (linux only), None elsewhere."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1])
+        except OSError:
+            return None
+    return total / 2**10
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--use_small", action="store_true", help="benchmark the small models")
+    parser.add_argument("--n_workers", type=int, nargs="+", default=[1, 2, 4], help="pool sizes")
+    parser.add_argument("--n_requests", type=int, default=16, help="requests per pool size")
+    args = parser.parse_args()
+
+    from bark import generation
+    from bark.pool import WorkerPool
+
+    generation.preload_models(
+        text_use_gpu=False,
+        text_use_small=args.use_small,
+        coarse_use_gpu=False,
+        coarse_use_small=args.use_small,
+        fine_use_gpu=False,
+        fine_use_small=args.use_small,
+        codec_use_gpu=False,
+    )
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    texts = [PROMPTS[i % len(PROMPTS)] for i in range(args.n_requests)]
+    print(f"{'workers':>8}{'threads':>9}{'req/s':>9}{'speedup':>9}{'util':>7}{'pss MB':>10}")
+    base = None
+    for n_workers in args.n_workers:
+        threads_per_worker = max(1, n_cores // n_workers)
+        with WorkerPool(n_workers=n_workers, threads_per_worker=threads_per_worker) as pool:
+            t0 = time.perf_counter()
+            # sequential stages, so each worker uses exactly its `threads_per_worker` cores
+            futures = [
+                pool.submit(text, seed=i, overlap_stages=False) for i, text in enumerate(texts)
+            ]
+            for future in futures:
+                future.result()
+            throughput = len(texts) / (time.perf_counter() - t0)
+            stats = pool.stats()
+            # before closing, while the workers still hold their working memory
+            pss = _pss_mb([os.getpid()] + [s["pid"] for s in stats])
+        base = base or throughput
+        util = sum(s["utilization"] for s in stats) / len(stats)
+        pss_s = f"{pss:>10.0f}" if pss is not None else f"{'n/a':>10}"
+        print(
+            f"{n_workers:>8}{threads_per_worker:>9}{throughput:>9.2f}"
+            f"{throughput / base:>9.2f}{util:>7.2f}{pss_s}"
+        )
+
+
+if __name__ == "__main__":
+    main()
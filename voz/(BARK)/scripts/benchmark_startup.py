@@ -0,0 +1,71 @@
+"""
+Measure how long bark takes to start, as seen by short-lived processes like CLI jobs.
+
+Every case runs in a fresh interpreter, so nothing is shared between runs but the OS page
+cache. The first run of each case is a warmup and not counted:
+
+    pip install -e . && python scripts/benchmark_startup.py
+    python scripts/benchmark_startup.py --n_repeats 20 --importtime
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+CASES = {
+    "import bark": [sys.executable, "-c", "import bark"],
+    "python -m bark --help": [sys.executable, "-m", "bark", "--help"],
+    "bad cli args": [sys.executable, "-m", "bark", "--text", "hi", "--history_prompt", "nope"],
+    "from bark import generate_audio": [sys.executable, "-c", "from bark import generate_audio"],
+    "import bark.generation": [sys.executable, "-c", "import bark.generation"],
+    "python (baseline)": [sys.executable, "-c", "pass"],
+}
+
+
+def _time_cmd(cmd):
+    t0 = time.perf_counter()
+    # bad invocations are expected to exit non-zero
+    subprocess.run(cmd, capture_output=True)
+    return time.perf_counter() - t0
+
+
+def _top_imports(stmt, n):
+    """The `n` modules with the largest cumulative import time, from `python -X importtime`."""
+    err = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", stmt], capture_output=True, text=True
+    ).stderr
+    rows = []
+    for line in err.splitlines():
+        m = re.match(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+        if m is not None:
+            # only top-level imports, nested ones are already counted in their parent
+            if len(m.group(3)) <= 1:
+                rows.append((int(m.group(2)) / 1e6, m.group(4)))
+    return sorted(rows, reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--n_repeats", type=int, default=5, help="timed runs per case")
+    parser.add_argument(
+        "--importtime", action="store_true", help="also list the slowest imports of `import bark`"
+    )
+    args = parser.parse_args()
+
+    print(f"{'':<36}{'median s':>10}{'min s':>10}")
+    for name, cmd in CASES.items():
+        _time_cmd(cmd)
+        timings = [_time_cmd(cmd) for _ in range(args.n_repeats)]
+        print(f"{name:<36}{statistics.median(timings):>10.3f}{min(timings):>10.3f}")
+
+    if args.importtime:
+        for stmt in ("import bark", "from bark import generate_audio"):
+            print(f"\nslowest imports of `{stmt}`:")
+            for seconds, module in _top_imports(stmt, 10):
+                print(f"{module:<36}{seconds:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare the fine stage on length buckets against the padded 1024 frame path.
+
+For each prompt the semantic and coarse codes are generated once. The fine stage then runs
+both ways on the same coarse codes, and the script reports time, agreement of the generated
+codebooks and the log spectral distance between the decoded waveforms:
+
+    pip install -e . && python scripts/compare_fine_buckets.py
+    python scripts/compare_fine_buckets.py --history_prompt v2/en_speaker_6 --use_small
+"""
+import argparse
+import time
+
+import torch
+
+PROMPTS = [
+    "Hi.",
+    "Hello, my name is Suno.",
+    "The quick brown fox jumps over the lazy dog.",
+    "[clears throat] This is a test of the fine length buckets, with a slightly longer line.",
+]
+
+
+def log_spectral_distance(a, b, n_fft=1024, hop_length=256):
+    """Mean absolute difference of the log magnitude spectrograms, in dB."""
+    window = torch.hann_window(n_fft)
+    specs = [
+        torch.stft(
+            torch.from_numpy(x), n_fft, hop_length=hop_length, window=window, return_complex=True
+        ).abs()
+        for x in (a, b)
+    ]
+    log_specs = [20 * torch.log10(spec.clamp(min=1e-5)) for spec in specs]
+    return float((log_specs[0] - log_specs[1]).abs().mean())
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--history_prompt", default=None, help="speaker prompt for all stages")
+    parser.add_argument("--use_small", action="store_true", help="use the small models")
+    parser.add_argument("--use_gpu", action="store_true", help="run the models on gpu")
+    parser.add_argument("--seed", type=int, default=0, help="seed of every stage")
+    args = parser.parse_args()
+
+    from bark import generation
+
+    generation.preload_models(
+        text_use_gpu=args.use_gpu,
+        text_use_small=args.use_small,
+        coarse_use_gpu=args.use_gpu,
+        coarse_use_small=args.use_small,
+        fine_use_gpu=args.use_gpu,
+        fine_use_small=args.use_small,
+        codec_use_gpu=args.use_gpu,
+    )
+    # greedy decoding compares the two paths directly. Sampled codes differ on every run, so
+    # the distance between two seeds of the padded path gives the noise floor
+    print(
+        f"{'frames':>8}{'padded s':>10}{'bucket s':>10}"
+        f"{'agree':>8}{'lsd dB':>9}{'seed lsd dB':>13}"
+    )
+    for i, text in enumerate(PROMPTS):
+        x_semantic = generation.generate_text_semantic(
+            text, history_prompt=args.history_prompt, silent=True, use_kv_caching=True, seed=i
+        )
+        x_coarse = generation.generate_coarse(
+            x_semantic,
+            history_prompt=args.history_prompt,
+            silent=True,
+            use_kv_caching=True,
+            seed=args.seed,
+        )
+        outs = {}
+        for length_buckets in (False, True):
+            outs[length_buckets] = _timed(
+                lambda: generation.generate_fine(
+                    x_coarse,
+                    history_prompt=args.history_prompt,
+                    temp=None,
+                    length_buckets=length_buckets,
+                )
+            )
+        (padded, t_padded), (bucketed, t_bucketed) = outs[False], outs[True]
+        agree = (padded[x_coarse.shape[0] :] == bucketed[x_coarse.shape[0] :]).mean()
+        lsd = log_spectral_distance(
+            generation.codec_decode(padded), generation.codec_decode(bucketed)
+        )
+        sampled = [
+            generation.codec_decode(
+                generation.generate_fine(x_coarse, history_prompt=args.history_prompt, seed=seed)
+            )
+            for seed in (args.seed, args.seed + 1)
+        ]
+        seed_lsd = log_spectral_distance(*sampled)
+        print(
+            f"{x_coarse.shape[1]:>8}{t_padded:>10.2f}{t_bucketed:>10.2f}"
+            f"{agree:>8.3f}{lsd:>9.2f}{seed_lsd:>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()